@@ -0,0 +1,19 @@
+#!/bin/bash
+
+# Shared file check
+# Each image only gets its own folder, so files both of them need are
+# copied. This fails when the copies have drifted apart.
+
+cd "$(dirname "$0")/../.." || exit 1
+
+SHARED_FILES="eventLog.py"
+STATUS=0
+
+for FILE in $SHARED_FILES; do
+    if ! cmp -s "mqtt2grafana/xcel_itron2mqtt/$FILE" "simulatedMeter2mqtt/$FILE"; then
+        echo "Error: mqtt2grafana/xcel_itron2mqtt/$FILE and simulatedMeter2mqtt/$FILE differ"
+        STATUS=1
+    fi
+done
+
+exit $STATUS
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of the per-reading XML extraction.
+
+Compares xcelEndpoint.parse_response (tree parse plus descendant
+searches) with the compiled ExtractionPlan against recorded 2030.5
+responses for both endpoint profiles.
+
+Run from the xcel_itron2mqtt folder:
+    python benchmarks/bench_parse.py [-n ROUNDS]
+"""
+import sys
+import timeit
+import argparse
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+from xcelMeter import xcelMeter
+from xcelEndpoint import xcelEndpoint
+from xcelExtract import ExtractionPlan
+
+FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
+PROFILES = ('default', '3_2_39')
+
+def fixture_path(profile: str, url: str) -> Path:
+    """
+    Recorded responses are stored under their URL path,
+    e.g. /upt/1/mr/1/r -> fixtures/<profile>/upt_1_mr_1_r.xml
+
+    Returns: Path
+    """
+    return FIXTURES_DIR / profile / f'{url.strip("/").replace("/", "_")}.xml'
+
+def load_cases(profile: str) -> list:
+    """
+    Pairs every endpoint of the profile's yaml with its recorded response.
+
+    Returns: list of (endpoint name, tags, response bytes)
+    """
+    endpoints = xcelMeter.load_endpoints(str(BASE_DIR / 'configs' / f'endpoints_{profile}.yaml'))
+    cases = []
+    for point in endpoints:
+        for name, v in point.items():
+            response = fixture_path(profile, v['url']).read_bytes()
+            cases.append((name, v['tags'], response))
+
+    return cases
+
+def bench(func, rounds: int) -> float:
+    """
+    Returns: float, best time per call in microseconds
+    """
+    timer = timeit.Timer(func)
+
+    return min(timer.repeat(repeat=5, number=rounds)) / rounds * 1e6
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--rounds', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f'{"profile":<8} {"endpoint":<28} {"parse_response":>15} {"plan":>9} {"speedup":>8}')
+    for profile in PROFILES:
+        for name, tags, response in load_cases(profile):
+            plan = ExtractionPlan(tags)
+            # Both paths have to agree before their timings mean anything
+            expected = xcelEndpoint.parse_response(response, tags)
+            assert plan.extract(response) == expected, f'{profile} {name} readings differ'
+            baseline = bench(lambda: xcelEndpoint.parse_response(response, tags), args.rounds)
+            compiled = bench(lambda: plan.extract(response), args.rounds)
+            print(f'{profile:<8} {name:<28} {baseline:>12.1f} us {compiled:>6.1f} us '
+                  f'{baseline / compiled:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Embedded MQTT 3.1.1 stand-in for benchmarks.
+
+Accepts any client, acknowledges PUBLISH at QoS 0, 1 and 2 and answers
+SUBSCRIBE and PINGREQ, but never forwards messages. It only counts what
+arrives, which is all the benchmarks need to time the publish path.
+"""
+import socket
+import struct
+import logging
+import threading
+import socketserver
+
+logger = logging.getLogger(__name__)
+
+# Control packet types
+CONNECT, PUBLISH, PUBREL, SUBSCRIBE, PINGREQ, DISCONNECT = 1, 3, 6, 8, 12, 14
+
+class FakeBrokerHandler(socketserver.BaseRequestHandler):
+    def read_exactly(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def read_packet(self) -> tuple:
+        """
+        Returns: tuple of (first header byte, packet body)
+        """
+        header = self.read_exactly(1)[0]
+        length, multiplier = 0, 1
+        while True:
+            byte = self.read_exactly(1)[0]
+            length += (byte & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+
+        return header, self.read_exactly(length)
+
+    def handle(self):
+        broker = self.server.broker
+        broker.track(self.request)
+        try:
+            while True:
+                # A paused broker stops reading, its clients back up like on a slow broker
+                broker.flowing.wait()
+                header, body = self.read_packet()
+                packet_type = header >> 4
+                if packet_type == CONNECT:
+                    self.request.sendall(b'\x20\x02\x00\x00')
+                elif packet_type == PUBLISH:
+                    qos = (header >> 1) & 3
+                    topic_len = struct.unpack_from('>H', body)[0]
+                    broker.count(body[2:2 + topic_len].decode('utf-8'),
+                                 len(body) - 2 - topic_len - (2 if qos else 0))
+                    packet_id = body[2 + topic_len:4 + topic_len]
+                    if qos == 1:
+                        self.request.sendall(b'\x40\x02' + packet_id)
+                    elif qos == 2:
+                        self.request.sendall(b'\x50\x02' + packet_id)
+                elif packet_type == PUBREL:
+                    self.request.sendall(b'\x70\x02' + body[:2])
+                elif packet_type == SUBSCRIBE:
+                    # Grant QoS 0 to every requested filter
+                    filters, offset = 0, 2
+                    while offset < len(body):
+                        offset += 2 + struct.unpack_from('>H', body, offset)[0] + 1
+                        filters += 1
+                    self.request.sendall(bytes((0x90, 2 + filters)) + body[:2] + b'\x00' * filters)
+                elif packet_type == PINGREQ:
+                    self.request.sendall(b'\xd0\x00')
+                elif packet_type == DISCONNECT:
+                    return
+        except (EOFError, ConnectionError, OSError):
+            pass
+        finally:
+            broker.untrack(self.request)
+
+class FakeBrokerServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+class FakeBroker():
+    """
+    Listens on 127.0.0.1 and a free port. Use as a context manager, or
+    call start() and stop(). wait_for() blocks until a number of
+    messages has arrived, pause() stops reading from the clients until
+    resume().
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        self.messages = 0
+        self.payload_bytes = 0
+        # {topic: messages received}
+        self.topics = {}
+        self._received = threading.Condition()
+        self._server = None
+        # Open client connections, dropped on stop() like a broker restart would
+        self._connections = set()
+        self.flowing = threading.Event()
+        self.flowing.set()
+
+    def track(self, connection: socket.socket) -> None:
+        with self._received:
+            self._connections.add(connection)
+
+    def untrack(self, connection: socket.socket) -> None:
+        with self._received:
+            self._connections.discard(connection)
+
+    def count(self, topic: str, payload_size: int) -> None:
+        with self._received:
+            self.messages += 1
+            self.payload_bytes += payload_size
+            self.topics[topic] = self.topics.get(topic, 0) + 1
+            self._received.notify_all()
+
+    def wait_for(self, messages: int, timeout: float = None) -> bool:
+        """
+        Returns: bool, False if fewer messages arrived before the timeout
+        """
+        with self._received:
+            return self._received.wait_for(lambda: self.messages >= messages, timeout)
+
+    def pause(self) -> None:
+        self.flowing.clear()
+
+    def resume(self) -> None:
+        self.flowing.set()
+
+    def start(self) -> 'FakeBroker':
+        self._server = FakeBrokerServer((self.host, self.port), FakeBrokerHandler)
+        self._server.broker = self
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='fake_broker', daemon=True)
+        thread.start()
+        logger.info(f'Fake MQTT broker on {self.host}:{self.port}')
+
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        with self._received:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __enter__(self) -> 'FakeBroker':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -0,0 +1,177 @@
+"""
+In-process stand-in for the InfluxDB v2 write API.
+
+Takes POSTs to /api/v2/write, gunzips them when they say so and keeps
+every request with its query, headers and line protocol points parsed
+back into measurement, tags, fields and timestamp. Responses can be
+scripted, e.g. a 503 with Retry-After followed by a 204, to exercise
+the sink's retries.
+"""
+import gzip
+import logging
+import threading
+from time import monotonic
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+WRITE_PATH = '/api/v2/write'
+
+def split_escaped(text: str, separator: str, limit: int = -1, quotes: bool = False) -> list:
+    """
+    Splits on separator where it isn't escaped with a backslash, or with
+    quotes, inside a double quoted string field. Escapes are kept.
+
+    Returns: list of str
+    """
+    parts, current, quoted, i = [], '', False, 0
+    while i < len(text):
+        char = text[i]
+        if char == '\\' and i + 1 < len(text):
+            current += text[i:i + 2]
+            i += 2
+            continue
+        if char == '"' and quotes:
+            quoted = not quoted
+        if char == separator and not quoted and limit != 0:
+            parts.append(current)
+            current = ''
+            limit -= 1
+        else:
+            current += char
+        i += 1
+    parts.append(current)
+
+    return parts
+
+def unescape(text: str) -> str:
+    out, i = '', 0
+    while i < len(text):
+        if text[i] == '\\' and i + 1 < len(text):
+            out += text[i + 1]
+            i += 2
+        else:
+            out += text[i]
+            i += 1
+    return out
+
+def parse_field(value: str):
+    if value.startswith('"') and value.endswith('"'):
+        return unescape(value[1:-1])
+    return float(value)
+
+def parse_line(line: str) -> tuple:
+    """
+    Parses one line protocol point.
+
+    Returns: tuple of measurement, {tag: value}, {field: value}, timestamp
+    """
+    series, rest = split_escaped(line, ' ', 1)
+    field_set, timestamp = rest.rsplit(' ', 1)
+    measurement, *tag_pairs = split_escaped(series, ',')
+    tags = dict(tuple(unescape(part) for part in split_escaped(pair, '=', 1)) for pair in tag_pairs)
+    fields = {}
+    for pair in split_escaped(field_set, ',', quotes=True):
+        key, value = split_escaped(pair, '=', 1)
+        fields[unescape(key)] = parse_field(value)
+
+    return unescape(measurement), tags, fields, int(timestamp)
+
+class FakeInfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        influx = self.server.influx
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        gzipped = self.headers.get('Content-Encoding') == 'gzip'
+        if gzipped:
+            body = gzip.decompress(body)
+        status, headers = influx.next_response() if url.path == WRITE_PATH else (404, {})
+        influx.record({
+            'path': url.path,
+            'query': {k: v[0] for k, v in parse_qs(url.query).items()},
+            'authorization': self.headers.get('Authorization'),
+            'gzip': gzipped,
+            'status': status,
+            'time': monotonic(),
+            'points': [parse_line(line) for line in body.decode('utf-8').splitlines() if line],
+            })
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeInflux():
+    """
+    Listens on 127.0.0.1 and a free port, answering 204 unless
+    fail_next() queued something else. Use as a context manager, or
+    call start() and stop().
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.host = host
+        self.port = port
+        # Every write request, see FakeInfluxHandler
+        self.requests = []
+        self._responses = []
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    def fail_next(self, status: int, retry_after: int = None, count: int = 1) -> None:
+        """
+        Answers the next count writes with status, and a Retry-After
+        header when given.
+
+        Returns: None
+        """
+        headers = {'Retry-After': str(retry_after)} if retry_after is not None else {}
+        with self._lock:
+            self._responses.extend([(status, headers)] * count)
+
+    def next_response(self) -> tuple:
+        with self._lock:
+            return self._responses.pop(0) if self._responses else (204, {})
+
+    def record(self, request: dict) -> None:
+        with self._lock:
+            self.requests.append(request)
+
+    def points(self) -> list:
+        """
+        Returns: list of the points of every accepted write
+        """
+        with self._lock:
+            return [point for request in self.requests if request['status'] < 300
+                    for point in request['points']]
+
+    def start(self) -> 'FakeInflux':
+        self._server = ThreadingHTTPServer((self.host, self.port), FakeInfluxHandler)
+        self._server.daemon_threads = True
+        self._server.influx = self
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever, name='fake_influx', daemon=True)
+        thread.start()
+        logger.info(f'Fake InfluxDB on {self.url}')
+
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> 'FakeInflux':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
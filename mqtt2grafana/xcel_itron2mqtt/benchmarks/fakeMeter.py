@@ -0,0 +1,340 @@
+"""
+In-process stand-in for the meter's 2030.5 HTTPS server.
+
+Serves the recorded fixtures of one firmware profile by URL path over
+TLS, with a configurable response latency and error rate, so the poller
+can be benchmarked end to end without a meter on the network. With
+push enabled it also takes 2030.5 subscriptions and posts notifications
+to the subscriber when told to, and with history it serves the
+ReadingSet and Reading lists behind the summation readings, with s/l
+paging.
+"""
+import re
+import ssl
+import random
+import hashlib
+import logging
+import http.client
+import tempfile
+import threading
+import subprocess
+import xml.etree.ElementTree as ET
+from time import sleep
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+FIXTURES_DIR = Path(__file__).resolve().parent / 'fixtures'
+# How a failing request fails, the meter does both under load
+ERROR_KINDS = ('status', 'reset')
+IEEE_NS = 'urn:ieee:std:2030.5:ns'
+SUBSCRIPTION_LIST = '/sdev/sub'
+# Readings per ReadingSet of the generated history, a day of hourly intervals
+READINGS_PER_SET = 24
+
+def generate_creds(directory: str) -> tuple:
+    """
+    Creates a throwaway self-signed EC cert and key with the openssl CLI,
+    used both by the fake meter and as the client's credentials.
+
+    Returns: tuple of paths for cert and key files
+    """
+    cert = Path(directory) / 'cert.pem'
+    key = Path(directory) / 'key.pem'
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec',
+                    '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                    '-keyout', str(key), '-out', str(cert), '-days', '1',
+                    '-subj', '/CN=fake-meter'],
+                   check=True, capture_output=True)
+
+    return str(cert), str(key)
+
+def cert_lfdi(cert: str) -> str:
+    """
+    Returns: str, the lFDI of the PEM cert file, as the meter would report it
+    """
+    der = ssl.PEM_cert_to_DER_cert(Path(cert).read_text())
+    return hashlib.sha256(der).hexdigest()[:40].upper()
+
+class FakeMeterHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the meter, so connection reuse shows up in the numbers
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, don't let Nagle hold the body back
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        meter = self.server.meter
+        meter.count_request()
+        delay = meter.latency + random.uniform(0, meter.jitter)
+        if delay > 0:
+            sleep(delay)
+        if meter.error_rate and random.random() < meter.error_rate:
+            meter.count_error()
+            if random.choice(meter.error_kinds) == 'reset':
+                self.close_connection = True
+                self.connection.close()
+                return
+            self.send_error(500)
+            return
+        path, _, query = self.path.partition('?')
+        body = meter.list_page(path, parse_qs(query))
+        if body is None:
+            body = meter.responses.get(path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/sep+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply(self, status: int, headers: dict = None) -> None:
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        meter = self.server.meter
+        meter.count_request()
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path != SUBSCRIPTION_LIST or not meter.push:
+            # What a meter without subscription support answers
+            self.reply(405)
+            return
+        location = meter.add_subscription(body)
+        if location is None:
+            self.send_error(400)
+            return
+        self.reply(201, {'Location': location})
+
+    def do_DELETE(self):
+        meter = self.server.meter
+        meter.count_request()
+        self.reply(204 if meter.remove_subscription(self.path) else 404)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeMeter():
+    """
+    Fake meter for one firmware profile, serving on 127.0.0.1 and a free
+    port. Use as a context manager, or call start() and stop().
+
+    latency is the fixed delay of every response in seconds, jitter an
+    extra random delay of up to that many seconds, and error_rate the
+    share of requests answered with a 500 or a dropped connection.
+    push makes /sdev link a subscription list that takes subscriptions,
+    without it subscribing is refused with a 405. history is the number
+    of intervals (interval seconds each) the summation readings have
+    behind their current one, in ReadingSets of READINGS_PER_SET.
+    """
+    def __init__(self, profile: str = 'default', latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, error_kinds: tuple = ERROR_KINDS,
+                 host: str = '127.0.0.1', port: int = 0, push: bool = False,
+                 history: int = 0, interval: int = 3600):
+        self.profile = profile
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_kinds = tuple(error_kinds)
+        self.host = host
+        self.port = port
+        # {url path: response body}, fixtures are named after their path
+        self.responses = {'/' + path.stem.replace('_', '/'): path.read_bytes()
+                          for path in (FIXTURES_DIR / profile).glob('*.xml')}
+        self.push = push
+        if push:
+            self.responses['/sdev'] = (
+                f'<SelfDevice xmlns="{IEEE_NS}" href="/sdev">'
+                f'<SubscriptionListLink href="{SUBSCRIPTION_LIST}"/></SelfDevice>').encode()
+        # {list path: (list element tag, [item xml, newest first])}
+        self.lists = {}
+        if history:
+            self.build_history(history, interval)
+        # {subscription location: (subscribed resource path, notificationURI)}
+        self.subscriptions = {}
+        self._next_subscription = 0
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._tmp = None
+        self._server = None
+        self.creds = None
+
+    def count_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def count_error(self) -> None:
+        with self._lock:
+            self.errors += 1
+
+    def build_history(self, history: int, interval: int) -> None:
+        """
+        Generates the ReadingSet and Reading lists behind every recorded
+        ReadingSet reading, ending at the recorded one.
+
+        Returns: None
+        """
+        for path, body in list(self.responses.items()):
+            parts = path.split('/rs/')
+            if len(parts) != 2:
+                continue
+            resource = parts[0]
+            current = ET.fromstring(body)
+            end = int(current.findtext(f'{{{IEEE_NS}}}timePeriod/{{{IEEE_NS}}}start'))
+            value = int(current.findtext(f'{{{IEEE_NS}}}value'))
+            sets = []
+            for set_id, first in enumerate(range(0, history + 1, READINGS_PER_SET), start=1):
+                set_path = f'{resource}/rs/{set_id}'
+                offsets = range(first, min(first + READINGS_PER_SET, history + 1))
+                readings = [
+                    f'<Reading href="{set_path}/r/{k - first + 1}"><timePeriod>'
+                    f'<duration>{interval}</duration><start>{end - k * interval}</start>'
+                    f'</timePeriod><value>{value - k * 10}</value></Reading>'
+                    for k in offsets]
+                self.lists[f'{set_path}/r'] = ('ReadingList', readings)
+                set_start = end - offsets[-1] * interval
+                sets.append(f'<ReadingSet href="{set_path}"><timePeriod>'
+                            f'<duration>{(len(offsets)) * interval}</duration>'
+                            f'<start>{set_start}</start></timePeriod>'
+                            f'<ReadingListLink all="{len(readings)}" href="{set_path}/r"/>'
+                            f'</ReadingSet>')
+            self.lists[f'{resource}/rs'] = ('ReadingSetList', sets)
+
+    def list_page(self, path: str, query: dict) -> bytes | None:
+        """
+        Returns: bytes, the page of a list resource selected by the s and l
+        query parameters, None if the path isn't a list
+        """
+        if path not in self.lists:
+            return None
+        tag, items = self.lists[path]
+        start = int(query.get('s', ['0'])[0])
+        limit = int(query.get('l', ['1'])[0])
+        page = items[start:start + limit]
+
+        return (f'<{tag} xmlns="{IEEE_NS}" href="{path}" all="{len(items)}" '
+                f'results="{len(page)}">{"".join(page)}</{tag}>').encode('utf-8')
+
+    def add_subscription(self, body: bytes) -> str | None:
+        """
+        Returns: str, location of the new subscription, None if it's invalid
+        """
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError:
+            return None
+        resource = root.findtext(f'{{{IEEE_NS}}}subscribedResource')
+        notify_uri = root.findtext(f'{{{IEEE_NS}}}notificationURI')
+        if resource not in self.responses or not notify_uri:
+            return None
+        with self._lock:
+            self._next_subscription += 1
+            location = f'{SUBSCRIPTION_LIST}/{self._next_subscription}'
+            self.subscriptions[location] = (resource, notify_uri)
+
+        return location
+
+    def remove_subscription(self, location: str) -> bool:
+        with self._lock:
+            return self.subscriptions.pop(location, None) is not None
+
+    def notification(self, resource: str, location: str, status: int = 0) -> bytes:
+        """
+        Returns: bytes, a Notification carrying the resource's fixture
+        """
+        body = self.responses[resource].decode('utf-8')
+        if body.startswith('<?xml'):
+            body = body.split('?>', 1)[1]
+        # The embedded resource keeps its own element, typed through xsi:type
+        tag = ET.fromstring(body).tag.split('}')[-1]
+        inner = body.split('>', 1)[1].rsplit('</', 1)[0]
+
+        return (f'<Notification xmlns="{IEEE_NS}" '
+                f'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+                f'<subscribedResource>{resource}</subscribedResource>'
+                f'<Resource xsi:type="{tag}" href="{resource}">{inner}</Resource>'
+                f'<status>{status}</status>'
+                f'<subscriptionURI>{location}</subscriptionURI>'
+                f'</Notification>').encode('utf-8')
+
+    def notify(self, resource: str = None, status: int = 0, creds: tuple = None) -> list:
+        """
+        Posts a notification to every subscriber of the resource, or of
+        every resource when it's None. A non zero status tells the
+        subscriber its subscription is cancelled, and drops it. creds
+        posts with another cert and key than the meter's.
+
+        Returns: list of the HTTP status codes the subscribers answered with
+        """
+        with self._lock:
+            targets = [(location, sub) for location, sub in self.subscriptions.items()
+                       if resource is None or sub[0] == resource]
+            if status:
+                for location, _ in targets:
+                    self.subscriptions.pop(location, None)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.load_cert_chain(*(creds or self.creds))
+        answers = []
+        for location, (subscribed, notify_uri) in targets:
+            uri = urlsplit(notify_uri)
+            connection = http.client.HTTPSConnection(uri.hostname, uri.port, context=context,
+                                                     timeout=5.0)
+            try:
+                connection.request('POST', uri.path or '/',
+                                   body=self.notification(subscribed, location, status),
+                                   headers={'Content-Type': 'application/sep+xml'})
+                answers.append(connection.getresponse().status)
+            except OSError as e:
+                logger.warning(f'Notification to {notify_uri} failed: {e}')
+                answers.append(None)
+            finally:
+                connection.close()
+
+        return answers
+
+    def start(self) -> 'FakeMeter':
+        self._tmp = tempfile.TemporaryDirectory(prefix='fake_meter_')
+        self.creds = generate_creds(self._tmp.name)
+        # Report the lFDI of the cert it presents, push mode checks that they match
+        self.responses['/sdev/sdi'] = re.sub(rb'<lFDI>[^<]*</lFDI>',
+                                             f'<lFDI>{cert_lfdi(self.creds[0])}</lFDI>'.encode(),
+                                             self.responses['/sdev/sdi'])
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*self.creds)
+        self._server = ThreadingHTTPServer((self.host, self.port), FakeMeterHandler)
+        self._server.daemon_threads = True
+        # Handshake in the handler thread, not in the accept loop
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True,
+                                                  do_handshake_on_connect=False)
+        self._server.meter = self
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='fake_meter', daemon=True)
+        thread.start()
+        logger.info(f'Fake {self.profile} meter on {self.host}:{self.port}')
+
+        return self
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._tmp is not None:
+            self._tmp.cleanup()
+            self._tmp = None
+
+    def __enter__(self) -> 'FakeMeter':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
@@ -0,0 +1,565 @@
+"""
+Benchmark suite for the poller and the simulator's publish path.
+
+Everything runs in process against a fake HTTPS meter serving the
+recorded fixtures and an embedded MQTT stand-in, so results only depend
+on this machine. Reports, as JSON:
+
+- parse: ops/sec of xcelEndpoint.parse_response and the ExtractionPlan
+  for every endpoint of both firmware profiles
+- cycle: latency percentiles of a full poll cycle (query, parse and
+  publish of every endpoint) in sync and async polling mode
+- publish: messages/sec through xcelEndpoint.mqtt_publish and the
+  simulator's MqttPublisher until the broker has received them all
+- backpressure: mqtt_publish latency and publish queue depth while the
+  broker stops reading, and how long the queue takes to drain after
+- influx: points/sec through InfluxSink into a fake InfluxDB, with
+  checks of batching, gzip, tag/field escaping and the retries on
+  429/503 with Retry-After
+- push: notification to broker latency in 2030.5 push mode, and how
+  many endpoints fall back to polling when the meter refuses subscriptions
+- spool: how fast the disk spool replays what was published while the
+  broker was down
+
+Every section but publish also records {check: passed} under
+checks, as does meta for the files shared with the simulator. A failed
+check makes the run exit 1.
+
+Run from the xcel_itron2mqtt folder:
+    python benchmarks/run_benchmarks.py -o results.json
+    python benchmarks/run_benchmarks.py --compare results.json
+"""
+import os
+import sys
+import json
+import asyncio
+import logging
+import argparse
+import filecmp
+import math
+import platform
+import tempfile
+import urllib3
+import subprocess
+from pathlib import Path
+from time import time, sleep, perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = Path(__file__).resolve().parent
+BASE_DIR = BENCH_DIR.parent
+SIMULATOR_DIR = BASE_DIR.parent.parent / 'simulatedMeter2mqtt'
+# Copied into both images, see scripts/check_shared_files.sh
+SHARED_FILES = ('eventLog.py',)
+sys.path.insert(0, str(BASE_DIR))
+sys.path.insert(0, str(BENCH_DIR))
+
+from xcelMeter import xcelMeter
+from xcelEndpoint import xcelEndpoint
+from xcelExtract import ExtractionPlan
+from xcelPush import PushManager
+from bench_parse import PROFILES, load_cases, bench
+from fakeMeter import FakeMeter, generate_creds
+from fakeBroker import FakeBroker
+from fakeInflux import FakeInflux
+from xcelInflux import InfluxSink
+
+# Outputs that would leave the process, the benchmarks only measure MQTT
+ISOLATED_ENV = ('SPOOL_DIR', 'INFLUX_URL', 'METRICS_PORT', 'MQTT_USER', 'MQTT_PASSWORD',
+                'SUBSCRIPTION_LIST_URL', 'PUBLISH_PIPELINE', 'PUBLISH_QUEUE_SIZE',
+                'PUBLISH_MAX_INFLIGHT', 'PUBLISH_BATCH_SIZE', 'PUBLISH_OVERFLOW')
+
+def percentiles(samples: list) -> dict:
+    """
+    Returns: dict of mean, p50, p90, p99 and max in milliseconds
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    def pick(share: float) -> float:
+        return ordered[min(int(share * len(ordered)), len(ordered) - 1)] * 1000
+
+    return {
+        'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50_ms': round(pick(0.50), 3),
+        'p90_ms': round(pick(0.90), 3),
+        'p99_ms': round(pick(0.99), 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+        }
+
+def bench_parse(rounds: int) -> dict:
+    """
+    Returns: dict, {profile: {endpoint: {implementation: ops/sec}}} and
+    {check: passed}
+    """
+    results = {}
+    checks = {}
+    for profile in PROFILES:
+        results[profile] = {}
+        for name, tags, response in load_cases(profile):
+            plan = ExtractionPlan(tags)
+            # Both have to agree before their timings mean anything
+            checks[f'{profile}_{name}'] = plan.extract(response) == xcelEndpoint.parse_response(response, tags)
+            results[profile][name] = {
+                'parse_response_ops': round(1e6 / bench(lambda: xcelEndpoint.parse_response(response, tags), rounds)),
+                'plan_ops': round(1e6 / bench(lambda: plan.extract(response), rounds)),
+                }
+    results['checks'] = checks
+
+    return results
+
+def received(broker: FakeBroker, prefix: str) -> int:
+    """
+    Returns: int, messages the broker got on topics starting with prefix
+    """
+    return sum(count for topic, count in list(broker.topics.items()) if topic.startswith(prefix))
+
+def run_cycle_sync(meter: xcelMeter) -> None:
+    for obj in meter.endpoints:
+        obj.run()
+    if meter.batcher is not None:
+        meter.batcher.flush()
+
+async def run_cycles_async(meter: xcelMeter, cycles: int) -> list:
+    durations = []
+    with ThreadPoolExecutor(max_workers=max(1, len(meter.endpoints))) as executor:
+        for _ in range(cycles):
+            started = perf_counter()
+            await asyncio.gather(*(meter.poll_endpoint_async(obj, executor) for obj in meter.endpoints))
+            if meter.batcher is not None:
+                meter.batcher.flush()
+            durations.append(perf_counter() - started)
+
+    return durations
+
+def bench_cycle(profile: str, broker: FakeBroker, args) -> dict:
+    """
+    Sets a meter up against a fake meter of the given profile and times
+    whole poll cycles, ignoring the endpoints' intervals.
+
+    Returns: dict, {polling mode: cycle latency percentiles and counters},
+    the transport counters and {check: passed}
+    """
+    results = {}
+    checks = {}
+    with FakeMeter(profile, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                   error_rate=args.error_rate) as fake:
+        meter = xcelMeter(f'Bench {profile}', fake.host, fake.port, fake.creds)
+        meter.setup()
+        try:
+            for mode in ('sync', 'async'):
+                requests_before, errors_before = fake.requests, fake.errors
+                messages_before = broker.messages
+                skips_before = sum(obj.breaker.skipped for obj in meter.endpoints)
+                if mode == 'sync':
+                    durations = []
+                    for _ in range(args.cycles):
+                        started = perf_counter()
+                        run_cycle_sync(meter)
+                        durations.append(perf_counter() - started)
+                else:
+                    durations = asyncio.run(run_cycles_async(meter, args.cycles))
+                result = percentiles(durations)
+                result.update({
+                    'cycles': args.cycles,
+                    'requests': fake.requests - requests_before,
+                    'meter_errors': fake.errors - errors_before,
+                    'breaker_skips': sum(obj.breaker.skipped for obj in meter.endpoints) - skips_before,
+                    'messages': broker.messages - messages_before,
+                    })
+                results[mode] = result
+                checks[f'{mode}_published'] = result['messages'] > 0
+                if not args.error_rate:
+                    checks[f'{mode}_every_endpoint'] = (
+                        result['requests'] == args.cycles * len(meter.endpoints)
+                        and not result['meter_errors'] and not result['breaker_skips'])
+            results['transport'] = meter.transport_stats()
+        finally:
+            meter.mqtt_client.disconnect()
+            meter.mqtt_client.loop_stop()
+    results['checks'] = checks
+
+    return results
+
+def bench_publish(broker: FakeBroker, messages: int) -> dict:
+    """
+    Returns: dict, {publish path: messages/sec}
+    """
+    results = {}
+    # Time the throughput, not the overflow policy
+    os.environ['PUBLISH_OVERFLOW'] = 'block'
+    with FakeMeter('default') as fake:
+        meter = xcelMeter('Bench publish', fake.host, fake.port, fake.creds)
+        meter.setup()
+        obj = meter.endpoints[0]
+        topic = next(iter(obj._sensor_state_topics.values()))
+        target = broker.messages + messages
+        started = perf_counter()
+        for i in range(messages):
+            obj.mqtt_publish(topic, str(i))
+        broker.wait_for(target, timeout=60)
+        results['xcel_mqtt_publish'] = round(messages / (perf_counter() - started))
+        meter.mqtt_client.disconnect()
+        meter.mqtt_client.loop_stop()
+    os.environ.pop('PUBLISH_OVERFLOW', None)
+
+    if (SIMULATOR_DIR / 'mqttPublisher.py').is_file():
+        sys.path.insert(0, str(SIMULATOR_DIR))
+        from mqttPublisher import MqttPublisher
+        for qos in (0, 1):
+            publisher = MqttPublisher(broker.host, broker.port, qos=qos)
+            publisher.connect()
+            target = broker.messages + messages
+            started = perf_counter()
+            publisher.publish_many((f'bench/simulator/{i % 16}', str(i)) for i in range(messages))
+            broker.wait_for(target, timeout=60)
+            publisher.wait_for_inflight(timeout=60)
+            results[f'simulator_qos{qos}'] = round(messages / (perf_counter() - started))
+            publisher.close()
+
+    return results
+
+def bench_backpressure(broker: FakeBroker, messages: int, policy: str) -> dict:
+    """
+    Publishes 1 kB messages over 64 topics while the broker doesn't read
+    anything, so the socket, the inflight window and then the publish
+    queue fill up, and times the drain once it reads again.
+
+    Returns: dict, mqtt_publish latency percentiles, queue counters and
+    {check: passed}
+    """
+    os.environ['PUBLISH_OVERFLOW'] = policy
+    os.environ['PUBLISH_QUEUE_SIZE'] = '1000'
+    try:
+        with FakeMeter('default') as fake:
+            meter = xcelMeter(f'Bench backpressure {policy}', fake.host, fake.port, fake.creds)
+            meter.setup()
+            obj = meter.endpoints[0]
+            pipeline = meter.mqtt_client
+            pipeline.flush(timeout=10)
+            payload = 'x' * 1024
+            durations = []
+            peak_queue = 0
+            received_before = received(broker, 'bench/backpressure/')
+            broker.pause()
+            try:
+                for i in range(messages):
+                    started = perf_counter()
+                    obj.mqtt_publish(f'bench/backpressure/{i % 64}', payload)
+                    durations.append(perf_counter() - started)
+                    if i % 100 == 0:
+                        peak_queue = max(peak_queue, pipeline.queue_depth())
+            finally:
+                broker.resume()
+            started = perf_counter()
+            drained = pipeline.flush(timeout=60)
+            results = percentiles(durations)
+            results.update({
+                'peak_queue': peak_queue,
+                'dropped': pipeline.dropped,
+                'coalesced': pipeline.coalesced,
+                'refused': pipeline.refused,
+                'drain_seconds': round(perf_counter() - started, 3) if drained else None,
+                })
+            # Every message was either delivered or counted as dropped, coalesced or refused
+            lost = pipeline.dropped + pipeline.coalesced + pipeline.refused
+            broker.wait_for(broker.messages + messages - lost
+                            - (received(broker, 'bench/backpressure/') - received_before), timeout=10)
+            results['checks'] = {
+                'drained': drained,
+                'queue_bounded': peak_queue <= 1000,
+                'accounted': received(broker, 'bench/backpressure/') - received_before + lost == messages,
+                }
+            meter.mqtt_client.disconnect()
+            meter.mqtt_client.loop_stop()
+    finally:
+        os.environ.pop('PUBLISH_OVERFLOW', None)
+        os.environ.pop('PUBLISH_QUEUE_SIZE', None)
+
+    return results
+
+def bench_influx(points: int, batch_size: int = 500) -> dict:
+    """
+    Writes points with spaces, commas, equal signs, quotes and
+    backslashes in their names and values through InfluxSink into a
+    fake InfluxDB and compares what arrives with what was written. Then
+    the fake answers 503 and 429 with Retry-After once each, and 400.
+
+    Returns: dict, points/sec, retry waits and {check: passed}
+    """
+    results = {}
+    checks = {}
+    with FakeInflux() as fake:
+        sink = InfluxSink(fake.url, 'bench-token', 'bench org', 'bench bucket',
+                          batch_size=batch_size, flush_interval=3600)
+        tags = {'lfdi': 'AB CD,1=2', 'endpoint': 'Instantaneous Demand', 'touTier': '1'}
+        expected = []
+        started = perf_counter()
+        for i in range(points):
+            fields = {'value': float(i), 'note k': f'say "hi, there" = \\ {i}'}
+            sink.write_point('Instantaneous Demand', tags, fields, 1700000000 + i)
+            expected.append(('Instantaneous Demand', tags, fields, 1700000000 + i))
+        # Waits for the sink's own thread to send the full batches
+        sink.flush()
+        results['points_per_sec'] = round(points / (perf_counter() - started))
+        requests = list(fake.requests)
+        checks['batches'] = (len(requests) == math.ceil(points / batch_size)
+                             and all(len(r['points']) <= batch_size for r in requests))
+        checks['gzip'] = all(r['gzip'] for r in requests)
+        checks['escaping'] = fake.points() == expected
+        checks['query_and_token'] = all(
+            r['query'] == {'org': 'bench org', 'bucket': 'bench bucket', 'precision': 's'}
+            and r['authorization'] == 'Token bench-token' for r in requests)
+
+        for status in (503, 429):
+            before = len(fake.requests)
+            fake.fail_next(status, retry_after=2)
+            sink.write_point('retry', {}, {'value': 1.0}, 1)
+            sink.flush()
+            attempts = fake.requests[before:]
+            waited = attempts[-1]['time'] - attempts[0]['time']
+            results[f'retry_{status}_wait_s'] = round(waited, 2)
+            # The sink jitters its delay by -20%..+20%
+            checks[f'retry_{status}'] = ([r['status'] for r in attempts] == [status, 204]
+                                         and waited >= 2 * 0.8)
+        before, failed_before = len(fake.requests), sink.failed_writes
+        fake.fail_next(400)
+        sink.write_point('rejected', {}, {'value': 1.0}, 1)
+        sink.flush()
+        checks['no_retry_400'] = (len(fake.requests) - before == 1
+                                  and sink.failed_writes == failed_before + 1)
+    results['checks'] = checks
+
+    return results
+
+def bench_push(broker: FakeBroker, args) -> dict:
+    """
+    Subscribes a meter to a fake meter that takes subscriptions and times
+    each notification until the broker has the reading, then checks the
+    fallback against one that refuses them.
+
+    Returns: dict, latency percentiles, subscription counters and
+    {check: passed}
+    """
+    results = {}
+    checks = {}
+    with FakeMeter('default', push=True) as fake:
+        meter = xcelMeter('Bench push', fake.host, fake.port, fake.creds)
+        meter.setup()
+        push = PushManager(meter, fake.creds, host=fake.host, port=0)
+        try:
+            results['subscribed'] = push.start()
+            resource = push.resource_path(meter.endpoints[0].url)
+            requests_before = fake.requests
+            durations = []
+            delivered = 0
+            for _ in range(args.cycles):
+                target = broker.messages + 1
+                started = perf_counter()
+                fake.notify(resource)
+                delivered += broker.wait_for(target, timeout=10)
+                durations.append(perf_counter() - started)
+            results['notify'] = percentiles(durations)
+            results['notify']['meter_requests'] = fake.requests - requests_before
+            results['polls_skipped'] = sum(not obj.poll_wanted() for obj in meter.endpoints)
+            checks['subscribed_all'] = results['subscribed'] == len(meter.endpoints)
+            checks['notifications_delivered'] = delivered == args.cycles
+            checks['polls_skipped'] = results['polls_skipped'] == len(meter.endpoints)
+            # Anyone else's certificate fails the handshake
+            with tempfile.TemporaryDirectory(prefix='stranger_') as tmp:
+                checks['stranger_refused'] = fake.notify(resource, creds=generate_creds(tmp)) == [None]
+            # A cancelling notification puts the endpoint back on polling
+            fake.notify(resource, status=1)
+            results['polling_after_cancel'] = int(meter.endpoints[0].poll_wanted())
+            checks['polling_after_cancel'] = bool(results['polling_after_cancel'])
+        finally:
+            push.stop()
+            meter.mqtt_client.disconnect()
+            meter.mqtt_client.loop_stop()
+
+    with FakeMeter('default') as fake:
+        meter = xcelMeter('Bench push refused', fake.host, fake.port, fake.creds)
+        meter.setup()
+        push = PushManager(meter, fake.creds, host=fake.host, port=0)
+        os.environ['SUBSCRIPTION_LIST_URL'] = '/sdev/sub'
+        try:
+            results['refused_subscribed'] = push.start()
+            results['refused_polling'] = sum(obj.poll_wanted() for obj in meter.endpoints)
+            checks['fallback_polling'] = (not results['refused_subscribed']
+                                          and results['refused_polling'] == len(meter.endpoints))
+        finally:
+            os.environ.pop('SUBSCRIPTION_LIST_URL', None)
+            push.stop()
+            meter.mqtt_client.disconnect()
+            meter.mqtt_client.loop_stop()
+    results['checks'] = checks
+
+    return results
+
+def bench_spool(messages: int) -> dict:
+    """
+    Starts a meter with SPOOL_DIR set while its broker is down, publishes
+    messages into the spool and times the replay once a broker listens
+    on that port again.
+
+    Returns: dict, spool counters, replay messages/sec and {check: passed}
+    """
+    # A broker that comes back on the same port, like a restarted one would
+    down = FakeBroker().start()
+    down.stop()
+    spool_dir = tempfile.TemporaryDirectory(prefix='xcel_spool_')
+    overrides = {'SPOOL_DIR': spool_dir.name, 'SPOOL_REPLAY_RATE': '1000000',
+                 'MQTT_SERVER': down.host, 'MQTT_PORT': str(down.port)}
+    previous = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        with FakeMeter('default') as fake:
+            meter = xcelMeter('Bench spool', fake.host, fake.port, fake.creds)
+            meter.setup()
+            spooling = meter.mqtt_client.target
+            obj = meter.endpoints[0]
+            for i in range(messages):
+                obj.mqtt_publish(f'bench/spool/{i % 64}', str(i))
+            meter.mqtt_client.flush(timeout=60)
+            results = {'spooled': spooling.spooled}
+            with FakeBroker(port=down.port) as broker:
+                # Time the replay, not paho's reconnect backoff
+                broker.wait_for(1, timeout=60)
+                started = perf_counter()
+                replayed = broker.wait_for(spooling.spooled, timeout=120)
+                results['replay_per_sec'] = round(spooling.spooled / (perf_counter() - started)) \
+                    if replayed else None
+                # A batch counts as replayed once all of it went to paho
+                deadline = perf_counter() + 10
+                while spooling.replayed < spooling.spooled and perf_counter() < deadline:
+                    sleep(0.01)
+                results['replayed'] = spooling.replayed
+                results['checks'] = {
+                    'spooled_all': spooling.spooled >= messages,
+                    'replayed_all': (replayed and spooling.replayed == spooling.spooled
+                                     and received(broker, 'spool/bench/spool/') == messages),
+                    }
+                meter.mqtt_client.disconnect()
+                meter.mqtt_client.loop_stop()
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        spool_dir.cleanup()
+
+    return results
+
+def failed_checks(results: dict, prefix: str = '') -> list:
+    """
+    Returns: list of the dotted names of every check that didn't pass
+    """
+    failed = []
+    for k, v in results.items():
+        if k == 'checks' and isinstance(v, dict):
+            failed.extend(f'{prefix}{name}' for name, passed in v.items() if not passed)
+        elif isinstance(v, dict):
+            failed.extend(failed_checks(v, f'{prefix}{k}.'))
+
+    return failed
+
+def flatten(results: dict, prefix: str = '') -> dict:
+    """
+    Returns: dict, {'dotted.path': number} of every numeric result
+    """
+    flat = {}
+    for k, v in results.items():
+        key = f'{prefix}{k}'
+        if isinstance(v, dict):
+            flat.update(flatten(v, f'{key}.'))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            flat[key] = v
+    return flat
+
+def compare(baseline: dict, current: dict) -> None:
+    """
+    Prints the relative change of every result both runs have
+    """
+    old, new = flatten(baseline), flatten(current)
+    for key in sorted(old.keys() & new.keys()):
+        if key.startswith('meta.') or not old[key]:
+            continue
+        change = (new[key] - old[key]) / old[key] * 100
+        print(f'{key:<70} {old[key]:>12} {new[key]:>12} {change:>+8.1f}%', file=sys.stderr)
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', '--rounds', type=int, default=5000, help='parse calls per timing')
+    parser.add_argument('-c', '--cycles', type=int, default=200, help='poll cycles per mode')
+    parser.add_argument('-m', '--messages', type=int, default=20000, help='messages per publish run')
+    parser.add_argument('--latency', type=float, default=2.0, help='fake meter latency in ms')
+    parser.add_argument('--jitter', type=float, default=1.0, help='extra random latency in ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of failing requests')
+    parser.add_argument('--skip', action='append', default=[], choices=('parse', 'cycle', 'publish', 'backpressure', 'influx', 'push', 'spool'))
+    parser.add_argument('-o', '--output', help='write the JSON results here instead of stdout')
+    parser.add_argument('--compare', help='earlier results to print the change against')
+    args = parser.parse_args()
+
+    # Keeps the per message publish events of eventLog out of the timings
+    logging.basicConfig(format='%(levelname)s: %(message)s', level=logging.ERROR)
+    # The meter's cert is never verified, don't time a warning per request
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    for name in ISOLATED_ENV:
+        os.environ.pop(name, None)
+    # The meter loads its endpoint yaml relative to here
+    os.chdir(BASE_DIR)
+    # Start from an empty discovery state so every run publishes the same configs
+    state_dir = tempfile.TemporaryDirectory(prefix='xcel_bench_')
+    os.environ['DISCOVERY_STATE_DIR'] = state_dir.name
+
+    results = {'meta': {
+        'time': int(time()),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        # The simulator's numbers only compare if it runs the same shared code
+        'checks': {f'{name}_identical': filecmp.cmp(BASE_DIR / name, SIMULATOR_DIR / name, shallow=False)
+                   for name in SHARED_FILES if (SIMULATOR_DIR / name).is_file()},
+        }}
+    if 'parse' not in args.skip:
+        results['parse'] = bench_parse(args.rounds)
+    if 'influx' not in args.skip:
+        results['influx'] = bench_influx(args.messages)
+    with FakeBroker() as broker:
+        os.environ['MQTT_SERVER'] = broker.host
+        os.environ['MQTT_PORT'] = str(broker.port)
+        if 'cycle' not in args.skip:
+            results['cycle'] = {profile: bench_cycle(profile, broker, args) for profile in PROFILES}
+        if 'publish' not in args.skip:
+            results['publish'] = bench_publish(broker, args.messages)
+        if 'backpressure' not in args.skip:
+            results['backpressure'] = {policy: bench_backpressure(broker, args.messages, policy)
+                                       for policy in ('drop_oldest', 'coalesce')}
+        if 'push' not in args.skip:
+            results['push'] = bench_push(broker, args)
+    if 'spool' not in args.skip:
+        results['spool'] = bench_spool(args.messages)
+
+    document = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(document + '\n')
+    else:
+        print(document)
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), results)
+    failed = failed_checks(results)
+    if failed:
+        print(f'Failed checks: {", ".join(failed)}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+import yaml
+
+
+"""
+
+eventLog.py
+
+
+- one logging layer shared by xcel_itron2mqtt and simulatedMeter2mqtt, keep both copies identical
+  (mqtt2grafana/scripts/check_shared_files.sh fails when they differ)
+- driven by the output_level profiles of config.yml
+- log records go through a bounded queue to a background thread, a full queue drops instead of blocking
+- log_event() writes structured events with per event sampling and rate limits
+
+"""
+
+
+# Used when there's no config.yml next to the code
+DEFAULT_CONFIG = {
+    'output_level': 'bare_minimum',
+    'logging': {'level': 'INFO', 'format': 'simple'},
+    'formats': {
+        'bare_minimum': {
+            'show_connection': False,
+            'show_topic': False,
+            'show_message_id': False,
+            'show_docker_info': False,
+            'show_success_only': True,
+            'emoji': False,
+            'minimal_logging': True,
+        }
+    }
+}
+EMOJI = {logging.DEBUG: '🔍', logging.INFO: '✅', logging.WARNING: '⚠️', logging.ERROR: '❌',
+         logging.CRITICAL: '❌'}
+# Events and fields the profile switches hide
+CONNECTION_EVENTS = ('connect', 'disconnect')
+DOCKER_EVENTS = ('environment',)
+TOPIC_FIELDS = ('topic',)
+MESSAGE_ID_FIELDS = ('mid', 'latency_ms')
+EVENT_LOGGER = 'events'
+
+
+def load_config(path=None):
+    """Load config.yml (or LOG_CONFIG), falling back to the defaults"""
+    path = path or os.getenv('LOG_CONFIG', 'config.yml')
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return yaml.safe_load(file) or DEFAULT_CONFIG
+    except FileNotFoundError:
+        return DEFAULT_CONFIG
+
+
+def get_profile(config):
+    """The formats entry picked by output_level"""
+    formats = config.get('formats') or DEFAULT_CONFIG['formats']
+    fallback = formats.get('bare_minimum') or DEFAULT_CONFIG['formats']['bare_minimum']
+    return formats.get(config.get('output_level'), fallback)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread, counting instead of blocking when it falls behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class StructuredFormatter(logging.Formatter):
+    """Writes records as one JSON object per line, or as text with key=value fields"""
+
+    def __init__(self, style='simple', emoji=False):
+        super().__init__()
+        self.style = style
+        self.emoji = emoji
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        event = getattr(record, 'event', None)
+        message = record.getMessage()
+        if self.style == 'json':
+            document = {
+                'time': round(record.created, 3),
+                'level': record.levelname.lower(),
+                'logger': record.name,
+            }
+            if event:
+                document['event'] = event
+            if message:
+                document['msg'] = message
+            document.update(fields)
+            return json.dumps(document, default=str, ensure_ascii=False)
+
+        text = message or event or ''
+        if fields:
+            text = ' '.join([text] + [f'{k}={v}' for k, v in fields.items()]).strip()
+        if self.emoji:
+            text = f'{EMOJI.get(record.levelno, "")} {text}'
+        else:
+            text = f'{record.levelname}: {text}'
+        if self.style == 'detailed':
+            text = f'{self.formatTime(record)} {record.name} {text}'
+        return text
+
+
+class EventLog:
+    """
+    Structured events on top of the logging module. Below WARNING an
+    event can be sampled (only 1 in N is logged, 0 turns it off) and every event is rate
+    limited per second. The next event that gets through reports how many
+    were held back.
+    """
+
+    def __init__(self, profile=None):
+        self.logger = logging.getLogger(EVENT_LOGGER)
+        self._lock = threading.Lock()
+        self.configure(profile or DEFAULT_CONFIG['formats']['bare_minimum'])
+
+    def configure(self, profile):
+        with self._lock:
+            self.profile = profile
+            # {event: log 1 in N}
+            self.sample = dict(profile.get('sample') or {})
+            # Events per second per event name, 0 means no limit
+            self.rate_limit = float(profile.get('rate_limit') or 0)
+            self._counts = {}
+            self._tokens = {}
+            self._suppressed = {}
+            self._hidden = set()
+            if not profile.get('show_connection', True):
+                self._hidden.update(CONNECTION_EVENTS)
+            if not profile.get('show_docker_info', True):
+                self._hidden.update(DOCKER_EVENTS)
+            self._hidden_fields = set()
+            if not profile.get('show_topic', True):
+                self._hidden_fields.update(TOPIC_FIELDS)
+            if not profile.get('show_message_id', True):
+                self._hidden_fields.update(MESSAGE_ID_FIELDS)
+
+    def _admit(self, event, level):
+        """Sampling and rate limiting, returns the held back count or None to drop"""
+        now = time.monotonic()
+        with self._lock:
+            if level < logging.WARNING:
+                if event in self._hidden:
+                    return None
+                every = self.sample.get(event, 1)
+                if every <= 0:
+                    return None
+                count = self._counts.get(event, 0)
+                self._counts[event] = count + 1
+                if every > 1 and count % every:
+                    return None
+            if self.rate_limit:
+                tokens, last = self._tokens.get(event, (self.rate_limit, now))
+                tokens = min(self.rate_limit, tokens + (now - last) * self.rate_limit)
+                if tokens < 1:
+                    self._tokens[event] = (tokens, now)
+                    self._suppressed[event] = self._suppressed.get(event, 0) + 1
+                    return None
+                self._tokens[event] = (tokens - 1, now)
+            return self._suppressed.pop(event, 0)
+
+    def emit(self, event, message='', level=logging.INFO, **fields):
+        """Log one event, returns True if it was written"""
+        if not self.logger.isEnabledFor(level):
+            return False
+        suppressed = self._admit(event, level)
+        if suppressed is None:
+            return False
+        if self._hidden_fields:
+            fields = {k: v for k, v in fields.items() if k not in self._hidden_fields}
+        if suppressed:
+            fields['suppressed'] = suppressed
+        self.logger.log(level, message, extra={'event': event, 'fields': fields})
+        return True
+
+
+events = EventLog()
+_listener = None
+_listener_pid = None
+_handler = None
+
+
+def log_event(event, message='', level=logging.INFO, **fields):
+    """Shortcut for events.emit()"""
+    return events.emit(event, message, level, **fields)
+
+
+def dropped_records():
+    """Records lost because the log queue was full"""
+    return _handler.dropped if _handler is not None else 0
+
+
+def _stop_listener():
+    """Drain the queue before the process exits"""
+    global _listener
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+def setup_logging(config_path=None, level=None):
+    """
+    Routes all logging through a bounded queue to a writer thread and
+    applies the output_level profile of config.yml. LOGLEVEL (or level)
+    overrides logging.level of the config. Call again in a forked child,
+    the writer thread doesn't survive the fork.
+
+    Returns: dict, the active output profile
+    """
+    global _listener, _listener_pid, _handler
+    config = load_config(config_path)
+    profile = get_profile(config)
+    log_config = config.get('logging') or {}
+    level = (level or os.getenv('LOGLEVEL') or log_config.get('level') or 'INFO').upper()
+    style = str(log_config.get('format', 'simple')).lower()
+    emoji = style == 'emoji' or bool(profile.get('emoji'))
+
+    _stop_listener()
+    log_queue = queue.Queue(maxsize=int(log_config.get('queue_size', 10000)))
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(StructuredFormatter(style, emoji))
+    _listener = logging.handlers.QueueListener(log_queue, stream)
+    _listener_pid = os.getpid()
+    _handler = DroppingQueueHandler(log_queue)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_handler)
+    # Minimal output keeps library chatter down to errors, events still get through
+    root.setLevel(logging.ERROR if profile.get('minimal_logging') else level)
+    logging.getLogger(EVENT_LOGGER).setLevel(level)
+    events.configure(profile)
+    _listener.start()
+
+    return profile
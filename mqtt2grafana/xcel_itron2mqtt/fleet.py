@@ -0,0 +1,196 @@
+import os
+import yaml
+import signal
+import asyncio
+import logging
+import multiprocessing as mp
+from time import sleep, monotonic
+from xcelMeter import xcelMeter
+from xcelSpool import wrap_client
+from xcelMetrics import register_client, start_metrics_server
+from main import INTEGRATION_NAME, look_for_creds
+from eventLog import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before retrying a meter whose setup failed
+SETUP_RETRY_DELAY = 60.0
+# Restart backoff for crashed workers, reset once a worker stays up
+RESTART_DELAY_MIN = 1.0
+RESTART_DELAY_MAX = 60.0
+STABLE_RUNTIME = 300.0
+
+def load_fleet(file_path: str) -> dict:
+    """
+    Loads the fleet yaml file. It holds a list of meters under `meters`,
+    each with at least an `ip` and `port`, and optionally the number of
+    worker processes under `workers`.
+
+    Returns: dict
+    """
+    with open(file_path, mode='r', encoding='utf-8') as file:
+        fleet = yaml.safe_load(file)
+
+    meters = fleet.get('meters') or []
+    fleet['meters'] = meters
+    for i, meter in enumerate(meters):
+        if 'ip' not in meter or 'port' not in meter:
+            raise ValueError(f'Meter #{i} in {file_path} needs an ip and a port')
+        meter.setdefault('name', f'{INTEGRATION_NAME} {meter["ip"]}')
+
+    return fleet
+
+def shard_meters(meters: list, workers: int) -> list:
+    """
+    Splits the meters round-robin into one shard per worker, never
+    creating more shards than there are meters.
+
+    Returns: list of lists of meter dicts
+    """
+    workers = max(1, min(workers, len(meters)))
+
+    return [meters[i::workers] for i in range(workers)]
+
+def meter_topic_prefix(meter: dict) -> str:
+    """
+    Topic prefix for a fleet meter. Unless the fleet file sets one, the
+    meter name is appended to MQTT_TOPIC_PREFIX so the sensors of
+    different meters don't publish onto the same topics.
+
+    Returns: str
+    """
+    if meter.get('topic_prefix'):
+        return meter['topic_prefix']
+    base = os.getenv('MQTT_TOPIC_PREFIX', 'homeassistant/')
+
+    return f'{base}{meter["name"].replace(" ", "_").lower()}/'
+
+async def run_meter(meter: xcelMeter) -> None:
+    """
+    Sets up a single meter and then polls it forever. A meter that can't
+    be reached is retried later instead of taking the worker down.
+
+    Returns: None
+    """
+    loop = asyncio.get_running_loop()
+    while not meter.initalized:
+        try:
+            await loop.run_in_executor(None, meter.setup)
+        except Exception as e:
+            logger.error(f'Setup of {meter.name} failed, retrying in {SETUP_RETRY_DELAY}s: {e}')
+            await asyncio.sleep(SETUP_RETRY_DELAY)
+    await meter.run_async()
+
+def run_worker(worker_id: int, meters: list) -> None:
+    """
+    Worker process entry point. Every meter of the shard is polled from
+    one event loop and all of them publish over a single MQTT connection.
+
+    Returns: None
+    """
+    # Don't inherit the supervisor's handlers, terminate() has to stop us
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # The log writer thread doesn't survive the fork
+    setup_logging()
+    mqtt_server_address = os.getenv('MQTT_SERVER')
+    mqtt_client = wrap_client(xcelMeter.setup_mqtt(mqtt_server_address, xcelMeter.get_mqtt_port()),
+                              f'fleet_worker_{worker_id}')
+    register_client(f'fleet_worker_{worker_id}', mqtt_client)
+    # Every worker serves its own metrics, on METRICS_PORT + worker number
+    if os.getenv('METRICS_PORT'):
+        start_metrics_server(int(os.getenv('METRICS_PORT')) + worker_id)
+    pollers = []
+    for meter in meters:
+        if meter.get('cert') and meter.get('key'):
+            creds = (meter['cert'], meter['key'])
+        else:
+            creds = look_for_creds()
+        pollers.append(xcelMeter(meter['name'], meter['ip'], meter['port'], creds,
+                                 mqtt_client=mqtt_client,
+                                 topic_prefix=meter_topic_prefix(meter)))
+    logger.info(f'Worker {worker_id} polling {len(pollers)} meters')
+
+    async def run_all():
+        await asyncio.gather(*(run_meter(meter) for meter in pollers))
+
+    asyncio.run(run_all())
+
+class FleetSupervisor():
+    """
+    Starts one worker process per shard of meters and restarts any
+    worker that dies, backing off if it keeps crashing.
+    """
+    def __init__(self, meters: list, workers: int):
+        self.shards = shard_meters(meters, workers)
+        self._processes = [None] * len(self.shards)
+        self._started_at = [0.0] * len(self.shards)
+        self._restart_delay = [RESTART_DELAY_MIN] * len(self.shards)
+        self._restart_due = [0.0] * len(self.shards)
+        self._running = False
+
+    def start_worker(self, worker_id: int) -> None:
+        process = mp.Process(target=run_worker, args=(worker_id, self.shards[worker_id]),
+                             name=f'xcel_fleet_{worker_id}')
+        process.start()
+        self._processes[worker_id] = process
+        self._started_at[worker_id] = monotonic()
+        logger.info(f'Started worker {worker_id} (pid {process.pid}) '
+                    f'with {len(self.shards[worker_id])} meters')
+
+    def check_workers(self) -> None:
+        """
+        Restarts workers that exited, waiting an exponentially growing
+        delay between restarts of a worker that crashes right away.
+
+        Returns: None
+        """
+        now = monotonic()
+        for worker_id, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                process.join()
+                runtime = now - self._started_at[worker_id]
+                if runtime > STABLE_RUNTIME:
+                    self._restart_delay[worker_id] = RESTART_DELAY_MIN
+                logger.error(f'Worker {worker_id} exited with code {process.exitcode}, '
+                             f'restarting in {self._restart_delay[worker_id]}s')
+                self._restart_due[worker_id] = now + self._restart_delay[worker_id]
+                self._restart_delay[worker_id] = min(self._restart_delay[worker_id] * 2,
+                                                     RESTART_DELAY_MAX)
+                self._processes[worker_id] = None
+            if now >= self._restart_due[worker_id]:
+                self.start_worker(worker_id)
+
+    def stop(self, *args) -> None:
+        self._running = False
+
+    def run(self) -> None:
+        """
+        Supervisor loop, runs until SIGTERM/SIGINT and then takes the
+        workers down with it.
+
+        Returns: None
+        """
+        self._running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while self._running:
+            self.check_workers()
+            sleep(1.0)
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join()
+
+
+if __name__ == '__main__':
+    fleet = load_fleet(os.getenv('FLEET_CONFIG', 'configs/fleet.yaml'))
+    if not fleet['meters']:
+        raise ValueError('No meters listed in the fleet config')
+    workers = int(os.getenv('FLEET_WORKERS', fleet.get('workers') or os.cpu_count()))
+    supervisor = FleetSupervisor(fleet['meters'], workers)
+    supervisor.run()
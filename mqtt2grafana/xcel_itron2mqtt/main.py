@@ -1,29 +1,41 @@
 import os
 import logging
-from time import sleep
+import threading
 from pathlib import Path
 from xcelMeter import xcelMeter
+from xcelCache import MeterCache
+from eventLog import setup_logging, log_event
 from zeroconf import ServiceBrowser, ServiceListener, Zeroconf
 
 INTEGRATION_NAME = "Xcel Itron 5"
+# Meter will respond on _smartenergy._tcp.local. port 5353
+SERVICE_TYPE = "_smartenergy._tcp.local."
 
-LOGLEVEL = os.environ.get('LOGLEVEL', 'INFO').upper()
-logging.basicConfig(format='%(levelname)s: %(message)s', level=LOGLEVEL)
+# Output profile from config.yml, LOGLEVEL still sets the level
+setup_logging()
 
 # mDNS listener to find the IP Address of the meter on the network
 class XcelListener(ServiceListener):
     def __init__(self):
         self.info = None
+        # Set as soon as a service resolved to an address
+        self.found = threading.Event()
 
     def update_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        pass
+        self._resolve(zc, type_, name)
 
     def remove_service(self, zc: Zeroconf, type_: str, name: str) -> None:
         pass
 
     def add_service(self, zc: Zeroconf, type_: str, name: str) -> None:
-        self.info = zc.get_service_info(type_, name)
-        print(f"Service {name} added, service info: {self.info}")
+        self._resolve(zc, type_, name)
+        log_event('discovery', f"Service {name} added", info=self.info)
+
+    def _resolve(self, zc: Zeroconf, type_: str, name: str) -> None:
+        info = zc.get_service_info(type_, name)
+        if info is not None and info.addresses:
+            self.info = info
+            self.found.set()
 
 def look_for_creds() -> tuple:
     """
@@ -51,44 +63,87 @@ def look_for_creds() -> tuple:
     else:
         raise FileNotFoundError('Could not find cert and key credentials')
 
-def mDNS_search_for_meter() -> str | int:
+def mDNS_search_for_meter(timeout: float = None) -> tuple[str, int]:
     """
     Creates a new zeroconf instance to probe the network for the meter
-    to extract its ip address and port. Closes the instance down when complete.
+    to extract its ip address and port. Returns as soon as the service
+    resolves, or raises TimeoutError after MDNS_TIMEOUT seconds. Closes
+    the instance down when complete.
 
-    Returns: string, ip address of the meter
+    Returns: tuple of the ip address and port of the meter
     """
+    if timeout is None:
+        timeout = float(os.getenv('MDNS_TIMEOUT', 30))
     zeroconf = Zeroconf()
     listener = XcelListener()
-    # Meter will respond on _smartenergy._tcp.local. port 5353
-    browser = ServiceBrowser(zeroconf, "_smartenergy._tcp.local.", listener)
-    # Have to wait to hear back from the asynchrounous listener/browser task
-    sleep(10)
     try:
-        addresses = listener.info.addresses
-    except:
-        raise TimeoutError('Waiting too long to get response from meter')
-    print(listener.info)
-    # Auto parses the network byte format into a legible address
-    ip_address = listener.info.parsed_addresses()[0]
-    port = listener.info.port
-    # Close out our mDNS discovery device
-    zeroconf.close()
-  
+        browser = ServiceBrowser(zeroconf, SERVICE_TYPE, listener)
+        # Wait to hear back from the asynchrounous listener/browser task
+        if not listener.found.wait(timeout):
+            raise TimeoutError('Waiting too long to get response from meter')
+        logging.debug(listener.info)
+        # Auto parses the network byte format into a legible address
+        ip_address = listener.info.parsed_addresses()[0]
+        port = listener.info.port
+    finally:
+        # Close out our mDNS discovery device
+        zeroconf.close()
+
     return ip_address, port
 
+def verify_meter_address(meter: xcelMeter) -> None:
+    """
+    Background check of a cached meter address. Moves the meter over if
+    mDNS finds it somewhere else.
+
+    Returns: None
+    """
+    try:
+        ip_address, port = mDNS_search_for_meter()
+    except TimeoutError as e:
+        logging.warning(f'Could not verify the cached meter address: {e}')
+        return
+    if (ip_address, int(port)) != (meter.ip_address, int(meter.port)):
+        logging.warning(f'Meter moved to {ip_address}:{port}')
+        meter.move(ip_address, port)
+
 
 if __name__ == '__main__':
+    if not os.getenv('METER_IP') and os.getenv('DISCOVERY_MODE', 'once').lower() == 'continuous':
+        # Poll every meter that shows up on the network, for as long as it's there
+        from xcelDiscovery import MeterDiscovery
+        MeterDiscovery(INTEGRATION_NAME, look_for_creds()).run()
+        raise SystemExit(0)
+    cache = MeterCache()
+    cached = cache.load() or {}
+    verify_address = False
     if os.getenv('METER_IP') and os.getenv('METER_PORT'):
         ip_address = os.getenv('METER_IP')
         port_num = os.getenv('METER_PORT')
+    elif cached.get('ip') and cached.get('port'):
+        # Start on the last known address, mDNS confirms it in the background
+        ip_address, port_num = cached['ip'], cached['port']
+        verify_address = True
     else:
         ip_address, port_num = mDNS_search_for_meter()
         # ip_address, port_num = "10.28.10.181", 8081
     creds = look_for_creds()
-    meter = xcelMeter(INTEGRATION_NAME, ip_address, port_num, creds)
+    meter = xcelMeter(INTEGRATION_NAME, ip_address, port_num, creds, cache=cache)
+    if verify_address:
+        threading.Thread(target=verify_meter_address, args=(meter,),
+                         name='xcel_mdns_verify', daemon=True).start()
     meter.setup()
 
     if meter.initalized:
+        push = None
+        if os.getenv('PUSH_MODE', 'off').lower() in ('on', 'true', '1'):
+            # Let the meter send changes as they happen, polling covers what it refuses
+            from xcelPush import PushManager
+            push = PushManager(meter, creds)
+            push.start()
         # The run method controls all the looping, querying, and mqtt sending
-        meter.run()
\ No newline at end of file
+        try:
+            meter.run()
+        finally:
+            if push is not None:
+                push.stop()
\ No newline at end of file
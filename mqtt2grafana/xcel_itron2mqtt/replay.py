@@ -0,0 +1,121 @@
+"""
+Replays captured meter responses (CAPTURE=on) through the parse and
+publish pipeline, at the speed they were captured, N times faster or as
+fast as possible. The meter is rebuilt from the capture, so responses of
+a 3.2.39 meter go through the 3.2.39 endpoints. Publishes go to
+MQTT_SERVER with the replay topic prefix in front of both the
+Homeassistant and the batch/derived topics, so nothing lands on the
+live meter's topics. InfluxDB output is off unless REPLAY_INFLUX_BUCKET
+names a bucket to write to instead of the live one. Rollups are left
+out, their windows follow the wall clock and not the replayed time.
+
+    python replay.py state/capture/<lFDI>_<time>.jsonl.gz --speed 10
+    python replay.py state/capture/*.jsonl.gz --speed 0 --loops 5
+"""
+import os
+import sys
+import json
+import argparse
+import xml.etree.ElementTree as ET
+from time import sleep, monotonic
+from urllib.parse import urlsplit
+
+# Replays must not capture themselves or backfill from a meter that isn't there
+os.environ['CAPTURE'] = 'off'
+os.environ['BACKFILL'] = 'off'
+os.environ['ROLLUP_WINDOWS'] = ''
+# Never write replayed points into the live bucket
+if os.getenv('REPLAY_INFLUX_BUCKET'):
+    os.environ['INFLUX_BUCKET'] = os.environ['REPLAY_INFLUX_BUCKET']
+else:
+    os.environ['INFLUX_URL'] = ''
+
+from xcelMeter import xcelMeter
+from xcelCapture import read_capture
+from xcelInflux import shared_sink
+from eventLog import setup_logging
+
+def build_meter(details: dict, topic_prefix: str) -> xcelMeter:
+    """
+    Sets up a meter from the meter record of a capture, without talking to it.
+
+    Returns: xcelMeter
+    """
+    meter = xcelMeter(f'Replay {details["name"]}', '127.0.0.1', 0, (None, None),
+                      topic_prefix=topic_prefix, batch_topic_prefix=topic_prefix)
+    meter.apply_hardware_details(details)
+    meter.initalized = True
+
+    return meter
+
+def replay(path: str, topic_prefix: str, speed: float, loops: int = 1) -> dict:
+    """
+    Feeds every response of a capture file to its endpoint. A speed of 0
+    replays as fast as the pipeline goes.
+
+    Returns: dict of counters and timings
+    """
+    records = read_capture(path)
+    details = next(records, None)
+    if details is None or details.get('type') != 'meter':
+        raise ValueError(f'{path} is not a capture file')
+    responses = list(records)
+    meter = build_meter(details, topic_prefix)
+    endpoints = {urlsplit(obj.url).path: obj for obj in meter.endpoints}
+    stats = {'file': str(path), 'swVer': details.get('swVer'), 'responses': 0,
+             'parse_errors': 0, 'unknown_urls': 0}
+    captured = responses[-1]['mono'] - responses[0]['mono'] if responses else 0.0
+    started = monotonic()
+    for loop in range(loops):
+        loop_started = monotonic()
+        for record in responses:
+            if speed:
+                ahead = loop_started + (record['mono'] - responses[0]['mono']) / speed - monotonic()
+                if ahead > 0:
+                    sleep(ahead)
+            obj = endpoints.get(urlsplit(record['url']).path)
+            if obj is None:
+                stats['unknown_urls'] += 1
+                continue
+            try:
+                reading = obj.process_response(record['body'].encode('utf-8'))
+            except ET.ParseError:
+                stats['parse_errors'] += 1
+                continue
+            obj.publish_reading(reading)
+            if meter.batcher is not None:
+                meter.batcher.flush()
+            stats['responses'] += 1
+    elapsed = monotonic() - started
+    meter.mqtt_client.disconnect()
+    meter.mqtt_client.loop_stop()
+    stats.update({
+        'seconds': round(elapsed, 3),
+        'responses_per_sec': round(stats['responses'] / elapsed) if elapsed else None,
+        'captured_seconds': round(captured * loops, 3),
+        'speedup': round(captured * loops / elapsed, 1) if elapsed else None,
+        })
+
+    return stats
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('captures', nargs='+', help='capture files, replayed one after another')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='1 replays in real time, 10 ten times faster, 0 as fast as possible')
+    parser.add_argument('--loops', type=int, default=1, help='times to replay each file')
+    parser.add_argument('--topic-prefix', default=os.getenv('REPLAY_TOPIC_PREFIX', 'replay/'),
+                        help='MQTT topic prefix of the replayed meters')
+    args = parser.parse_args()
+
+    setup_logging()
+    results = [replay(path, args.topic_prefix, args.speed, args.loops) for path in args.captures]
+    influx = shared_sink()
+    if influx is not None:
+        influx.flush()
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
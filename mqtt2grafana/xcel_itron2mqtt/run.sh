@@ -1,2 +1,6 @@
 #!/bin/sh
-python3 -Wignore main.py
\ No newline at end of file
+if [ -n "$FLEET_CONFIG" ]; then
+    python3 -Wignore fleet.py
+else
+    python3 -Wignore main.py
+fi
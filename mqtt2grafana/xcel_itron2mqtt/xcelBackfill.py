@@ -0,0 +1,247 @@
+import os
+import re
+import json
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from time import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# Local imports
+from xcelBatch import CycleBatcher, TIMESTAMP_READING
+
+logger = logging.getLogger(__name__)
+
+# Prefix that appears on all of the XML elements
+IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
+# e.g. /upt/1/mr/2/rs/1/r/1 -> /upt/1/mr/2, endpoints without a ReadingSet can't be backfilled
+METER_READING_PATH = re.compile(r'^(?P<mr>.*/mr/[^/]+)/rs/')
+# Seconds between writes of the state file, it's only as fresh as this
+SAVE_INTERVAL = 60.0
+
+class ReadingBackfill():
+    """
+    Fills the holes an outage of the poller or the meter connection
+    leaves behind. Works as an endpoint sink that remembers, per meter
+    reading, the timePeriod start of the last reading that was stored
+    and when it was stored, in a small JSON file per meter. When the
+    next reading comes in after more than the gap threshold, the meter's
+    ReadingSet and Reading lists (/upt/1/mr/2/rs, .../rs/1/r) are walked
+    with 2030.5 s/l paging, and every reading in between is written to
+    the other sinks and published as one bulk JSON document per page on
+    <MQTT_BATCH_TOPIC_PREFIX><lFDI>/backfill, all with their original
+    timestamps. Requests to the meter are capped by concurrency.
+    """
+    def __init__(self, meter, state_dir: str = None, page_size: int = None,
+                 concurrency: int = None, max_age: float = None, gap: float = None):
+        self.meter = meter
+        if state_dir is None:
+            state_dir = os.getenv('BACKFILL_STATE_DIR', 'state/backfill')
+        self.state_path = Path(state_dir) / f'{meter._lfdi}.json'
+        if page_size is None:
+            page_size = int(os.getenv('BACKFILL_PAGE_SIZE', 255))
+        self.page_size = page_size
+        if concurrency is None:
+            concurrency = int(os.getenv('BACKFILL_CONCURRENCY', 2))
+        # Oldest reading worth going back for, in seconds
+        if max_age is None:
+            max_age = float(os.getenv('BACKFILL_MAX_AGE', 7 * 86400))
+        self.max_age = max_age
+        # Seconds without a stored reading that count as a gap, None is 3 poll intervals
+        if gap is None and os.getenv('BACKFILL_GAP'):
+            gap = float(os.getenv('BACKFILL_GAP'))
+        self.gap = gap
+        self._executor = ThreadPoolExecutor(max_workers=concurrency,
+                                            thread_name_prefix='xcel_backfill')
+        self._slots = threading.BoundedSemaphore(concurrency)
+        batch_mode = meter.payload_mode if meter.payload_mode != 'per_sensor' else 'json'
+        self.publisher = CycleBatcher(meter.mqtt_client, meter.device_info, batch_mode,
+                                      topic_prefix=meter.batch_topic_prefix, stream='backfill')
+        self._lock = threading.Lock()
+        # {meter reading path: {'start': timePeriod start, 'stored_at': epoch seconds}}
+        self._state = self._load_state()
+        self._saved_at = 0.0
+        # Meter readings with a backfill in progress
+        self._running = set()
+
+    @staticmethod
+    def meter_reading(url: str) -> str | None:
+        """
+        Returns: str, path of the endpoint's MeterReading, None if it
+        doesn't read from a ReadingSet
+        """
+        match = METER_READING_PATH.match(re.sub(r'^https?://[^/]+', '', url))
+
+        return match.group('mr') if match else None
+
+    def _load_state(self) -> dict:
+        try:
+            state = json.loads(self.state_path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring unreadable backfill state {self.state_path}: {e}')
+            return {}
+
+        return state if isinstance(state, dict) else {}
+
+    def save(self) -> None:
+        with self._lock:
+            document = json.dumps(self._state, indent=2, sort_keys=True)
+            self._saved_at = time()
+        try:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.state_path.with_suffix('.json.tmp')
+            tmp.write_text(document, encoding='utf-8')
+            tmp.replace(self.state_path)
+        except OSError as e:
+            # Worst case the next gap isn't noticed
+            logger.warning(f'Could not write backfill state {self.state_path}: {e}')
+
+    def gap_threshold(self, endpoint) -> float:
+        if self.gap is not None:
+            return self.gap
+
+        return 3 * (endpoint.poll_interval or self.meter.POLLING_RATE)
+
+    def write(self, endpoint, reading: dict) -> None:
+        """
+        Sink interface, records the reading and starts a backfill in the
+        background when it comes after a gap.
+
+        Returns: None
+        """
+        resource = self.meter_reading(endpoint.url)
+        try:
+            start = int(reading[TIMESTAMP_READING])
+        except (KeyError, TypeError, ValueError):
+            return
+        if resource is None:
+            return
+        now = time()
+        with self._lock:
+            last = self._state.get(resource)
+            self._state[resource] = {'start': max(start, last['start']) if last else start,
+                                     'stored_at': now}
+            due = now - self._saved_at >= SAVE_INTERVAL
+            missed = (last is not None and start > last['start']
+                      and now - last['stored_at'] > self.gap_threshold(endpoint)
+                      and resource not in self._running)
+            if missed:
+                self._running.add(resource)
+        if missed or due:
+            self.save()
+        if missed:
+            logger.info(f'{endpoint.name} has a gap since {last["start"]}, backfilling')
+            threading.Thread(target=self._run, args=(endpoint, resource, last['start'], start),
+                             name='xcel_backfill', daemon=True).start()
+
+    def _run(self, endpoint, resource: str, since: int, until: int) -> None:
+        try:
+            self.backfill(endpoint, since, until)
+        except Exception as e:
+            logger.error(f'Backfill of {endpoint.name} failed: {e}')
+        finally:
+            with self._lock:
+                self._running.discard(resource)
+
+    def fetch(self, path: str, start: int, limit: int) -> ET.Element:
+        """
+        Reads one page of a 2030.5 list resource.
+
+        Returns: ET.Element, the list element
+        """
+        with self._slots:
+            response = self.meter.requests_session.get(f'{self.meter.url}{path}',
+                                                       params={'s': start, 'l': limit},
+                                                       verify=False, timeout=15.0)
+        response.raise_for_status()
+
+        return ET.fromstring(response.content)
+
+    def fetch_all(self, path: str, item: str) -> list:
+        """
+        Reads every page of a list resource, the first one tells how many
+        items there are, the rest are fetched concurrently.
+
+        Returns: list of the item elements
+        """
+        first = self.fetch(path, 0, self.page_size)
+        items = first.findall(f'{IEEE_PREFIX}{item}')
+        total = int(first.get('all', len(items)))
+        offsets = range(len(items), total, self.page_size) if items else ()
+        for page in self._executor.map(lambda s: self.fetch(path, s, self.page_size), offsets):
+            items.extend(page.findall(f'{IEEE_PREFIX}{item}'))
+
+        return items
+
+    @staticmethod
+    def time_period(element: ET.Element) -> tuple:
+        """
+        Returns: tuple of the element's timePeriod start and duration
+        """
+        period = element.find(f'{IEEE_PREFIX}timePeriod')
+        if period is None:
+            return None, 0
+
+        return (int(period.findtext(f'{IEEE_PREFIX}start', 0)),
+                int(period.findtext(f'{IEEE_PREFIX}duration', 0)))
+
+    def missed_readings(self, endpoint, since: int, until: int) -> list:
+        """
+        Collects the readings of the endpoint's MeterReading that started
+        after since and before until, skipping ReadingSets entirely
+        outside of that window.
+
+        Returns: list of reading dicts, oldest first
+        """
+        resource = self.meter_reading(endpoint.url)
+        since = max(since, int(time() - self.max_age))
+        readings = {}
+        for reading_set in self.fetch_all(f'{resource}/rs', 'ReadingSet'):
+            start, duration = self.time_period(reading_set)
+            if start is not None and (start + duration <= since or start >= until):
+                continue
+            link = reading_set.find(f'{IEEE_PREFIX}ReadingListLink')
+            if link is not None:
+                path = link.get('href')
+            else:
+                path = f'{reading_set.get("href")}/r'
+            for element in self.fetch_all(path, 'Reading'):
+                start, _ = self.time_period(element)
+                if start is None or not since < start < until:
+                    continue
+                readings[start] = endpoint.plan.extract(ET.tostring(element))
+
+        return [readings[start] for start in sorted(readings)]
+
+    def backfill(self, endpoint, since: int, until: int) -> int:
+        """
+        Writes and publishes what the endpoint missed between the two
+        timePeriod starts.
+
+        Returns: int, number of readings backfilled
+        """
+        readings = self.missed_readings(endpoint, since, until)
+        # The live cycle batch and sinks that only aggregate the present stay out of it,
+        # sinks that can take the whole window at once get it that way
+        others = [sink for sink in endpoint.sinks if sink is not self and sink is not self.meter.batcher]
+        batch_sinks = [sink for sink in others if hasattr(sink, 'write_batch')]
+        sinks = [sink for sink in others if sink not in batch_sinks
+                 and not getattr(sink, 'live_only', False)]
+        for sink in batch_sinks:
+            sink.write_batch(endpoint, readings)
+        for offset in range(0, len(readings), self.page_size):
+            for reading in readings[offset:offset + self.page_size]:
+                for sink in sinks:
+                    sink.write(endpoint, reading)
+                self.publisher.write(endpoint, reading)
+            self.publisher.flush()
+        logger.info(f'Backfilled {len(readings)} readings of {endpoint.name}')
+
+        return len(readings)
+
+    def close(self) -> None:
+        self.save()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,92 @@
+import os
+import json
+import logging
+import threading
+from time import time
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_MODES = ('per_sensor', 'json', 'msgpack')
+# Readings that describe when the meter took the reading
+TIMESTAMP_READING = 'timePeriodstart'
+
+def to_number(value):
+    """
+    Meter readings arrive as strings, send them as numbers where we can
+
+    Returns: int, float or the value as is
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+class CycleBatcher():
+    """
+    Collects every reading of a meter's poll cycle and publishes them as
+    a single JSON (or msgpack) document on one topic per meter:
+
+        {"lfdi": ..., "name": ..., "model": ..., "sw_version": ..., "time": ...,
+         "readings": [{"lfdi": ..., "endpoint": "Instantaneous_Demand",
+                       "time": 1697558400, "value": 1473}, ...]}
+
+    Each reading carries the meter's timePeriod start as its time when the
+    endpoint reports one, otherwise the time it was polled. Works as an
+    endpoint sink, the meter calls flush() at the end of each cycle.
+    """
+    def __init__(self, mqtt_client, device_info: dict, payload_mode: str = 'json',
+                 topic_prefix: str = None, stream: str = 'readings'):
+        if payload_mode not in PAYLOAD_MODES[1:]:
+            raise ValueError(f'Unknown batched payload mode {payload_mode}')
+        if payload_mode == 'msgpack':
+            try:
+                import msgpack
+            except ImportError as e:
+                raise ImportError('PAYLOAD_MODE=msgpack needs the msgpack package installed') from e
+            self._encode = msgpack.packb
+        else:
+            self._encode = lambda doc: json.dumps(doc, separators=(',', ':'))
+        self.client = mqtt_client
+        device = device_info['device']
+        self.lfdi = device['identifiers'][0]
+        self._header = {
+            'lfdi': self.lfdi,
+            'name': device['name'],
+            'model': device['model'],
+            'sw_version': device['sw_version'],
+            }
+        if topic_prefix is None:
+            topic_prefix = os.getenv('MQTT_BATCH_TOPIC_PREFIX', 'xcel_itron5/')
+        # e.g. xcel_itron5/<lFDI>/readings, subscribe to xcel_itron5/+/readings
+        self.topic = f'{topic_prefix}{self.lfdi}/{stream}'
+        self._lock = threading.Lock()
+        self._readings = []
+
+    def write(self, endpoint, reading: dict) -> None:
+        entry = {'lfdi': self.lfdi, 'endpoint': endpoint.name.replace(' ', '_')}
+        entry.update((k, to_number(v)) for k, v in reading.items())
+        timestamp = entry.get(TIMESTAMP_READING)
+        entry['time'] = timestamp if isinstance(timestamp, int) else int(time())
+        with self._lock:
+            self._readings.append(entry)
+
+    def flush(self) -> int | None:
+        """
+        Publishes everything collected since the last flush as one message.
+
+        Returns: int, the publish result code, None if there was nothing to send
+        """
+        with self._lock:
+            readings, self._readings = self._readings, []
+        if not readings:
+            return None
+        document = dict(self._header)
+        document['time'] = max(entry['time'] for entry in readings)
+        document['readings'] = readings
+        result = self.client.publish(self.topic, self._encode(document))
+
+        return result[0]
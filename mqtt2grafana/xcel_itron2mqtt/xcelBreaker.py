@@ -0,0 +1,103 @@
+import os
+import random
+import logging
+import threading
+from time import monotonic, time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker():
+    """
+    Per-endpoint circuit breaker, replaces blocking retries in the
+    polling loop.
+
+    closed:    every poll goes through, consecutive failures are counted
+    open:      polls are skipped until the backoff delay has passed
+    half_open: a single probe goes through, success closes the breaker,
+               failure opens it again with twice the delay
+    """
+    def __init__(self, name: str, failure_threshold: int = None,
+                 base_delay: float = None, max_delay: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or int(os.getenv('BREAKER_FAILURES', 3))
+        self.base_delay = base_delay or float(os.getenv('BREAKER_BASE_DELAY', 5.0))
+        self.max_delay = max_delay or float(os.getenv('BREAKER_MAX_DELAY', 300.0))
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.delay = self.base_delay
+        self._retry_at = 0.0
+        # Counters for alerting
+        self.skipped = 0
+        self.opened = 0
+        self.last_error = None
+        self.last_change = time()
+
+    def _set_state(self, state: str) -> None:
+        # Caller holds the lock
+        if state == self.state:
+            return
+        logger.warning(f'Circuit breaker for {self.name}: {self.state} -> {state}')
+        self.state = state
+        self.last_change = time()
+        if state == OPEN:
+            self.opened += 1
+
+    def allow(self, now: float = None) -> bool:
+        """
+        Checks whether the endpoint may be polled right now, moving an
+        open breaker to half open once its backoff has expired.
+
+        Returns: bool
+        """
+        if now is None:
+            now = monotonic()
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and now >= self._retry_at:
+                self._set_state(HALF_OPEN)
+                return True
+            # Open and still backing off, or a probe is already out
+            self.skipped += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.delay = self.base_delay
+            self._set_state(CLOSED)
+
+    def record_failure(self, error: Exception = None, now: float = None) -> None:
+        if now is None:
+            now = monotonic()
+        with self._lock:
+            self.failures += 1
+            self.last_error = repr(error) if error is not None else None
+            if self.state == HALF_OPEN:
+                # Probe failed, back off further
+                self.delay = min(self.delay * 2, self.max_delay)
+            elif self.failures < self.failure_threshold:
+                return
+            # Spread the probes of several endpoints/meters apart
+            self._retry_at = now + self.delay * random.uniform(0.8, 1.2)
+            self._set_state(OPEN)
+
+    def snapshot(self) -> dict:
+        """
+        Returns: dict of the breaker state and counters
+        """
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'skipped': self.skipped,
+                'opened': self.opened,
+                'delay': self.delay,
+                'last_error': self.last_error,
+                'last_change': self.last_change,
+                }
@@ -0,0 +1,58 @@
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# What we remember about the meter between restarts
+CACHE_FIELDS = ('ip', 'port', 'lFDI', 'swVer', 'mfID', 'profile')
+
+class MeterCache():
+    """
+    Small JSON file holding the last known address and hardware details
+    of the meter, so a restart can start polling right away instead of
+    waiting on mDNS and /sdev/sdi. Whatever is read from it gets checked
+    against the network in the background.
+    """
+    def __init__(self, path: str = None):
+        if path is None:
+            path = os.getenv('METER_CACHE', 'state/meter_cache.json')
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    def load(self) -> dict | None:
+        """
+        Returns: dict of the cached fields, None if there's no usable cache
+        """
+        try:
+            cached = json.loads(self.path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring unreadable meter cache {self.path}: {e}')
+            return None
+        if not isinstance(cached, dict):
+            return None
+
+        return {k: v for k, v in cached.items() if k in CACHE_FIELDS}
+
+    def save(self, **values) -> None:
+        """
+        Merges the given fields into the cache file. Failing to write it
+        only costs the next restart some time, so errors are logged and
+        swallowed.
+
+        Returns: None
+        """
+        with self._lock:
+            cached = self.load() or {}
+            cached.update((k, v) for k, v in values.items() if k in CACHE_FIELDS)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self.path.with_suffix(f'{self.path.suffix}.tmp')
+                tmp.write_text(json.dumps(cached, indent=2), encoding='utf-8')
+                tmp.replace(self.path)
+            except OSError as e:
+                logger.warning(f'Could not write meter cache {self.path}: {e}')
@@ -0,0 +1,97 @@
+import os
+import gzip
+import json
+import logging
+import threading
+from time import time, monotonic
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Seconds between flushes of the compressed stream, a crash loses at most this much
+FLUSH_INTERVAL = 5.0
+
+class CaptureLog():
+    """
+    Append-only, gzip compressed log of the raw responses of one meter,
+    one JSON record per line. The first record of a file describes the
+    meter (name, lFDI, swVer, mfID) so a replay can rebuild its
+    endpoints, every other one holds a response with its URL, the meter
+    and both the wall clock and monotonic time it arrived. A file that
+    was cut short by a crash is read up to its last complete record.
+    """
+    def __init__(self, path: str, meter_details: dict):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.path, 'at', encoding='utf-8')
+        self._flushed_at = monotonic()
+        self.records = 0
+        self._write(dict(meter_details, type='meter'))
+        self._file.flush()
+        logger.info(f'Capturing meter responses to {self.path}')
+
+    @classmethod
+    def from_env(cls, meter_details: dict) -> 'CaptureLog | None':
+        """
+        A new file under CAPTURE_DIR per meter and start when CAPTURE is on.
+
+        Returns: CaptureLog or None
+        """
+        if os.getenv('CAPTURE', 'off').lower() not in ('on', 'true', '1'):
+            return None
+        directory = Path(os.getenv('CAPTURE_DIR', 'state/capture'))
+        name = f'{meter_details["lFDI"]}_{int(time())}.jsonl.gz'
+
+        return cls(directory / name, meter_details)
+
+    def _write(self, record: dict) -> None:
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def record(self, endpoint, response: bytes, kind: str = 'poll') -> None:
+        """
+        Appends one raw response. Capturing must never stop the poller,
+        so write errors are logged and swallowed.
+
+        Returns: None
+        """
+        entry = {
+            'type': kind,
+            'wall': time(),
+            'mono': monotonic(),
+            'meter': endpoint.meter_name,
+            'url': endpoint.url,
+            'body': response.decode('utf-8', errors='replace'),
+            }
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                self._write(entry)
+                self.records += 1
+                if monotonic() - self._flushed_at >= FLUSH_INTERVAL:
+                    self._file.flush()
+                    self._flushed_at = monotonic()
+            except (OSError, ValueError) as e:
+                logger.warning(f'Could not capture response of {endpoint.name}: {e}')
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+def read_capture(path: str):
+    """
+    Reads a capture file, tolerating a truncated end.
+
+    Returns: generator of the records, the meter record first
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        try:
+            for line in file:
+                if not line.endswith('\n'):
+                    break
+                yield json.loads(line)
+        except EOFError:
+            logger.warning(f'{path} ends early, probably cut short by a crash')
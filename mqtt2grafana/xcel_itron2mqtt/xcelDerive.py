@@ -0,0 +1,339 @@
+import os
+import json
+import logging
+import threading
+from time import time
+import numpy as np
+
+# Local imports
+from xcelBatch import TIMESTAMP_READING
+
+logger = logging.getLogger(__name__)
+
+DURATION_READING = 'timePeriodduration'
+TIER_READING = 'touTier'
+VALUE_READING = 'value'
+# What an endpoint's `derive` key in the endpoints yaml can say, and the series it feeds
+SERIES_NAMES = {'delivered': 'import', 'received': 'export'}
+# A drop from at least this share of the wrap value is the counter wrapping, lower is a reset
+WRAP_MARGIN = 0.9
+# Recent samples of each series the live net flow is lined up from
+NET_SAMPLES = 8
+NO_TIER = -1
+
+def energy_deltas(values: np.ndarray, wrap: float = 0.0) -> np.ndarray:
+    """
+    Energy of each interval between consecutive summations. A summation
+    that goes down either wrapped, when it was close to the wrap value,
+    or was reset and counts from zero again.
+
+    Returns: np.ndarray of Wh, one shorter than values
+    """
+    deltas = np.diff(values)
+    drops = deltas < 0
+    if wrap:
+        wrapped = drops & (values[:-1] >= wrap * WRAP_MARGIN)
+        deltas = np.where(wrapped, deltas + wrap, deltas)
+        drops &= ~wrapped
+
+    return np.where(drops, values[1:], deltas)
+
+def derive(times: np.ndarray, values: np.ndarray, tiers: np.ndarray, wrap: float = 0.0) -> dict:
+    """
+    Derived series of one summation: the energy and average power of
+    every interval between samples, and the tier in effect at its end.
+    Samples are sorted, and of samples at the same time the last wins.
+
+    Returns: dict of np.ndarrays time, energy_wh, power_w and tier, and
+    since, the time the first interval starts
+    """
+    order = np.argsort(times, kind='stable')
+    times, values, tiers = times[order], values[order], tiers[order]
+    keep = np.append(np.diff(times) > 0, True)
+    times, values, tiers = times[keep], values[keep], tiers[keep]
+    energy = energy_deltas(values, wrap)
+    seconds = np.diff(times)
+
+    return {
+        'since': times[0] if len(times) else None,
+        'time': times[1:],
+        'energy_wh': energy,
+        'power_w': energy * 3600.0 / seconds,
+        'tier': tiers[1:],
+        }
+
+def tier_energy(energy: np.ndarray, tiers: np.ndarray) -> dict:
+    """
+    Returns: dict, {touTier: Wh} of the intervals, leaving out those without a tier
+    """
+    known = tiers != NO_TIER
+    found, index = np.unique(tiers[known], return_inverse=True)
+    totals = np.bincount(index, weights=energy[known], minlength=len(found))
+
+    return {int(tier): float(total) for tier, total in zip(found, totals)}
+
+def net_flow(imports: dict, exports: dict) -> dict:
+    """
+    Import minus export power over the time both derived series cover.
+    The reset corrected energy of each is accumulated and interpolated
+    onto the union of their sample times.
+
+    Returns: dict of np.ndarrays time and net_w, positive when drawing from the grid
+    """
+    import_times = np.concatenate(([imports['since']], imports['time']))
+    export_times = np.concatenate(([exports['since']], exports['time']))
+    grid = np.union1d(import_times, export_times)
+    grid = grid[(grid >= max(import_times[0], export_times[0]))
+                & (grid <= min(import_times[-1], export_times[-1]))]
+    if len(grid) < 2:
+        return {'time': grid[:0], 'net_w': np.empty(0)}
+    imported = np.interp(grid, import_times, np.concatenate(([0.0], np.cumsum(imports['energy_wh']))))
+    exported = np.interp(grid, export_times, np.concatenate(([0.0], np.cumsum(exports['energy_wh']))))
+
+    return {'time': grid[1:], 'net_w': np.diff(imported - exported) * 3600.0 / np.diff(grid)}
+
+class SummationBuffer():
+    """
+    Fixed size ring of the most recent samples of one summation, kept
+    in NumPy arrays: time, value and touTier.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.tiers = np.full(capacity, NO_TIER, dtype=np.int16)
+        self.size = 0
+        # Next slot to write
+        self.head = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def last_time(self) -> int | None:
+        return int(self.times[self.head - 1]) if self.size else None
+
+    def append(self, when: int, value: float, tier: int) -> None:
+        self.times[self.head] = when
+        self.values[self.head] = value
+        self.tiers[self.head] = tier
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def arrays(self, last: int = None) -> tuple:
+        """
+        Returns: tuple of time, value and tier arrays, oldest first,
+        optionally only the last n samples
+        """
+        count = self.size if last is None else min(last, self.size)
+        index = (np.arange(self.head - count, self.head)) % self.capacity
+
+        return self.times[index], self.values[index], self.tiers[index]
+
+    def merge(self, times: np.ndarray, values: np.ndarray, tiers: np.ndarray) -> None:
+        """
+        Adds samples from anywhere in time, e.g. a backfill, keeping the
+        newest capacity samples in order.
+
+        Returns: None
+        """
+        old_times, old_values, old_tiers = self.arrays()
+        times = np.concatenate((times, old_times))
+        values = np.concatenate((values, old_values))
+        tiers = np.concatenate((tiers, old_tiers))
+        # Stable sort with the buffer last, on equal times its samples win
+        order = np.argsort(times, kind='stable')
+        times, values, tiers = times[order], values[order], tiers[order]
+        keep = np.append(np.diff(times) > 0, True)
+        times, values, tiers = (times[keep][-self.capacity:], values[keep][-self.capacity:],
+                                tiers[keep][-self.capacity:])
+        self.size = len(times)
+        self.times[:self.size] = times
+        self.values[:self.size] = values
+        self.tiers[:self.size] = tiers
+        self.head = self.size % self.capacity
+
+class DerivationEngine():
+    """
+    Endpoint sink that derives, per meter, what would otherwise be
+    computed in Flux on every dashboard query: import and export power
+    from Current Summation Delivered/Received (the endpoints marked
+    `derive: delivered|received` in the endpoints yaml), net flow, and
+    the energy of every interval per touTier. Counter resets and wraps
+    (DERIVE_COUNTER_WRAP) are taken care of. Each update is published on
+    <MQTT_BATCH_TOPIC_PREFIX><lFDI>/derived and written to the derived
+    measurement when InfluxDB output is on. A backfill hands its
+    readings over with write_batch(), which recomputes the window in one
+    go on the arrays.
+    """
+    # Readings from the past go through write_batch()
+    live_only = True
+
+    def __init__(self, mqtt_client, device_info: dict, capacity: int = None,
+                 wrap: float = None, topic_prefix: str = None, influx=None):
+        self.client = mqtt_client
+        self.lfdi = device_info['device']['identifiers'][0]
+        if capacity is None:
+            capacity = int(os.getenv('DERIVE_CAPACITY', 1440))
+        self.capacity = capacity
+        # Value the summation counters roll over at, 0 treats every drop as a reset
+        if wrap is None:
+            wrap = float(os.getenv('DERIVE_COUNTER_WRAP', 0))
+        self.wrap = wrap
+        if topic_prefix is None:
+            topic_prefix = os.getenv('MQTT_BATCH_TOPIC_PREFIX', 'xcel_itron5/')
+        self.topic = f'{topic_prefix}{self.lfdi}/derived'
+        self.influx = influx
+        self._lock = threading.Lock()
+        # {series: SummationBuffer}
+        self.buffers = {series: SummationBuffer(capacity) for series in SERIES_NAMES.values()}
+        # End of the last net flow interval emitted live
+        self._net_time = None
+
+    @staticmethod
+    def to_sample(reading: dict) -> tuple | None:
+        """
+        Returns: tuple of time, value and tier of a summation reading,
+        None if it has no usable value
+        """
+        try:
+            value = float(reading[VALUE_READING])
+        except (KeyError, TypeError, ValueError):
+            return None
+        try:
+            start = int(reading[TIMESTAMP_READING])
+        except (KeyError, TypeError, ValueError):
+            start = int(time())
+        try:
+            duration = int(reading.get(DURATION_READING) or 0)
+        except (TypeError, ValueError):
+            duration = 0
+        try:
+            tier = int(reading.get(TIER_READING))
+        except (TypeError, ValueError):
+            tier = NO_TIER
+
+        return start + duration if duration > 0 else start, value, tier
+
+    def write(self, endpoint, reading: dict) -> None:
+        """
+        Sink interface, adds the summation and emits the interval since
+        the previous one.
+
+        Returns: None
+        """
+        series = SERIES_NAMES.get(getattr(endpoint, 'derive', None))
+        sample = self.to_sample(reading) if series else None
+        if sample is None:
+            return
+        with self._lock:
+            buffer = self.buffers[series]
+            last_time = buffer.last_time
+            if last_time is not None and sample[0] <= last_time:
+                # The meter hasn't moved on since the last poll
+                return
+            buffer.append(*sample)
+            if len(buffer) < 2:
+                return
+            derived = derive(*buffer.arrays(last=2), wrap=self.wrap)
+            when, power = int(derived['time'][-1]), float(derived['power_w'][-1])
+            net = self.latest_net()
+        document = {'lfdi': self.lfdi, 'time': when, 'series': series,
+                    'energy_wh': float(derived['energy_wh'][-1]), 'power_w': round(power, 3)}
+        tier = int(derived['tier'][-1])
+        if tier != NO_TIER:
+            document['touTier'] = tier
+        if net:
+            document['net_time'], document['net_w'] = net[-1]
+        self.emit(document, net)
+
+    def latest_net(self) -> list:
+        """
+        Net flow intervals that ended since the last call. Runs net_flow()
+        on the recent samples of both series, so import and export power
+        are always taken over the same stretch of time.
+
+        Returns: list of (time, import minus export W), empty until both
+        series overlap
+        """
+        if any(len(buffer) < 2 for buffer in self.buffers.values()):
+            return []
+        net = net_flow(derive(*self.buffers['import'].arrays(last=NET_SAMPLES), wrap=self.wrap),
+                       derive(*self.buffers['export'].arrays(last=NET_SAMPLES), wrap=self.wrap))
+        new = net['time'] > self._net_time if self._net_time is not None else slice(None)
+        intervals = [(int(when), round(float(power), 3))
+                     for when, power in zip(net['time'][new], net['net_w'][new])]
+        if intervals:
+            self._net_time = intervals[-1][0]
+
+        return intervals
+
+    def write_batch(self, endpoint, readings: list) -> int:
+        """
+        Merges a batch of past readings, e.g. a backfill, into the
+        series and recomputes the derived series over the window they
+        cover, publishing them as one document.
+
+        Returns: int, number of derived intervals
+        """
+        series = SERIES_NAMES.get(getattr(endpoint, 'derive', None))
+        samples = [s for s in (self.to_sample(r) for r in readings) if s is not None] if series else []
+        if not samples:
+            return 0
+        times, values, tiers = (np.array(column) for column in zip(*samples))
+        with self._lock:
+            buffer = self.buffers[series]
+            buffer.merge(times.astype(np.int64), values.astype(np.float64), tiers.astype(np.int16))
+            derived = derive(*buffer.arrays(), wrap=self.wrap)
+            other = self.buffers['export' if series == 'import' else 'import']
+            other_derived = derive(*other.arrays(), wrap=self.wrap) if len(other) >= 2 else None
+        window = (derived['time'] > times.min()) & (derived['time'] <= times.max())
+        if not window.any():
+            return 0
+        document = {'lfdi': self.lfdi, 'series': series,
+                    'time': derived['time'][window].tolist(),
+                    'energy_wh': derived['energy_wh'][window].tolist(),
+                    'power_w': np.round(derived['power_w'][window], 3).tolist(),
+                    'touTier_wh': tier_energy(derived['energy_wh'][window], derived['tier'][window])}
+        if other_derived is not None and len(other_derived['time']):
+            net = net_flow(*((derived, other_derived) if series == 'import' else (other_derived, derived)))
+            net_window = (net['time'] > times.min()) & (net['time'] <= times.max())
+            document['net_time'] = net['time'][net_window].tolist()
+            document['net_w'] = np.round(net['net_w'][net_window], 3).tolist()
+        self.emit_batch(document, derived, window)
+
+        return int(window.sum())
+
+    def emit(self, document: dict, net: list = ()) -> None:
+        """
+        Publishes one derived interval and writes it, and the net flow
+        intervals that ended since the last one, to InfluxDB.
+
+        Returns: None
+        """
+        result = self.client.publish(self.topic, json.dumps(document, separators=(',', ':')))
+        if result[0] != 0:
+            logger.warning(f'Derived series of {self.lfdi} not published, rc {result[0]}')
+        if self.influx is None:
+            return
+        tags = {'lfdi': self.lfdi, 'series': document['series'], 'touTier': document.get('touTier')}
+        self.influx.write_point('derived', tags, {'energy_wh': document['energy_wh'],
+                                                  'power_w': document['power_w']}, document['time'])
+        for when, power in net:
+            self.influx.write_point('derived', {'lfdi': self.lfdi, 'series': 'net'},
+                                    {'power_w': power}, when)
+
+    def emit_batch(self, document: dict, derived: dict, window: np.ndarray) -> None:
+        result = self.client.publish(self.topic, json.dumps(document, separators=(',', ':')))
+        if result[0] != 0:
+            logger.warning(f'Recomputed series of {self.lfdi} not published, rc {result[0]}')
+        if self.influx is None:
+            return
+        series = document['series']
+        for when, energy, power, tier in zip(document['time'], document['energy_wh'],
+                                             document['power_w'], derived['tier'][window].tolist()):
+            tags = {'lfdi': self.lfdi, 'series': series, 'touTier': tier if tier != NO_TIER else None}
+            self.influx.write_point('derived', tags, {'energy_wh': energy, 'power_w': power}, when)
+        for when, net in zip(document.get('net_time', ()), document.get('net_w', ())):
+            self.influx.write_point('derived', {'lfdi': self.lfdi, 'series': 'net'},
+                                    {'power_w': net}, when)
@@ -0,0 +1,142 @@
+import os
+import signal
+import logging
+import threading
+from zeroconf import ServiceBrowser, ServiceListener, Zeroconf
+
+# Local imports
+from xcelMeter import xcelMeter
+from xcelSpool import wrap_client
+from xcelMetrics import register_client
+from fleet import meter_topic_prefix
+
+logger = logging.getLogger(__name__)
+
+# Meters announce themselves on _smartenergy._tcp.local.
+SERVICE_TYPE = '_smartenergy._tcp.local.'
+# Seconds to wait before retrying a meter whose setup failed
+SETUP_RETRY_DELAY = 60.0
+
+class MeterDiscovery(ServiceListener):
+    """
+    Long running mDNS discovery of every meter on the HAN. The browser
+    stays open for the life of the process. Each newly announced meter
+    gets its own xcelMeter poller thread, a meter that shows up at a new
+    address is moved there, and a meter whose service goes away has its
+    poller retired. All pollers publish over one MQTT connection, each
+    under its own topic prefix.
+    """
+    def __init__(self, name_prefix: str, creds: tuple, mqtt_client=None):
+        self.name_prefix = name_prefix
+        self.creds = creds
+        if mqtt_client is None:
+            mqtt_client = wrap_client(xcelMeter.setup_mqtt(os.getenv('MQTT_SERVER'),
+                                                           xcelMeter.get_mqtt_port()),
+                                      'discovery')
+            register_client('discovery', mqtt_client)
+        self.mqtt_client = mqtt_client
+        # {mDNS service name: xcelMeter}
+        self.meters = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self.zeroconf = None
+        self.browser = None
+
+    def meter_name(self, service_name: str) -> str:
+        """
+        Names the meter after its mDNS instance, e.g.
+        itron-1234._smartenergy._tcp.local. -> Xcel Itron 5 itron-1234
+
+        Returns: str
+        """
+        instance = service_name[:-len(SERVICE_TYPE)].rstrip('.') \
+            if service_name.endswith(SERVICE_TYPE) else service_name
+
+        return f'{self.name_prefix} {instance}'
+
+    def _resolve(self, zc: Zeroconf, type_: str, name: str) -> tuple | None:
+        """
+        Returns: tuple of the ip address and port, None if it didn't resolve
+        """
+        info = zc.get_service_info(type_, name)
+        if info is None or not info.addresses:
+            logger.warning(f'Could not resolve {name}')
+            return None
+
+        return info.parsed_addresses()[0], info.port
+
+    def add_service(self, zc: Zeroconf, type_: str, name: str) -> None:
+        address = self._resolve(zc, type_, name)
+        if address is None:
+            return
+        with self._lock:
+            if self._stopped.is_set():
+                return
+            meter = self.meters.get(name)
+            if meter is not None:
+                # Announced again, possibly somewhere else
+                if (meter.ip_address, int(meter.port)) != address:
+                    meter.move(*address)
+                return
+            meter_name = self.meter_name(name)
+            meter = xcelMeter(meter_name, *address, self.creds,
+                              mqtt_client=self.mqtt_client,
+                              topic_prefix=meter_topic_prefix({'name': meter_name}))
+            self.meters[name] = meter
+        logger.info(f'Discovered {meter.name} at {address[0]}:{address[1]}')
+        threading.Thread(target=self.run_meter, args=(meter,),
+                         name=f'xcel_{meter_name}', daemon=True).start()
+
+    def update_service(self, zc: Zeroconf, type_: str, name: str) -> None:
+        # Same handling, a new address moves the poller and an unknown meter starts one
+        self.add_service(zc, type_, name)
+
+    def remove_service(self, zc: Zeroconf, type_: str, name: str) -> None:
+        with self._lock:
+            meter = self.meters.pop(name, None)
+        if meter is not None:
+            logger.info(f'{meter.name} went away, retiring its poller')
+            meter.stop()
+
+    @staticmethod
+    def run_meter(meter: xcelMeter) -> None:
+        """
+        Poller thread of one meter. Sets the meter up, retrying later if it
+        can't be reached, then polls it until it's retired.
+
+        Returns: None
+        """
+        while not meter.stopped:
+            try:
+                meter.setup()
+                break
+            except Exception as e:
+                logger.error(f'Setup of {meter.name} failed, retrying in {SETUP_RETRY_DELAY}s: {e}')
+                if meter.wait_stopped(SETUP_RETRY_DELAY):
+                    return
+        if not meter.stopped:
+            meter.run()
+
+    def stop(self, *args) -> None:
+        self._stopped.set()
+
+    def run(self) -> None:
+        """
+        Browses for meters until SIGTERM/SIGINT, then retires every poller.
+
+        Returns: None
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.zeroconf = Zeroconf()
+        self.browser = ServiceBrowser(self.zeroconf, SERVICE_TYPE, self)
+        logger.info(f'Browsing for meters on {SERVICE_TYPE}')
+        try:
+            self._stopped.wait()
+        finally:
+            self.zeroconf.close()
+            with self._lock:
+                meters, self.meters = list(self.meters.values()), {}
+            for meter in meters:
+                meter.stop()
+            self.mqtt_client.disconnect()
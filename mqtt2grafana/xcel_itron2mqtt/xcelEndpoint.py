@@ -6,7 +6,16 @@ import logging
 import paho.mqtt.client as mqtt
 import xml.etree.ElementTree as ET
 from copy import deepcopy
-from tenacity import retry, stop_after_attempt, before_sleep_log, wait_exponential
+from time import monotonic, perf_counter, time
+
+# Local imports
+from xcelExtract import ExtractionPlan
+from xcelPolicy import PublishPolicy
+from xcelBreaker import CircuitBreaker
+from xcelHADiscovery import DiscoveryManager
+from eventLog import log_event
+from xcelMetrics import (REQUEST_LATENCY, PARSE_TIME, REQUEST_FAILURES, PUBLISHES,
+                         PUBLISH_FAILURES, LAST_SUCCESS)
 
 logger = logging.getLogger(__name__)
 
@@ -20,37 +29,68 @@ class xcelEndpoint():
     instances.
     """
     def __init__(self, session: requests.Session, mqtt_client: mqtt.Client, 
-                    url: str, name: str, tags: list, device_info: dict):
+                    url: str, name: str, tags: list, device_info: dict,
+                    topic_prefix: str = None, poll_interval: float = None,
+                    sinks: list = None, publish_states: bool = True,
+                    discovery: DiscoveryManager = None, rollup: str = None,
+                    derive: str = None, capture=None):
         self.requests_session = session
         self.url = url
         self.name = name
         self.tags = tags
+        # Compile the tags spec once so each poll is a single pass over the response
+        self.plan = ExtractionPlan(tags)
         self.client = mqtt_client
         self.device_info = device_info
+        # Label for metrics and logs
+        self.meter_name = device_info['device']['name']
+        # Seconds between polls, None uses the meter's default
+        self.poll_interval = poll_interval
+        # Outputs that receive every reading besides MQTT, e.g. InfluxDB
+        self.sinks = sinks or []
+        # Off when a batching sink publishes the readings instead
+        self.publish_states = publish_states
+        # 'demand' or 'energy' when the rollup sink aggregates this endpoint
+        self.rollup = rollup
+        # 'delivered' or 'received' when the summation feeds the derived power series
+        self.derive = derive
+        # CaptureLog that keeps every raw response for replays, None when capture is off
+        self.capture = capture
+        # Failing endpoints are skipped until a probe succeeds, rather than retried in place
+        self.breaker = CircuitBreaker(name)
+        # In push mode, polling pauses until this monotonic time while notifications arrive
+        self.pushed_until = None
+        # Holds the Homeassistant configs of the meter's sensors, sends the changed ones
+        if discovery is None:
+            discovery = DiscoveryManager(mqtt_client, self.meter_name)
+        self.discovery = discovery
 
-        self._mqtt_topic_prefix = os.getenv('MQTT_TOPIC_PREFIX', 'homeassistant/')
+        if topic_prefix is None:
+            topic_prefix = os.getenv('MQTT_TOPIC_PREFIX', 'homeassistant/')
+        self._mqtt_topic_prefix = topic_prefix
         self._current_response = None
         self._mqtt_topic = None
         # Record all of the sensor state topics in an easy to lookup dict
         self._sensor_state_topics = {}
+        # Report-by-exception rules from the yaml, and what each sensor last sent
+        self._publish_policies = {}
+        self._last_published = {}
 
         # Setup the rest of what we need for this endpoint
         self.mqtt_send_config()
 
-    @retry(stop=stop_after_attempt(15),
-           wait=wait_exponential(multiplier=1, min=1, max=15),
-           before_sleep=before_sleep_log(logger, logging.WARNING),
-           reraise=True)
-    def query_endpoint(self) -> str:
+    def query_endpoint(self) -> bytes:
         """
         Sends a request to the given endpoint associated with the 
         object instance
 
-        Returns: str in XML format of the meter's response
+        Returns: bytes in XML format of the meter's response
         """
         x = self.requests_session.get(self.url, verify=False, timeout=15.0)
-    
-        return x.text
+        if self.capture is not None:
+            self.capture.record(self, x.content)
+
+        return x.content
 
     @staticmethod
     def parse_response(response: str, tags: dict) -> dict:
@@ -58,6 +98,10 @@ class xcelEndpoint():
         Drill down the XML response from the meter and extract the
         readings according to the endpoints.yaml structure.
 
+        Reference implementation only, the endpoints parse with their
+        ExtractionPlan (see xcelExtract). Kept so the benchmarks can
+        check the plan's readings and timings against it.
+
         Returns: dict in the nesting structure of found below each tag
         in the endpoints.yaml
         """
@@ -87,11 +131,51 @@ class xcelEndpoint():
         
         Returns: Dict in the form of {reading: value}
         """
-        response = self.query_endpoint()
-        self.current_response = self.parse_response(response, self.tags)
+        started = perf_counter()
+        try:
+            response = self.query_endpoint()
+            REQUEST_LATENCY.observe(perf_counter() - started, meter=self.meter_name, endpoint=self.name)
+            return self.process_response(response)
+        except Exception:
+            REQUEST_FAILURES.inc(meter=self.meter_name, endpoint=self.name)
+            raise
+
+    def process_response(self, response: bytes) -> dict:
+        """
+        Parses a raw response of this endpoint, whether it was polled,
+        pushed by the meter or replayed from a capture.
+
+        Returns: Dict in the form of {reading: value}
+        """
+        started = perf_counter()
+        self.current_response = self.plan.extract(response)
+        PARSE_TIME.observe(perf_counter() - started, meter=self.meter_name, endpoint=self.name)
+        LAST_SUCCESS.set(time(), meter=self.meter_name, endpoint=self.name)
 
         return self.current_response
 
+    def poll_wanted(self) -> bool:
+        """
+        Returns: bool, False while notifications from the meter keep this
+        endpoint current
+        """
+        return self.pushed_until is None or monotonic() >= self.pushed_until
+
+    def handle_notification(self, notification: bytes, stale_after: float) -> None:
+        """
+        Parses a 2030.5 notification carrying this endpoint's resource and
+        publishes it like a polled reading. Polling stays paused for
+        stale_after seconds.
+
+        Returns: None
+        """
+        if self.capture is not None:
+            self.capture.record(self, notification, kind='notify')
+        self.process_response(notification)
+        self.pushed_until = monotonic() + stale_after
+        self.breaker.record_success()
+        self.publish_reading(self.current_response)
+
     def create_config(self, sensor_name: str,  details: dict) -> tuple[str, dict]:
         """
         Helper to generate the JSON sonfig payload for setting
@@ -103,6 +187,10 @@ class xcelEndpoint():
         payload = deepcopy(details)
         mqtt_friendly_name = self.name.replace(" ", "_")
         entity_type = payload.pop('entity_type')
+        # Our own setting, not something Homeassistant understands
+        policy = PublishPolicy.from_config(payload.pop('publish_policy', None))
+        if policy is not None:
+            self._publish_policies[sensor_name] = policy
         payload["state_topic"] = f'{self._mqtt_topic_prefix}{entity_type}/{mqtt_friendly_name}/{sensor_name}/state'
         payload['name'] = f'{self.name} {sensor_name}'
         # Mouthful
@@ -122,20 +210,19 @@ class xcelEndpoint():
         Homeassistant requires a config payload to be sent to more
         easily setup the sensor/device once it appears over mqtt
         https://www.home-assistant.io/integrations/mqtt/
+
+        The payloads are handed to the discovery manager, the meter has it
+        publish whichever changed once all of its endpoints are built.
         """
-        _tags = deepcopy(self.tags)
-        for k, v in _tags.items():
+        for k, v in self.tags.items():
             if isinstance(v, list):
                 for val_items in v:
-                    name, details = val_items.popitem()
-                    sensor_name = f'{k}{name}'
-                    mqtt_topic, payload = self.create_config(sensor_name, details)
-                    # Send MQTT payload
-                    self.mqtt_publish(mqtt_topic, str(payload))
+                    for name, details in val_items.items():
+                        mqtt_topic, payload = self.create_config(f'{k}{name}', details)
+                        self.discovery.add(mqtt_topic, payload)
             else:
-                name_suffix = f'{k[0].upper()}'
                 mqtt_topic, payload = self.create_config(k, v)
-                self.mqtt_publish(mqtt_topic, str(payload), retain=True)
+                self.discovery.add(mqtt_topic, payload)
 
     def process_send_mqtt(self, reading: dict) -> None:
         """
@@ -145,8 +232,14 @@ class xcelEndpoint():
         Returns: None
         """
         mqtt_topic_message = {}
+        now = monotonic()
         # Cycle through all the readings for the given sensor
         for k, v in reading.items():
+            # Skip readings that haven't moved enough since they were last sent
+            policy = self._publish_policies.get(k)
+            if policy is not None and not policy.should_publish(v, self._last_published.get(k), now):
+                continue
+            self._last_published[k] = (v, now)
             # Figure out which topic this reading needs to be sent to
             topic = self._sensor_state_topics[k]
             if topic not in mqtt_topic_message.keys():
@@ -158,24 +251,39 @@ class xcelEndpoint():
         for topic, payload in mqtt_topic_message.items():
             self.mqtt_publish(topic, payload)
 
+    def publish_reading(self, reading: dict) -> None:
+        """
+        Hands a fresh reading to every sink and publishes it over MQTT
+
+        Returns: None
+        """
+        for sink in self.sinks:
+            sink.write(self, reading)
+        if self.publish_states:
+            self.process_send_mqtt(reading)
+
     def mqtt_publish(self, topic: str, message: str, retain=False) -> int:
         """
         Publish the given message to the topic associated with the class
        
         Returns: integer
         """
-        result = [0]
-        print(f"Sending to MQTT TOPIC:\t{topic}")
-        
-        print(f"Payload (message):\t\t{message}")
-        
-        
         result = self.client.publish(topic, str(message), retain=retain)
-        print('\n')
-        print('PUBLISH NOT SUCCESSFUL: Error in sending MQTT payload')
-        # print(f"\n MQTT Send Result: \t\t{result}")
+        rc = result[0]
+        PUBLISHES.inc(meter=self.meter_name, endpoint=self.name)
+        if rc == mqtt.MQTT_ERR_SUCCESS and not result[1]:
+            # Only queued (or spooled), the publish pipeline logs what the client did with it
+            log_event('publish', 'Queued', meter=self.meter_name, endpoint=self.name,
+                      topic=topic, value=message)
+        elif rc == mqtt.MQTT_ERR_SUCCESS:
+            log_event('publish', 'Published', meter=self.meter_name, endpoint=self.name,
+                      topic=topic, value=message, rc=rc, mid=result[1])
+        else:
+            PUBLISH_FAILURES.inc(meter=self.meter_name, endpoint=self.name)
+            log_event('publish', 'Publish failed', logging.WARNING, meter=self.meter_name,
+                      endpoint=self.name, topic=topic, rc=rc, error=mqtt.error_string(rc))
         # Return status of the published message
-        return result[0]
+        return rc
 
     def run(self) -> None:
         """
@@ -184,5 +292,13 @@ class xcelEndpoint():
 
         Returns: None
         """
-        reading = self.get_reading()
-        self.process_send_mqtt(reading)
+        if not self.poll_wanted() or not self.breaker.allow():
+            return
+        try:
+            reading = self.get_reading()
+        except Exception as e:
+            self.breaker.record_failure(e)
+            logger.warning(f'Failed to query {self.name}: {e}')
+            return
+        self.breaker.record_success()
+        self.publish_reading(reading)
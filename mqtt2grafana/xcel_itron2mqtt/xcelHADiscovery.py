@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# {id of a paho client: (client, [callbacks run when it reconnects])}
+_reconnect_callbacks = {}
+_reconnect_lock = threading.Lock()
+
+def on_reconnect(mqtt_client, callback) -> None:
+    """
+    Runs callback() whenever the client gets its broker connection back,
+    not on its first connect. Hooks the paho client's on_connect once
+    per client, however many meters share it, keeping any on_connect
+    that was there before.
+
+    Returns: None
+    """
+    # A SpoolingClient wraps the paho client, the callbacks live on the real one
+    client = getattr(mqtt_client, 'client', mqtt_client)
+    with _reconnect_lock:
+        entry = _reconnect_callbacks.get(id(client))
+        if entry is not None:
+            entry[1].append(callback)
+            return
+        callbacks = [callback]
+        _reconnect_callbacks[id(client)] = (client, callbacks)
+        previous = client.on_connect
+        # Connected before we got here means the next connect is a reconnect
+        state = {'connected_before': client.is_connected()}
+
+        def handle_connect(paho_client, userdata, flags, rc):
+            if previous:
+                previous(paho_client, userdata, flags, rc)
+            if rc != 0:
+                return
+            if not state['connected_before']:
+                state['connected_before'] = True
+                return
+            for reconnected in list(callbacks):
+                try:
+                    reconnected()
+                except Exception as e:
+                    logger.error(f'Resending after reconnect failed: {e}')
+
+        client.on_connect = handle_connect
+
+def remove_reconnect(mqtt_client, callback) -> None:
+    client = getattr(mqtt_client, 'client', mqtt_client)
+    with _reconnect_lock:
+        entry = _reconnect_callbacks.get(id(client))
+        if entry is not None and callback in entry[1]:
+            entry[1].remove(callback)
+
+class DiscoveryManager():
+    """
+    Keeps the Home Assistant MQTT discovery payloads of one meter. Every
+    config is registered once with add(), then publish_pending() sends
+    (retained) only those whose hash differs from what was sent on an
+    earlier run, as remembered in a small JSON file per meter. After a
+    broker reconnect everything is sent again, in case the broker lost
+    its retained messages.
+    """
+    def __init__(self, mqtt_client, name: str, store_dir: str = None):
+        self.client = mqtt_client
+        if store_dir is None:
+            store_dir = os.getenv('DISCOVERY_STATE_DIR', 'state/discovery')
+        self.store_path = Path(store_dir) / f'{name.replace(" ", "_").lower()}.json'
+        self._lock = threading.Lock()
+        # {topic: payload} of everything this meter announces
+        self._configs = {}
+        # {topic: sha256 of the payload last published}
+        self._published = self._load_store()
+        on_reconnect(mqtt_client, self.resend_all)
+
+    @staticmethod
+    def payload_hash(payload: str) -> str:
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _load_store(self) -> dict:
+        try:
+            published = json.loads(self.store_path.read_text(encoding='utf-8'))
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring unreadable discovery state {self.store_path}: {e}')
+            return {}
+
+        return published if isinstance(published, dict) else {}
+
+    def _save_store(self) -> None:
+        try:
+            self.store_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.store_path.with_suffix('.json.tmp')
+            tmp.write_text(json.dumps(self._published, indent=2, sort_keys=True), encoding='utf-8')
+            tmp.replace(self.store_path)
+        except OSError as e:
+            # Costs a resend of the configs on the next start, nothing more
+            logger.warning(f'Could not write discovery state {self.store_path}: {e}')
+
+    def add(self, topic: str, payload: str) -> None:
+        """
+        Registers the config payload for a topic, replacing any earlier one.
+
+        Returns: None
+        """
+        with self._lock:
+            self._configs[topic] = payload
+
+    def _publish(self, topics: list) -> int:
+        """
+        Publishes the configs of the given topics retained, recording the
+        hash of each one the client accepted.
+
+        Returns: int, number of configs published
+        """
+        sent = 0
+        for topic in topics:
+            payload = self._configs[topic]
+            result = self.client.publish(topic, payload, retain=True)
+            if result[0] == 0:
+                self._published[topic] = self.payload_hash(payload)
+                sent += 1
+            else:
+                logger.warning(f'Discovery config for {topic} not sent, rc {result[0]}')
+        if sent:
+            self._save_store()
+
+        return sent
+
+    def publish_pending(self) -> int:
+        """
+        Sends the configs that are new or changed since they were last sent.
+
+        Returns: int, number of configs published
+        """
+        with self._lock:
+            changed = [topic for topic, payload in self._configs.items()
+                       if self._published.get(topic) != self.payload_hash(payload)]
+            sent = self._publish(changed)
+        logger.info(f'Discovery configs: {sent} sent, {len(self._configs) - len(changed)} unchanged')
+
+        return sent
+
+    def close(self) -> None:
+        """
+        Stops resending on reconnect, for meters that were retired
+
+        Returns: None
+        """
+        remove_reconnect(self.client, self.resend_all)
+
+    def resend_all(self) -> int:
+        """
+        Sends every config again, used after a reconnect.
+
+        Returns: int, number of configs published
+        """
+        with self._lock:
+            sent = self._publish(list(self._configs))
+        logger.info(f'Resent {sent} discovery configs after reconnecting')
+
+        return sent
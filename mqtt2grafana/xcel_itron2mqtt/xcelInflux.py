@@ -0,0 +1,233 @@
+import os
+import gzip
+import random
+import logging
+import requests
+import threading
+from time import time, sleep, monotonic
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Readings that are tags rather than fields of a point
+TAG_READINGS = ('touTier',)
+# Meter supplied interval of summation readings
+TIMESTAMP_READING = 'timePeriodstart'
+DURATION_READING = 'timePeriodduration'
+
+def escape_key(value: str) -> str:
+    """
+    Escapes measurement names, tag keys/values and field keys for line protocol
+
+    Returns: str
+    """
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def format_field(value) -> str | None:
+    """
+    Numbers become float fields, anything else a string field.
+
+    Returns: str, or None for empty readings
+    """
+    if value is None:
+        return None
+    try:
+        return repr(float(value))
+    except (TypeError, ValueError):
+        escaped = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        return f'"{escaped}"'
+
+def to_line(measurement: str, tags: dict, fields: dict, timestamp: int) -> str | None:
+    """
+    Builds a single line protocol point with a timestamp in seconds.
+
+    Returns: str, or None when no field has a value
+    """
+    field_set = ','.join(f'{escape_key(k)}={v}' for k, v in
+                         ((k, format_field(v)) for k, v in fields.items()) if v is not None)
+    if not field_set:
+        return None
+    tag_set = ''.join(f',{escape_key(k)}={escape_key(v)}' for k, v in sorted(tags.items())
+                      if v not in (None, ''))
+
+    return f'{escape_key(measurement)}{tag_set} {field_set} {timestamp}'
+
+class InfluxSink():
+    """
+    Writes readings straight to the InfluxDB v2 write API as line
+    protocol, skipping the MQTT -> Telegraf hop. Points are batched by
+    size and time and sent gzipped from a background thread. Failed
+    writes are retried with exponential backoff. Points are tagged with
+    the meter's lFDI, the endpoint and touTier, and are stamped with the
+    end of the meter's timePeriod when it has a duration, the time they
+    were received otherwise.
+    """
+    def __init__(self, url: str, token: str, org: str, bucket: str,
+                 batch_size: int = 5000, flush_interval: float = 10.0,
+                 max_buffer: int = 100000, max_retries: int = 8):
+        self.write_url = f'{url.rstrip("/")}/api/v2/write'
+        self.params = {'org': org, 'bucket': bucket, 'precision': 's'}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Token {token}',
+            'Content-Type': 'text/plain; charset=utf-8',
+            'Content-Encoding': 'gzip',
+            })
+        # Oldest points fall off if InfluxDB stays down for too long
+        self._buffer = deque(maxlen=max_buffer)
+        self._lock = threading.Lock()
+        # One flush at a time, see flush()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self.written = 0
+        self.dropped = 0
+        self.failed_writes = 0
+        self._thread = threading.Thread(target=self._flush_loop, name='xcel_influx', daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_env(cls) -> 'InfluxSink | None':
+        """
+        Builds the sink from INFLUX_URL and friends, falling back to the
+        INFLUXDB_INIT_* values of the docker stack. None if INFLUX_URL
+        isn't set.
+
+        Returns: InfluxSink or None
+        """
+        url = os.getenv('INFLUX_URL')
+        if not url:
+            return None
+        return cls(url,
+                   os.getenv('INFLUX_TOKEN', os.getenv('INFLUXDB_INIT_ADMIN_TOKEN', '')),
+                   os.getenv('INFLUX_ORG', os.getenv('INFLUXDB_INIT_ORG', '')),
+                   os.getenv('INFLUX_BUCKET', os.getenv('INFLUXDB_INIT_BUCKET', '')),
+                   batch_size=int(os.getenv('INFLUX_BATCH_SIZE', 5000)),
+                   flush_interval=float(os.getenv('INFLUX_FLUSH_INTERVAL', 10.0)))
+
+    def write(self, endpoint, reading: dict) -> None:
+        """
+        Queues one endpoint reading as a point.
+
+        Returns: None
+        """
+        tags = {
+            'lfdi': endpoint.device_info['device']['identifiers'][0],
+            'endpoint': endpoint.name,
+            }
+        fields = {}
+        for k, v in reading.items():
+            if k in TAG_READINGS:
+                tags[k] = v
+            else:
+                fields[k] = v
+        try:
+            start = int(reading[TIMESTAMP_READING])
+            duration = int(reading.get(DURATION_READING) or 0)
+        except (KeyError, TypeError, ValueError):
+            start, duration = None, 0
+        # An interval is stamped with its end, anything else with when it came in
+        timestamp = start + duration if duration > 0 else int(time())
+        self.write_point(endpoint.name.replace(' ', '_'), tags, fields, timestamp)
+
+    def write_point(self, measurement: str, tags: dict, fields: dict, timestamp: int) -> None:
+        line = to_line(measurement, tags, fields, timestamp)
+        if line is None:
+            return
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(line)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _take_batch(self, full_only: bool = False) -> list:
+        with self._lock:
+            if full_only and len(self._buffer) < self.batch_size:
+                return []
+            count = min(len(self._buffer), self.batch_size)
+            return [self._buffer.popleft() for _ in range(count)]
+
+    def _send(self, lines: list) -> bool:
+        """
+        Posts a batch, retrying server errors and rate limiting with
+        exponential backoff.
+
+        Returns: bool, True once InfluxDB accepted the batch
+        """
+        body = gzip.compress('\n'.join(lines).encode('utf-8'))
+        delay = 1.0
+        for attempt in range(self.max_retries):
+            try:
+                response = self.session.post(self.write_url, params=self.params,
+                                             data=body, timeout=10.0)
+            except requests.RequestException as e:
+                logger.warning(f'InfluxDB write failed: {e}')
+            else:
+                if response.status_code < 300:
+                    return True
+                if response.status_code != 429 and response.status_code < 500:
+                    # Bad data or credentials, retrying won't help
+                    logger.error(f'InfluxDB rejected {len(lines)} points: '
+                                 f'{response.status_code} {response.text[:200]}')
+                    return False
+                retry_after = response.headers.get('Retry-After')
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+                logger.warning(f'InfluxDB write returned {response.status_code}, retrying')
+            sleep(delay * random.uniform(0.8, 1.2))
+            delay = min(delay * 2, 60.0)
+        logger.error(f'Giving up on {len(lines)} points after {self.max_retries} attempts')
+
+        return False
+
+    def _flush_loop(self) -> None:
+        next_flush = monotonic() + self.flush_interval
+        while True:
+            self._wakeup.wait(timeout=max(next_flush - monotonic(), 0))
+            self._wakeup.clear()
+            if monotonic() < next_flush:
+                # Woken by a full buffer, what doesn't fill a batch waits for the interval
+                self.flush(full_only=True)
+                continue
+            self.flush()
+            next_flush = monotonic() + self.flush_interval
+
+    def flush(self, full_only: bool = False) -> None:
+        """
+        Sends everything buffered so far, one batch at a time, or only
+        the full batches. A flush that's already running (the background
+        one, or another caller's) is waited for rather than raced, so
+        batches go out in order.
+
+        Returns: None
+        """
+        with self._flush_lock:
+            while True:
+                lines = self._take_batch(full_only)
+                if not lines:
+                    return
+                if self._send(lines):
+                    self.written += len(lines)
+                else:
+                    self.failed_writes += 1
+                    self.dropped += len(lines)
+
+_shared_sink = None
+_shared_lock = threading.Lock()
+
+def shared_sink() -> InfluxSink | None:
+    """
+    One sink per process, so every meter of a fleet worker shares the
+    same batches.
+
+    Returns: InfluxSink or None when InfluxDB output isn't configured
+    """
+    global _shared_sink
+    with _shared_lock:
+        if _shared_sink is None:
+            _shared_sink = InfluxSink.from_env()
+        return _shared_sink
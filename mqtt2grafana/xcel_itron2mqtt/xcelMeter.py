@@ -1,79 +1,173 @@
 import os
-import ssl
+import asyncio
 import yaml
 import json
 import requests
 import logging
+import threading
 import paho.mqtt.client as mqtt
 import xml.etree.ElementTree as ET
-from time import sleep
+from time import sleep, monotonic
 from typing import Tuple
-from requests.packages.urllib3.util.ssl_ import create_urllib3_context
-from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from tenacity import retry, stop_after_attempt, before_sleep_log, wait_exponential
 
 # Local imports
 from xcelEndpoint import xcelEndpoint
+from xcelTransport import MeterAdapter
+from xcelScheduler import PollScheduler
+from xcelSpool import wrap_client
+from xcelInflux import shared_sink
+from xcelBatch import CycleBatcher
+from xcelMetrics import (RETRIES, register_meter, unregister_meter, register_client,
+                         start_metrics_server)
+from xcelCache import MeterCache
+from xcelHADiscovery import DiscoveryManager
+from xcelBackfill import ReadingBackfill
+from xcelRollup import RollupSink
+from xcelDerive import DerivationEngine
+from xcelCapture import CaptureLog
+from eventLog import log_event
 
 IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
-# Our target cipher is: ECDHE-ECDSA-AES128-CCM8
-CIPHERS = ('ECDHE')
+# XML Entries we're looking for within /sdev/sdi
+HW_INFO_NAMES = ['lFDI', 'swVer', 'mfID']
+# Backoff of the background /sdev/sdi check when starting from the cache
+VERIFY_DELAY_MIN = 5.0
+VERIFY_DELAY_MAX = 300.0
+# Longest the async loop sleeps before checking whether it was stopped
+STOP_CHECK_INTERVAL = 1.0
 
 logger = logging.getLogger(__name__)
 
-# Create an adapter for our request to enable the non-standard cipher
-# From https://lukasa.co.uk/2017/02/Configuring_TLS_With_Requests/
-class CCM8Adapter(HTTPAdapter):
+_log_setup_retry = before_sleep_log(logger, logging.WARNING)
+
+def before_setup_retry(retry_state) -> None:
     """
-    A TransportAdapter that re-enables ECDHE support in Requests.
-    Not really sure how much redundancy is actually required here
+    Counts and logs every retry of xcelMeter.setup
+
+    Returns: None
     """
-    def init_poolmanager(self, *args, **kwargs):
-        kwargs['ssl_context'] = self.create_ssl_context()
-        return super(CCM8Adapter, self).init_poolmanager(*args, **kwargs)
-
-    def proxy_manager_for(self, *args, **kwargs):
-        kwargs['ssl_context'] = self.create_ssl_context()
-        return super(CCM8Adapter, self).proxy_manager_for(*args, **kwargs)
-
-    def create_ssl_context(self):
-        ssl_version=ssl.PROTOCOL_TLSv1_2
-        context = create_urllib3_context(ssl_version=ssl_version)
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_REQUIRED
-        context.set_ciphers(CIPHERS)
-        return context
+    RETRIES.inc(meter=retry_state.args[0].name, operation='setup')
+    _log_setup_retry(retry_state)
 
 class xcelMeter():
 
-    def __init__(self, name: str, ip_address: str, port: int, creds: Tuple[str, str]):
+    def __init__(self, name: str, ip_address: str, port: int, creds: Tuple[str, str],
+                 mqtt_client: mqtt.Client = None, topic_prefix: str = None,
+                 cache: MeterCache = None, batch_topic_prefix: str = None):
         self.name = name
+        self.ip_address = ip_address
+        self.port = port
+        # Last known hardware details, lets setup skip the /sdev/sdi round trip
+        self.cache = cache
+        # Overrides MQTT_TOPIC_PREFIX so several meters can share a broker
+        self.topic_prefix = topic_prefix
+        # Overrides MQTT_BATCH_TOPIC_PREFIX of the batch, rollup and derived topics
+        self.batch_topic_prefix = batch_topic_prefix
+        # Polling interval of endpoints that don't set their own in the yaml
         self.POLLING_RATE = 5.0
+        # 'sync' queries endpoints one after another, 'async' queries them all at once
+        self.polling_mode = os.getenv('POLLING_MODE', 'sync').lower()
+        # 'per_sensor' publishes each reading on its own topic, 'json'/'msgpack'
+        # one document per meter per poll cycle
+        self.payload_mode = os.getenv('PAYLOAD_MODE', 'per_sensor').lower()
+        self.batcher = None
+        # Fills in what an outage missed from the meter's ReadingSet lists
+        self.backfill_enabled = os.getenv('BACKFILL', 'on').lower() in ('on', 'true', '1')
+        self.backfill = None
+        self.rollup = None
+        # Power, net flow and per tier energy computed from the summations
+        self.derive_enabled = os.getenv('DERIVE', 'on').lower() in ('on', 'true', '1')
+        self.deriver = None
+        # Raw responses kept for replays, see CAPTURE
+        self.capture = None
         # Base URL used to query the meter
         self.url = f'https://{ip_address}:{port}'
 
         # Setup the MQTT server connection
         self.mqtt_server_address = os.getenv('MQTT_SERVER')
         self.mqtt_port = self.get_mqtt_port()
-        self.mqtt_client = self.setup_mqtt(self.mqtt_server_address, self.mqtt_port)
+        # Fleet workers hand in one client that all of their meters share
+        if mqtt_client is None:
+            mqtt_client = wrap_client(self.setup_mqtt(self.mqtt_server_address, self.mqtt_port),
+                                      self.name)
+            register_client(self.name, mqtt_client)
+        self.mqtt_client = mqtt_client
+        # Homeassistant configs of the meter, only changed ones get published
+        self.discovery = DiscoveryManager(self.mqtt_client, self.name)
+
+        # Extra outputs next to MQTT, shared by every meter in the process
+        self.sinks = [sink for sink in (shared_sink(),) if sink is not None]
 
         # Create a new requests session based on the passed in ip address and port #
-        self.requests_session = self.setup_session(creds, ip_address)
+        self.requests_session = self.setup_session(creds, ip_address, port)
 
         # Set to uninitialized
         self.initalized = False
+        self.endpoints = []
+        # Hardware details found by verify_hardware_details, applied by the run loops
+        self._pending_details = None
+        # Set by stop(), ends the run loops
+        self._stopped = threading.Event()
+
+        # Optional Prometheus endpoint, see METRICS_PORT
+        register_meter(self)
+        start_metrics_server()
 
     @retry(stop=stop_after_attempt(15),
            wait=wait_exponential(multiplier=1, min=1, max=15),
-           before_sleep=before_sleep_log(logger, logging.WARNING),
+           before_sleep=before_setup_retry,
            reraise=True)
     def setup(self) -> None: # This metgod initializes, or creates a meter object
-        # XML Entries we're looking for within the endpoint
-        hw_info_names = ['lFDI', 'swVer', 'mfID']
-        # Endpoint of the meter used for HW info
-        hw_info_url = '/sdev/sdi' # e.g. http://localhost:8082/sdev/sdi or http://<IP_ADDRESS>:8082/sdev/sdi
-        # Query the meter to get some more details about it
-        details_dict = self.get_hardware_details(hw_info_url, hw_info_names)
+        cached = self.cache.load() if self.cache is not None else None
+        if cached and self.cache_matches(cached):
+            # Start polling on what we knew last time, and make sure it still holds
+            logger.info(f'Using cached hardware details of {self.name}, verifying in the background')
+            details_dict = cached
+            threading.Thread(target=self.verify_hardware_details, args=(cached,),
+                             name='xcel_verify', daemon=True).start()
+        else:
+            # Endpoint of the meter used for HW info
+            hw_info_url = '/sdev/sdi' # e.g. http://localhost:8082/sdev/sdi or http://<IP_ADDRESS>:8082/sdev/sdi
+            # Query the meter to get some more details about it
+            details_dict = self.get_hardware_details(hw_info_url, HW_INFO_NAMES)
+        self.apply_hardware_details(details_dict)
+
+        # ready to go
+        self.initalized = True
+
+    def cache_matches(self, cached: dict) -> bool:
+        """
+        Cached hardware details only count for the meter they came from,
+        METER_IP may point at another one since they were saved.
+
+        Returns: bool, True if the cache is complete and for this address
+        """
+        if not all(cached.get(name) for name in HW_INFO_NAMES):
+            return False
+        try:
+            return str(cached['ip']) == str(self.ip_address) and int(cached['port']) == int(self.port)
+        except (KeyError, TypeError, ValueError):
+            return False
+
+    @staticmethod
+    def endpoints_profile(sw_version: str) -> str:
+        """
+        The swVer will dictate which version of endpoints we use
+
+        Returns: str, suffix of the configs/endpoints_<profile>.yaml to load
+        """
+        return 'default' if str(sw_version) != '3.2.39' else '3_2_39'
+
+    def apply_hardware_details(self, details_dict: dict) -> None:
+        """
+        Builds the device info and the endpoints for the given hardware
+        details, replacing any endpoints from before. The run loops pick
+        up the new endpoints on their next tick.
+
+        Returns: None
+        """
         self._mfid = details_dict['mfID']
         self._lfdi = details_dict['lFDI']
         self._swVer = details_dict['swVer']
@@ -90,16 +184,99 @@ class xcelMeter():
         # Send homeassistant a new device config for the meter
         self.send_mqtt_config()
 
-        # The swVer will dictate which version of endpoints we use
-        endpoints_file_ver = 'default' if str(self._swVer) != '3.2.39' else '3_2_39'
+        if self.payload_mode != 'per_sensor':
+            self.batcher = CycleBatcher(self.mqtt_client, self.device_info, self.payload_mode,
+                                        topic_prefix=self.batch_topic_prefix)
+        if self.backfill is not None:
+            self.backfill.close()
+        if self.backfill_enabled:
+            self.backfill = ReadingBackfill(self)
+        # 1 and 15 minute aggregates for long dashboard ranges
+        rollup_windows = RollupSink.windows_from_env()
+        if rollup_windows:
+            self.rollup = RollupSink(self.mqtt_client, self.device_info, rollup_windows,
+                                     topic_prefix=self.batch_topic_prefix, influx=shared_sink())
+        if self.derive_enabled:
+            self.deriver = DerivationEngine(self.mqtt_client, self.device_info,
+                                            topic_prefix=self.batch_topic_prefix, influx=shared_sink())
+        if self.capture is not None:
+            self.capture.close()
+        self.capture = CaptureLog.from_env({'name': self.name, 'lFDI': self._lfdi,
+                                            'swVer': self._swVer, 'mfID': self._mfid})
+
+        endpoints_file_ver = self.endpoints_profile(self._swVer)
         # List to store our endpoint objects in
         self.endpoints_list = self.load_endpoints(f'configs/endpoints_{endpoints_file_ver}.yaml')
 
         # create endpoints from list
         self.endpoints = self.create_endpoints(self.endpoints_list, self.device_info)
+        # Every config is known now, send the ones Homeassistant hasn't seen
+        self.discovery.publish_pending()
 
-        # ready to go
-        self.initalized = True
+        if self.cache is not None:
+            self.cache.save(ip=self.ip_address, port=int(self.port), lFDI=self._lfdi,
+                            swVer=self._swVer, mfID=self._mfid, profile=endpoints_file_ver)
+
+    def verify_hardware_details(self, cached: dict) -> None:
+        """
+        Background check of cached hardware details against /sdev/sdi.
+        Keeps trying with a growing delay until the meter answers, then
+        has the run loop rebuild the endpoints between two cycles if the
+        meter turned out to be different (e.g. a firmware update changed
+        the endpoints profile).
+
+        Returns: None
+        """
+        delay = VERIFY_DELAY_MIN
+        while True:
+            try:
+                details_dict = self.get_hardware_details('/sdev/sdi', HW_INFO_NAMES)
+                break
+            except Exception as e:
+                logger.debug(f'Verifying hardware details of {self.name} failed: {e}')
+                sleep(delay)
+                delay = min(delay * 2, VERIFY_DELAY_MAX)
+        changed = [name for name in HW_INFO_NAMES if str(cached.get(name)) != str(details_dict[name])]
+        if not changed:
+            logger.info(f'Cached hardware details of {self.name} are current')
+            return
+        logger.warning(f'Meter {self.name} changed ({", ".join(changed)}), rebuilding endpoints')
+        # Swapping the outputs under a running poll would close them on it
+        self._pending_details = details_dict
+
+    def apply_pending_details(self) -> None:
+        """
+        Applies what verify_hardware_details found, called by the run
+        loops while no poll is running.
+
+        Returns: None
+        """
+        details_dict, self._pending_details = self._pending_details, None
+        if details_dict is not None:
+            self.apply_hardware_details(details_dict)
+
+    def move(self, ip_address: str, port: int) -> None:
+        """
+        Points the meter and its endpoints at a new address, e.g. after
+        the meter got a new DHCP lease.
+
+        Returns: None
+        """
+        old_url = self.url
+        self.ip_address = ip_address
+        self.port = port
+        self.url = f'https://{ip_address}:{port}'
+        if self.url == old_url:
+            return
+        self.requests_session.mount(f'{self.url}/', MeterAdapter())
+        old_adapter = self.requests_session.adapters.pop(f'{old_url}/', None)
+        if old_adapter is not None:
+            old_adapter.close()
+        for obj in self.endpoints:
+            obj.url = obj.url.replace(old_url, self.url, 1)
+        logger.info(f'Moved {self.name} from {old_url} to {self.url}')
+        if self.cache is not None:
+            self.cache.save(ip=ip_address, port=int(port))
 
     def get_hardware_details(self, hw_info_url: str, hw_names: list) -> dict:
         """
@@ -120,7 +297,7 @@ class xcelMeter():
         return hw_info_dict
 
     @staticmethod
-    def setup_session(creds: tuple, ip_address: str) -> requests.Session:
+    def setup_session(creds: tuple, ip_address: str, port: int) -> requests.Session:
         """
         Creates a new requests session with the given credentials pointed
         at the give IP address. Will be shared across each xcelQuery object.
@@ -129,11 +306,28 @@ class xcelMeter():
         """
         session = requests.Session()
         session.cert = creds
-        # Mount our adapter to the domain
-        session.mount('https://{ip_address}', CCM8Adapter())
+        # Mount our adapter to the meter, trailing slash so 10.0.0.5 doesn't match 10.0.0.50
+        session.mount(f'https://{ip_address}:{port}/', MeterAdapter())
 
         return session
 
+    def breaker_states(self) -> dict:
+        """
+        Circuit breaker state and skip counts of every endpoint, for alerting.
+
+        Returns: dict, {<endpoint name>: <breaker snapshot>}
+        """
+        return {obj.name: obj.breaker.snapshot() for obj in self.endpoints}
+
+    def transport_stats(self) -> dict:
+        """
+        Connection counters of the meter's transport, used to check that
+        steady state polling reuses connections and TLS sessions.
+
+        Returns: dict
+        """
+        return self.requests_session.get_adapter(f'{self.url}/').stats.snapshot()
+
     @staticmethod
     def load_endpoints(file_path: str) -> list:
         """
@@ -147,13 +341,29 @@ class xcelMeter():
         return endpoints
 
     def create_endpoints(self, endpoints: dict, device_info: dict) -> None:
+        # In batched payload mode readings go to the batcher instead of per sensor topics
+        sinks = self.sinks if self.batcher is None else self.sinks + [self.batcher]
+        if self.backfill is not None:
+            sinks = sinks + [self.backfill]
+        if self.rollup is not None:
+            sinks = sinks + [self.rollup]
+        if self.deriver is not None:
+            sinks = sinks + [self.deriver]
         # Build query objects for each endpoint
         query_obj = []
         for point in endpoints:
             for endpoint_name, v in point.items():
                 request_url = f'{self.url}{v["url"]}'
                 query_obj.append(xcelEndpoint(self.requests_session, self.mqtt_client,
-                                    request_url, endpoint_name, v['tags'], device_info))
+                                    request_url, endpoint_name, v['tags'], device_info,
+                                    topic_prefix=self.topic_prefix,
+                                    poll_interval=v.get('interval'),
+                                    sinks=sinks,
+                                    publish_states=self.batcher is None,
+                                    discovery=self.discovery,
+                                    rollup=v.get('rollup'),
+                                    derive=v.get('derive'),
+                                    capture=self.capture))
 
         return query_obj
 
@@ -182,9 +392,10 @@ class xcelMeter():
         """
         def on_connect(client, userdata, flags, rc):
             if rc == 0:
-                logging.info("Connected to MQTT Broker!")
+                log_event('connect', "Connected to MQTT Broker!")
             else:
-                logging.error("Failed to connect, return code %d\n", rc)
+                log_event('connect', "Failed to connect", logging.ERROR,
+                          rc=rc, error=mqtt.connack_string(rc))
 
         # Check if a username/PW is setup for the MQTT connection
         mqtt_username = os.getenv('MQTT_USER')
@@ -194,7 +405,13 @@ class xcelMeter():
         if mqtt_username and mqtt_password:
             client.username_pw_set(mqtt_username, mqtt_password)
         client.on_connect = on_connect
-        client.connect(mqtt_server_address, mqtt_port)
+        # Don't wait minutes between reconnect attempts after a broker restart
+        client.reconnect_delay_set(min_delay=1, max_delay=30)
+        if os.getenv('SPOOL_DIR'):
+            # Start up even if the broker is down, the spool holds our messages
+            client.connect_async(mqtt_server_address, mqtt_port)
+        else:
+            client.connect(mqtt_server_address, mqtt_port)
         client.loop_start()
 
         return client
@@ -213,7 +430,8 @@ class xcelMeter():
 
     def send_mqtt_config(self) -> None:
         """
-        Sends a discovery payload to homeassistant for the new meter device
+        Registers the discovery payload for the new meter device with the
+        discovery manager, which publishes it (retained) if it changed
 
         - sends device information ( a.k.a discovery payload) to a topic "homeassistant/device/energy/xcel_itron_5" 
         
@@ -222,7 +440,6 @@ class xcelMeter():
 
         # {self.name.replace(" ", "_").lower() creates xcel_itron_5 from Xcel Itron 5 to make homeassistant/device/energy/xcel_itron_5
         state_topic = f'homeassistant/device/energy/{self.name.replace(" ", "_").lower()}' 
-        logging.info(f"MQTT Discovery Topic being used: {state_topic}")  # <-- Added logging here
         config_dict = {
             "name": self.name,
             "device_class": "energy",
@@ -231,34 +448,150 @@ class xcelMeter():
             }
         config_dict.update(self.device_info)
         config_json = json.dumps(config_dict)
-        logging.debug(f"")
-        logging.debug(f"")
-        logging.debug(f"Sending MQTT Discovery Payload")
-        logging.debug(f"")
-        logging.debug(f"")
-        logging.debug(f"TOPIC: {state_topic}")
-        logging.debug(f"")
-        logging.debug(f"")
-        logging.debug(f"MESSAGE: {config_json}")
-        logging.debug(f"")
-        logging.debug(f"")
-        logging.info(f"Formatted JSON Structure of MEssage ( DEVICE INFO): {json.dumps(config_dict, indent=2)}")
-        logging.debug(f"")
-        logging.debug(f"")
-        logging.info(f"Publishing to topic: {state_topic}")  # <-- Log topic before publish
-
-        # JUST NEED TO CUSTOMIZE PUBLISH METHOD!
-        self.mqtt_client.publish(state_topic, str(config_json))
+        logger.debug(f"MQTT Discovery Payload for {state_topic}: {config_json}")
+        self.discovery.add(state_topic, config_json)
+
+    @property
+    def stopped(self) -> bool:
+        return self._stopped.is_set()
+
+    def stop(self) -> None:
+        """
+        Retires the meter, the run loop returns after the poll in progress
+        and the connections to the meter are closed. The MQTT client is
+        left alone since it may be shared with other meters.
+
+        Returns: None
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        unregister_meter(self)
+        self.discovery.close()
+        if self.backfill is not None:
+            self.backfill.close()
+        if self.capture is not None:
+            self.capture.close()
+        logger.info(f'Stopping {self.name}')
+
+    def wait_stopped(self, timeout: float) -> bool:
+        """
+        Sleeps up to timeout seconds, waking up early if the meter is stopped
+
+        Returns: bool, True if the meter was stopped
+        """
+        return self._stopped.wait(timeout)
 
     def run(self) -> None:
         """
         Main business loop. Just repeatedly queries the meter endpoints,
         parses the results, packages these up into MQTT payloads, and sends
-        them off to the MQTT server
+        them off to the MQTT server. Runs until stop() is called.
 
         Returns: None
         """
-        while True:
-            sleep(self.POLLING_RATE)
-            for obj in self.endpoints:
+        if self.polling_mode == 'async':
+            asyncio.run(self.run_async())
+            return
+
+        endpoints = None
+        while not self._stopped.is_set():
+            self.apply_pending_details()
+            # Endpoints get rebuilt when the meter turns out to have changed
+            if self.endpoints is not endpoints:
+                endpoints = self.endpoints
+                self.scheduler = PollScheduler(endpoints, self.POLLING_RATE)
+            delay = self.scheduler.next_due() - monotonic()
+            if delay > 0 and self._stopped.wait(delay):
+                break
+            for obj in self.scheduler.pop_due():
                 obj.run()
+            if self.batcher is not None:
+                self.batcher.flush()
+        self.requests_session.close()
+
+    async def run_async(self) -> None:
+        """
+        Asyncio version of the business loop. Endpoints that are due at
+        the same time are queried at once over the shared requests session,
+        and each reading is published as soon as its response arrives, so
+        a slow endpoint never holds back the others.
+
+        Returns: None
+        """
+        endpoints = None
+        executor = None
+        workers = 0
+        # Endpoints with a query still running, and the tasks running them
+        polling = set()
+        tasks = set()
+        while not self._stopped.is_set():
+            if self._pending_details is not None:
+                # Queries in flight still use the outputs that are about to be replaced
+                await asyncio.gather(*tasks, return_exceptions=True)
+                self.apply_pending_details()
+            if self.endpoints is not endpoints:
+                endpoints = self.endpoints
+                self.scheduler = PollScheduler(endpoints, self.POLLING_RATE)
+                # One worker per endpoint so no request has to wait for a free thread,
+                # queries still running on a replaced executor finish there
+                if max(1, len(endpoints)) != workers:
+                    workers = max(1, len(endpoints))
+                    if executor is not None:
+                        executor.shutdown(wait=False)
+                    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='xcel_poll')
+            delay = self.scheduler.next_due() - monotonic()
+            if delay > 0:
+                await asyncio.sleep(min(delay, STOP_CHECK_INTERVAL))
+                continue
+            cycle = []
+            for obj in self.scheduler.pop_due():
+                # Still waiting on the last tick, don't pile another one on
+                if obj in polling:
+                    self.scheduler.record_skip(obj)
+                    continue
+                polling.add(obj)
+                task = asyncio.create_task(self.poll_endpoint_async(obj, executor))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _, obj=obj: polling.discard(obj))
+                cycle.append(task)
+            if cycle and self.batcher is not None:
+                task = asyncio.create_task(self.flush_cycle_async(cycle))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        # Let the polls in progress finish before closing up
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if executor is not None:
+            executor.shutdown()
+        self.requests_session.close()
+
+    async def flush_cycle_async(self, cycle: list) -> None:
+        """
+        Publishes the batched document once every endpoint of the cycle is done
+
+        Returns: None
+        """
+        await asyncio.gather(*cycle, return_exceptions=True)
+        self.batcher.flush()
+
+    @staticmethod
+    async def poll_endpoint_async(obj: xcelEndpoint, executor: ThreadPoolExecutor) -> None:
+        """
+        Runs the blocking query and parse of a single endpoint on the
+        executor, then publishes the reading from the event loop.
+
+        Returns: None
+        """
+        if not obj.poll_wanted() or not obj.breaker.allow():
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            reading = await loop.run_in_executor(executor, obj.get_reading)
+        except Exception as e:
+            # Keep the other endpoints polling while this one backs off
+            obj.breaker.record_failure(e)
+            logger.warning(f'Failed to query {obj.name}: {e}')
+            return
+        obj.breaker.record_success()
+        obj.publish_reading(reading)
@@ -0,0 +1,278 @@
+import os
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds, suits both a LAN request to the meter and a few ms of XML parsing
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0)
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                      .replace('"', '\\"').replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return f'{{{pairs}}}'
+
+class Metric():
+    """
+    Base for a metric family with a fixed set of label names
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self) -> list:
+        """
+        Returns: list of (name suffix, label names, label values, value)
+        """
+        with self._lock:
+            return [('', self.label_names, key, value) for key, value in self._values.items()]
+
+    def expose(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, names, values, value in self.samples():
+            lines.append(f'{self.name}{suffix}{format_labels(names, values)} {value}')
+        return lines
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+class CallbackGauge(Metric):
+    """
+    Gauge read at scrape time from a function returning {label values: value}
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple, function):
+        super().__init__(name, documentation, labels)
+        self._function = function
+
+    def samples(self) -> list:
+        try:
+            values = self._function()
+        except Exception as e:
+            logger.debug(f'Collecting {self.name} failed: {e}')
+            return []
+        return [('', self.label_names, key, value) for key, value in values.items()]
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per bucket counts (not cumulative), then count and sum
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    def samples(self) -> list:
+        samples = []
+        names = self.label_names + ('le',)
+        with self._lock:
+            for key, (counts, count, total) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append(('_bucket', names, key + (repr(bound),), cumulative))
+                samples.append(('_bucket', names, key + ('+Inf',), count))
+                samples.append(('_count', self.label_names, key, count))
+                samples.append(('_sum', self.label_names, key, total))
+        return samples
+
+class Registry():
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+# Meters and MQTT clients of this process, read at scrape time
+_meters = []
+_clients = []
+
+def register_meter(meter) -> None:
+    _meters.append(meter)
+
+def unregister_meter(meter) -> None:
+    if meter in _meters:
+        _meters.remove(meter)
+
+def register_client(name: str, client) -> None:
+    _clients.append((name, client))
+
+def _paho_queued() -> dict:
+    values = {}
+    for name, client in _clients:
+        # Follow a SpoolingClient down to the paho client
+        client = getattr(client, 'client', client)
+        # Every packet paho hasn't written to the socket yet. _out_messages
+        # would only hold QoS 1/2 messages and we publish at QoS 0
+        out_packet = getattr(client, '_out_packet', None)
+        if out_packet is not None:
+            values[(name,)] = len(out_packet)
+    return values
+
+def _publish_queues() -> dict:
+    values = {}
+    for name, client in _clients:
+        queue_depth = getattr(client, 'queue_depth', None)
+        if callable(queue_depth):
+            values[(name, 'queued')] = queue_depth()
+            values[(name, 'inflight')] = client.inflight()
+    return values
+
+def _breaker_states() -> dict:
+    states = ('closed', 'open', 'half_open')
+    values = {}
+    for meter in _meters:
+        for obj in getattr(meter, 'endpoints', []):
+            for state in states:
+                values[(meter.name, obj.name, state)] = int(obj.breaker.state == state)
+    return values
+
+def _breaker_skips() -> dict:
+    return {(meter.name, obj.name): obj.breaker.skipped
+            for meter in _meters for obj in getattr(meter, 'endpoints', [])}
+
+def _transport_stats() -> dict:
+    values = {}
+    for meter in _meters:
+        for stat, value in meter.transport_stats().items():
+            values[(meter.name, stat)] = value
+    return values
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'xcel_request_duration_seconds', 'HTTPS request latency to the meter',
+    ('meter', 'endpoint')))
+PARSE_TIME = REGISTRY.register(Histogram(
+    'xcel_parse_duration_seconds', 'Time spent extracting readings from the XML response',
+    ('meter', 'endpoint')))
+REQUEST_FAILURES = REGISTRY.register(Counter(
+    'xcel_request_failures_total', 'Meter requests that raised or returned unusable data',
+    ('meter', 'endpoint')))
+PUBLISHES = REGISTRY.register(Counter(
+    'xcel_mqtt_publish_total', 'MQTT publishes handed to the client',
+    ('meter', 'endpoint')))
+PUBLISH_FAILURES = REGISTRY.register(Counter(
+    'xcel_mqtt_publish_failures_total', 'MQTT publishes the client refused',
+    ('meter', 'endpoint')))
+PUBLISH_ACK_LATENCY = REGISTRY.register(Histogram(
+    'xcel_mqtt_ack_duration_seconds', 'Time from handing a message to paho to its on_publish',
+    ('client',)))
+PUBLISH_DROPS = REGISTRY.register(Counter(
+    'xcel_mqtt_publish_dropped_total', 'Messages the publish queue dropped, coalesced or refused',
+    ('client', 'reason')))
+RETRIES = REGISTRY.register(Counter(
+    'xcel_retries_total', 'Tenacity retries', ('meter', 'operation')))
+CYCLE_OVERRUNS = REGISTRY.register(Counter(
+    'xcel_cycle_overruns_total', 'Polls skipped because the previous one ran late',
+    ('meter', 'endpoint')))
+LAST_SUCCESS = REGISTRY.register(Gauge(
+    'xcel_last_success_timestamp_seconds', 'Unix time of the last good reading',
+    ('meter', 'endpoint')))
+REGISTRY.register(CallbackGauge(
+    'xcel_mqtt_queued_packets', 'Packets queued in paho that are not written to the broker yet',
+    ('client',), _paho_queued))
+REGISTRY.register(CallbackGauge(
+    'xcel_mqtt_publish_queue_messages', 'Messages waiting in the publish pipeline, queued or inflight',
+    ('client', 'state'), _publish_queues))
+REGISTRY.register(CallbackGauge(
+    'xcel_breaker_state', 'Circuit breaker state per endpoint, 1 for the current state',
+    ('meter', 'endpoint', 'state'), _breaker_states))
+REGISTRY.register(CallbackGauge(
+    'xcel_breaker_skipped_polls', 'Polls skipped by an open circuit breaker',
+    ('meter', 'endpoint'), _breaker_skips))
+REGISTRY.register(CallbackGauge(
+    'xcel_transport_connections', 'Meter transport counters (requests, handshakes, reuse)',
+    ('meter', 'stat'), _transport_stats))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = REGISTRY.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the container log
+        pass
+
+_server = None
+
+def start_metrics_server(port: int = None) -> ThreadingHTTPServer | None:
+    """
+    Serves /metrics on METRICS_PORT (or the given port) from a daemon
+    thread. Only starts once per process, nothing happens if no port is
+    configured.
+
+    Returns: the server, or None when metrics are off
+    """
+    global _server
+    if _server is not None:
+        return _server
+    if port is None:
+        env_port = os.getenv('METRICS_PORT')
+        if not env_port:
+            return None
+        port = int(env_port)
+    _server = ThreadingHTTPServer(('', port), MetricsHandler)
+    thread = threading.Thread(target=_server.serve_forever, name='xcel_metrics', daemon=True)
+    thread.start()
+    logger.info(f'Serving metrics on port {port}')
+
+    return _server
@@ -0,0 +1,72 @@
+from time import monotonic
+
+class PublishPolicy():
+    """
+    Report-by-exception rules for a single sensor, set with the
+    `publish_policy` key next to a tag's device_class in the endpoints
+    yaml:
+
+        publish_policy:
+          deadband: 10           # publish when the value moved by at least 10
+          deadband_percent: 1.5  # ... or by 1.5 % of the last published value
+          on_change: true        # publish whenever the value differs at all
+          max_silence: 300       # always publish at least every 300 s
+
+    A sensor without a policy is published on every poll.
+    """
+    def __init__(self, deadband: float = None, deadband_percent: float = None,
+                 on_change: bool = False, max_silence: float = None):
+        self.deadband = deadband
+        self.deadband_percent = deadband_percent
+        self.on_change = on_change
+        self.max_silence = max_silence
+
+    @classmethod
+    def from_config(cls, config: dict | None) -> 'PublishPolicy | None':
+        """
+        Builds a policy from the yaml mapping, None when there isn't one.
+
+        Returns: PublishPolicy or None
+        """
+        if not config:
+            return None
+        unknown = set(config) - {'deadband', 'deadband_percent', 'on_change', 'max_silence'}
+        if unknown:
+            raise ValueError(f'Unknown publish_policy settings: {", ".join(sorted(unknown))}')
+
+        return cls(**config)
+
+    def should_publish(self, value: str, last: tuple | None, now: float = None) -> bool:
+        """
+        Decides whether a new reading goes out given the last published
+        (value, monotonic time), or None if nothing was published yet.
+
+        Returns: bool
+        """
+        if last is None:
+            return True
+        last_value, last_time = last
+        if now is None:
+            now = monotonic()
+        if self.max_silence is not None and now - last_time >= self.max_silence:
+            return True
+        if self.on_change and value != last_value:
+            return True
+        if self.deadband is None and self.deadband_percent is None:
+            # Only a heartbeat and/or on_change was asked for
+            return not self.on_change and self.max_silence is None
+        try:
+            delta = abs(float(value) - float(last_value))
+        except (TypeError, ValueError):
+            # Non numeric readings can only be compared for equality
+            return value != last_value
+        if self.deadband is not None and delta >= self.deadband:
+            return True
+        if self.deadband_percent is not None:
+            reference = abs(float(last_value))
+            if reference == 0.0:
+                return delta > 0.0
+            if delta / reference * 100.0 >= self.deadband_percent:
+                return True
+
+        return False
@@ -0,0 +1,267 @@
+import os
+import logging
+import threading
+from collections import deque
+from time import monotonic
+
+import paho.mqtt.client as mqtt
+
+# Local imports
+from eventLog import log_event
+from xcelMetrics import PUBLISH_ACK_LATENCY, PUBLISH_DROPS
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop_oldest', 'coalesce', 'block')
+
+class QueuedMessage():
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'queued_at')
+
+    def __init__(self, topic: str, payload, qos: int, retain: bool):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.queued_at = monotonic()
+
+class PublishPipeline():
+    """
+    Stands in for the paho (or spooling) client in the publish path and
+    takes the broker off the polling threads. publish() only puts the
+    message on a bounded queue and returns, a publisher thread hands the
+    queue to the client in batches while no more than max_inflight
+    messages wait for paho's on_publish. A slow or stalled broker fills
+    the window, then the queue, and from there the overflow policy
+    decides:
+
+    - drop_oldest: the oldest queued message makes room for the new one
+    - coalesce: a message for a topic that is still queued replaces the
+      queued payload, a full queue without that topic drops the oldest
+    - block: publish() waits up to block_timeout for room, then fails
+      with MQTT_ERR_QUEUE_SIZE
+
+    Retained messages (the Homeassistant discovery configs) skip the
+    queue and go straight to the client, so they can't be dropped after
+    the caller was told they were sent.
+    """
+    def __init__(self, client, name: str, max_queue: int = None, max_inflight: int = None,
+                 batch_size: int = None, overflow: str = None, block_timeout: float = None,
+                 ack_timeout: float = None):
+        self.target = client
+        # The paho client, below a SpoolingClient if there is one
+        self.client = getattr(client, 'client', client)
+        self.name = name
+        self.max_queue = max_queue or int(os.getenv('PUBLISH_QUEUE_SIZE', 10000))
+        self.max_inflight = max_inflight or int(os.getenv('PUBLISH_MAX_INFLIGHT', 100))
+        self.batch_size = batch_size or int(os.getenv('PUBLISH_BATCH_SIZE', 50))
+        self.overflow = (overflow or os.getenv('PUBLISH_OVERFLOW', 'drop_oldest')).lower()
+        if self.overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'PUBLISH_OVERFLOW must be one of {", ".join(OVERFLOW_POLICIES)}, '
+                             f'not {self.overflow}')
+        self.block_timeout = block_timeout or float(os.getenv('PUBLISH_BLOCK_TIMEOUT', 5))
+        # Seconds before an unconfirmed message stops counting against the window,
+        # paho never confirms QoS 0 messages that were queued when the connection dropped
+        self.ack_timeout = ack_timeout or float(os.getenv('PUBLISH_ACK_TIMEOUT', 30))
+        self.published = 0
+        self.acked = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.refused = 0
+        self._queue = deque()
+        # {topic: queued message}, only kept for the coalesce policy
+        self._by_topic = {}
+        # {mid: monotonic time it went to the client}
+        self._inflight = {}
+        # Acks that beat publish() returning their mid
+        self._early_acks = set()
+        self._sending = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._on_publish = self.client.on_publish
+        self.client.on_publish = self._handle_publish
+        self._thread = threading.Thread(target=self._publish_loop, name='xcel_publish', daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        # Anything else is the real client's business
+        return getattr(self.target, name)
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def inflight(self) -> int:
+        with self._cond:
+            return len(self._inflight)
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        """
+        Same signature and return value as paho's publish. The message is
+        only queued, so the mid is always 0, unless it is retained. What
+        the client makes of it is logged as a publish event when it's sent.
+
+        Returns: mqtt.MQTTMessageInfo
+        """
+        if retain:
+            return self.target.publish(topic, payload, qos=qos, retain=retain)
+        result = mqtt.MQTTMessageInfo(0)
+        result.rc = mqtt.MQTT_ERR_SUCCESS
+        with self._cond:
+            if self._closed:
+                result.rc = mqtt.MQTT_ERR_NO_CONN
+                return result
+            if self.overflow == 'coalesce':
+                queued = self._by_topic.get(topic)
+                if queued is not None:
+                    queued.payload, queued.qos, queued.retain = payload, qos, retain
+                    self.coalesced += 1
+                    PUBLISH_DROPS.inc(client=self.name, reason='coalesced')
+                    return result
+            if len(self._queue) >= self.max_queue:
+                if self.overflow == 'block':
+                    if not self._cond.wait_for(lambda: len(self._queue) < self.max_queue
+                                               or self._closed, self.block_timeout) \
+                            or self._closed:
+                        self.refused += 1
+                        PUBLISH_DROPS.inc(client=self.name, reason='refused')
+                        result.rc = mqtt.MQTT_ERR_QUEUE_SIZE
+                        return result
+                else:
+                    oldest = self._queue.popleft()
+                    if self._by_topic.get(oldest.topic) is oldest:
+                        del self._by_topic[oldest.topic]
+                    self.dropped += 1
+                    PUBLISH_DROPS.inc(client=self.name, reason='overflow')
+                    if self.dropped == 1 or self.dropped % 1000 == 0:
+                        logger.warning(f'Publish queue of {self.name} is full, dropped '
+                                       f'{self.dropped} messages so far')
+            message = QueuedMessage(topic, payload, qos, retain)
+            self._queue.append(message)
+            if self.overflow == 'coalesce':
+                self._by_topic[topic] = message
+            self._cond.notify_all()
+
+        return result
+
+    def _handle_publish(self, client, userdata, mid):
+        if self._on_publish:
+            self._on_publish(client, userdata, mid)
+        now = monotonic()
+        with self._cond:
+            sent_at = self._inflight.pop(mid, None)
+            if sent_at is None:
+                # Spool replays and other publishers of the client aren't ours
+                if self._sending:
+                    self._early_acks.add(mid)
+                return
+            self.acked += 1
+            self._cond.notify_all()
+        PUBLISH_ACK_LATENCY.observe(now - sent_at, client=self.name)
+
+    def _expire_inflight(self, now: float) -> None:
+        expired = [mid for mid, sent_at in self._inflight.items() if now - sent_at > self.ack_timeout]
+        for mid in expired:
+            del self._inflight[mid]
+        if expired:
+            logger.warning(f'{len(expired)} messages of {self.name} were never confirmed')
+            self._cond.notify_all()
+
+    def _take_batch(self) -> list:
+        with self._cond:
+            while True:
+                room = self.max_inflight - len(self._inflight)
+                if self._queue and room > 0:
+                    break
+                if self._closed and not self._queue:
+                    return None
+                self._cond.wait(timeout=1.0)
+                self._expire_inflight(monotonic())
+            batch = [self._queue.popleft() for _ in range(min(room, self.batch_size, len(self._queue)))]
+            for message in batch:
+                if self._by_topic.get(message.topic) is message:
+                    del self._by_topic[message.topic]
+            self._sending += 1
+            # Room for publish() calls blocked on a full queue
+            self._cond.notify_all()
+        return batch
+
+    def _publish_loop(self) -> None:
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            sent = []
+            for message in batch:
+                sent_at = monotonic()
+                try:
+                    result = self.target.publish(message.topic, message.payload,
+                                                 qos=message.qos, retain=message.retain)
+                except Exception as e:
+                    logger.error(f'Publishing to {message.topic} failed: {e}')
+                    continue
+                if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                    self.refused += 1
+                    PUBLISH_DROPS.inc(client=self.name, reason='refused')
+                    log_event('publish', 'Publish failed', logging.WARNING, client=self.name,
+                              topic=message.topic, rc=result.rc, error=mqtt.error_string(result.rc))
+                    continue
+                self.published += 1
+                # A spooled message has no mid, it isn't in flight
+                if result.mid:
+                    sent.append((result.mid, sent_at))
+                    log_event('publish', 'Published', client=self.name, topic=message.topic,
+                              rc=result.rc, mid=result.mid)
+            with self._cond:
+                self._sending -= 1
+                for mid, sent_at in sent:
+                    if mid in self._early_acks:
+                        self._early_acks.discard(mid)
+                        self.acked += 1
+                        PUBLISH_ACK_LATENCY.observe(monotonic() - sent_at, client=self.name)
+                    else:
+                        self._inflight[mid] = sent_at
+                if not self._sending:
+                    self._early_acks.clear()
+                self._cond.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Waits for the queue to empty and every message to be confirmed.
+
+        Returns: bool, False if messages were left after the timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._inflight
+                                       and not self._sending, timeout)
+
+    def close(self, timeout: float = 10.0) -> None:
+        """
+        Sends what is still queued, for up to timeout seconds, and stops
+        the publisher thread.
+
+        Returns: None
+        """
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._by_topic.clear()
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+
+    def disconnect(self, *args, **kwargs):
+        # Don't lose the queue on a clean shutdown
+        self.close()
+        return self.target.disconnect(*args, **kwargs)
+
+def wrap_pipeline(client, name: str):
+    """
+    Puts a PublishPipeline in front of the given client unless
+    PUBLISH_PIPELINE is off.
+
+    Returns: the pipeline, or the client as is
+    """
+    if os.getenv('PUBLISH_PIPELINE', 'on').lower() in ('off', 'false', '0'):
+        return client
+
+    return PublishPipeline(client, name)
@@ -0,0 +1,365 @@
+import os
+import sys
+import ssl
+import socket
+import hashlib
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from time import monotonic
+from urllib.parse import urlsplit, urljoin
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Prefix that appears on all of the XML elements
+IEEE_PREFIX = '{urn:ieee:std:2030.5:ns}'
+# Where the meter lists the resource subscriptions are posted to
+SUBSCRIPTION_LIST_LINK = 'SubscriptionListLink'
+SEP_XML = 'application/sep+xml'
+# Path of our listener the meter posts notifications to
+NOTIFY_PATH = '/notify'
+# Notification status 0 is a regular update, anything else means the subscription is gone
+STATUS_DEFAULT = '0'
+# Largest notification body we read, the meter's are well under a kilobyte
+MAX_NOTIFICATION_SIZE = 64 * 1024
+
+SUBSCRIPTION_TEMPLATE = (
+    '<Subscription xmlns="urn:ieee:std:2030.5:ns">'
+    '<subscribedResource>{resource}</subscribedResource>'
+    '<encoding>0</encoding>'
+    '<level>+S1</level>'
+    '<limit>1</limit>'
+    '<notificationURI>{notify_uri}</notificationURI>'
+    '</Subscription>'
+)
+
+def local_address(remote_host: str, remote_port: int) -> str:
+    """
+    The address of the interface that routes to the meter, what the
+    meter should post its notifications to. Nothing is sent, connecting
+    a UDP socket only picks the route.
+
+    Returns: str, ip address
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.connect((remote_host, int(remote_port)))
+        return probe.getsockname()[0]
+
+def cert_lfdi(der: bytes) -> str:
+    """
+    The 2030.5 long form device identifier of a certificate, the first
+    160 bits of the SHA-256 of its DER encoding.
+
+    Returns: str, 40 upper case hex digits
+    """
+    return hashlib.sha256(der).hexdigest()[:40].upper()
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status: int) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def do_POST(self):
+        push = self.server.push
+        if not push.is_meter(self.connection.getpeercert(binary_form=True)):
+            self.close_connection = True
+            self.reply(403)
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = -1
+        if not 0 <= length <= MAX_NOTIFICATION_SIZE:
+            # The body is left unread, so is the rest of the connection
+            logger.warning(f'Refused a notification of {self.headers.get("Content-Length")} bytes')
+            self.close_connection = True
+            self.reply(413)
+            return
+        body = self.rfile.read(length)
+        self.reply(push.handle_notification(body))
+
+    def log_message(self, format, *args):
+        pass
+
+class NotificationServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Mostly handshakes with a client that isn't the meter, no traceback for those
+        logger.warning(f'Notification from {client_address[0]} failed: {sys.exc_info()[1]}')
+
+class PushManager():
+    """
+    Optional 2030.5 push mode. Runs an HTTPS listener with the same
+    cert/key the meter knows us by, subscribes to each endpoint's
+    resource and feeds the notifications through the endpoint's parse
+    and publish path. Only the meter gets to post: the client has to
+    present a certificate that verifies against METER_CA_CERT, or the
+    certificate the meter serves when that isn't set, and whose lFDI
+    is the meter's. Endpoints the meter won't take a subscription for
+    are polled as usual, and a subscribed endpoint that stays quiet for
+    longer than stale_after is polled again until notifications resume.
+    Subscriptions that failed or were cancelled are retried every
+    retry_interval seconds.
+    """
+    def __init__(self, meter, creds: tuple, host: str = None, port: int = None,
+                 stale_after: float = None, retry_interval: float = None):
+        self.meter = meter
+        self.creds = creds
+        if host is None:
+            host = os.getenv('NOTIFY_HOST') or local_address(meter.ip_address, meter.port)
+        self.host = host
+        if port is None:
+            port = int(os.getenv('NOTIFY_PORT', '8443'))
+        self.port = port
+        if stale_after is None:
+            stale_after = float(os.getenv('PUSH_STALE_AFTER', '300'))
+        self.stale_after = stale_after
+        if retry_interval is None:
+            retry_interval = float(os.getenv('PUSH_RETRY_INTERVAL', '300'))
+        self.retry_interval = retry_interval
+        # {subscribed resource path: subscription location on the meter}
+        self.subscriptions = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._server = None
+
+    @property
+    def notify_uri(self) -> str:
+        return f'https://{self.host}:{self.port}{NOTIFY_PATH}'
+
+    @staticmethod
+    def resource_path(url: str) -> str:
+        return urlsplit(url).path
+
+    def endpoint_for(self, resource: str):
+        """
+        Returns: the meter's endpoint for the resource path, None if unknown
+        """
+        for obj in self.meter.endpoints:
+            if self.resource_path(obj.url) == resource:
+                return obj
+
+        return None
+
+    def is_meter(self, der: bytes | None) -> bool:
+        """
+        Checks that a client certificate belongs to the meter, by its lFDI.
+
+        Returns: bool, True if it's the meter's certificate
+        """
+        if not der:
+            logger.warning('Refused a notification without a client certificate')
+            return False
+        lfdi = cert_lfdi(der)
+        if lfdi != str(self.meter._lfdi).upper():
+            logger.warning(f'Refused a notification from lFDI {lfdi}, the meter is {self.meter._lfdi}')
+            return False
+
+        return True
+
+    def meter_ca(self) -> dict:
+        """
+        What the meter's client certificate has to verify against, the
+        METER_CA_CERT file, or else the certificate the meter serves on
+        its HTTPS port.
+
+        Returns: dict, keyword arguments for SSLContext.load_verify_locations
+        """
+        ca_file = os.getenv('METER_CA_CERT')
+        if ca_file:
+            return {'cafile': ca_file}
+        return {'cadata': ssl.get_server_certificate((self.meter.ip_address, int(self.meter.port)),
+                                                     timeout=15.0)}
+
+    def start_listener(self) -> None:
+        """
+        Starts the HTTPS notification listener in a background thread.
+
+        Returns: None
+        """
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*self.creds)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(**self.meter_ca())
+        # The meter's own certificate is enough to trust, whoever issued it
+        context.verify_flags |= ssl.VERIFY_X509_PARTIAL_CHAIN
+        self._server = NotificationServer(('', self.port), NotificationHandler)
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True,
+                                                  do_handshake_on_connect=False)
+        self._server.push = self
+        # Port 0 picks a free one
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever,
+                         name='xcel_notify', daemon=True).start()
+        logger.info(f'Listening for meter notifications on {self.notify_uri}')
+
+    def find_subscription_list(self) -> str | None:
+        """
+        Reads the SubscriptionListLink from /sdev, SUBSCRIPTION_LIST_URL
+        overrides it for meters that don't advertise one.
+
+        Returns: str, path of the subscription list, None if there's none
+        """
+        configured = os.getenv('SUBSCRIPTION_LIST_URL')
+        if configured:
+            return configured
+        try:
+            response = self.meter.requests_session.get(f'{self.meter.url}/sdev',
+                                                       verify=False, timeout=15.0)
+            response.raise_for_status()
+            link = ET.fromstring(response.content).find(f'.//{IEEE_PREFIX}{SUBSCRIPTION_LIST_LINK}')
+        except Exception as e:
+            logger.warning(f'Could not read /sdev for a subscription list: {e}')
+            return None
+
+        return link.get('href') if link is not None else None
+
+    def subscribe(self, list_path: str, obj) -> bool:
+        """
+        Posts a Subscription for the endpoint's resource. The meter has
+        to answer 201 Created, anything else counts as refused.
+
+        Returns: bool, True if the meter took the subscription
+        """
+        resource = self.resource_path(obj.url)
+        body = SUBSCRIPTION_TEMPLATE.format(resource=resource, notify_uri=self.notify_uri)
+        try:
+            response = self.meter.requests_session.post(f'{self.meter.url}{list_path}',
+                                                        data=body.encode('utf-8'),
+                                                        headers={'Content-Type': SEP_XML},
+                                                        verify=False, timeout=15.0)
+        except Exception as e:
+            logger.warning(f'Subscribing to {obj.name} failed, polling it instead: {e}')
+            return False
+        if response.status_code != 201:
+            logger.warning(f'Meter refused a subscription to {obj.name} '
+                           f'({response.status_code}), polling it instead')
+            return False
+        location = response.headers.get('Location')
+        if location:
+            location = self.resource_path(urljoin(f'{list_path}/', location))
+        with self._lock:
+            self.subscriptions[resource] = location
+        # No need to poll until it has had time to send the first notification
+        obj.pushed_until = monotonic() + self.stale_after
+        logger.info(f'Subscribed to {obj.name} at {resource}')
+
+        return True
+
+    def subscribe_all(self) -> int:
+        """
+        Subscribes every endpoint that isn't subscribed yet.
+
+        Returns: int, number of subscribed endpoints
+        """
+        list_path = self.find_subscription_list()
+        if list_path is None:
+            logger.warning('Meter has no subscription list, polling every endpoint')
+            return len(self.subscriptions)
+        for obj in list(self.meter.endpoints):
+            if self.resource_path(obj.url) not in self.subscriptions:
+                self.subscribe(list_path, obj)
+
+        return len(self.subscriptions)
+
+    def handle_notification(self, body: bytes) -> int:
+        """
+        Routes one notification to the endpoint it's for. A notification
+        that cancels the subscription puts the endpoint back on polling.
+
+        Returns: int, HTTP status to answer the meter with
+        """
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError as e:
+            logger.warning(f'Unreadable notification: {e}')
+            return 400
+        resource = root.findtext(f'{IEEE_PREFIX}subscribedResource')
+        obj = self.endpoint_for(resource) if resource else None
+        if obj is None:
+            logger.warning(f'Notification for unknown resource {resource}')
+            return 404
+        status = root.findtext(f'{IEEE_PREFIX}status', STATUS_DEFAULT)
+        if status != STATUS_DEFAULT:
+            with self._lock:
+                self.subscriptions.pop(resource, None)
+            obj.pushed_until = None
+            logger.warning(f'Meter cancelled the subscription to {obj.name} '
+                           f'(status {status}), polling it instead')
+            return 204
+        try:
+            obj.handle_notification(body, self.stale_after)
+        except Exception as e:
+            logger.warning(f'Failed to handle notification for {obj.name}: {e}')
+            return 400
+
+        return 204
+
+    def unsubscribe(self, resource: str) -> None:
+        """
+        Forgets the subscription to a resource and deletes it on the meter,
+        if the meter told us where it lives.
+
+        Returns: None
+        """
+        with self._lock:
+            location = self.subscriptions.pop(resource, None)
+        if not location:
+            return
+        try:
+            self.meter.requests_session.delete(f'{self.meter.url}{location}',
+                                               verify=False, timeout=4.0)
+        except Exception as e:
+            logger.debug(f'Could not delete subscription {location}: {e}')
+
+    def maintain(self) -> None:
+        """
+        Every retry_interval, subscribes again where a subscription failed,
+        was cancelled or has gone quiet, e.g. because the meter rebooted
+        and forgot it. Runs until stopped.
+
+        Returns: None
+        """
+        while not self._stopped.wait(self.retry_interval):
+            now = monotonic()
+            for resource in list(self.subscriptions):
+                obj = self.endpoint_for(resource)
+                if obj is None or obj.pushed_until is None or obj.pushed_until <= now:
+                    self.unsubscribe(resource)
+            if len(self.subscriptions) < len(self.meter.endpoints):
+                self.subscribe_all()
+
+    def start(self) -> int:
+        """
+        Starts the listener, subscribes what the meter allows and keeps
+        retrying the rest in the background.
+
+        Returns: int, number of subscribed endpoints
+        """
+        self.start_listener()
+        subscribed = self.subscribe_all()
+        logger.info(f'Push mode: {subscribed} of {len(self.meter.endpoints)} endpoints subscribed')
+        threading.Thread(target=self.maintain, name='xcel_push_maintain', daemon=True).start()
+
+        return subscribed
+
+    def stop(self) -> None:
+        """
+        Deletes our subscriptions on the meter and shuts the listener down.
+
+        Returns: None
+        """
+        self._stopped.set()
+        for resource in list(self.subscriptions):
+            self.unsubscribe(resource)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
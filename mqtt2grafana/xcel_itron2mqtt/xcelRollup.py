@@ -0,0 +1,171 @@
+import os
+import json
+import logging
+import threading
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# What an endpoint's `rollup` key in the endpoints yaml can say
+ROLLUP_KINDS = ('demand', 'energy')
+# Reading of an endpoint that gets aggregated
+VALUE_READING = 'value'
+
+def window_label(seconds: int) -> str:
+    """
+    e.g. 60 -> 1m, 900 -> 15m, 3600 -> 1h
+
+    Returns: str
+    """
+    if seconds % 3600 == 0:
+        return f'{seconds // 3600}h'
+    if seconds % 60 == 0:
+        return f'{seconds // 60}m'
+
+    return f'{seconds}s'
+
+class RollupWindow():
+    """
+    Running aggregates of one tumbling window, aligned to multiples of
+    its length. Constant size however many readings fall into it.
+    """
+    __slots__ = ('seconds', 'start', 'count', 'total', 'min', 'max', 'last',
+                 'energy_start', 'energy_last')
+
+    def __init__(self, seconds: int, start: int, energy_baseline: dict = None):
+        self.seconds = seconds
+        self.start = start
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        # {endpoint: summation when the window opened}, the previous window's last value
+        self.energy_start = dict(energy_baseline or {})
+        # {endpoint: latest summation in the window}
+        self.energy_last = {}
+
+    def add_demand(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.last = value
+
+    def add_energy(self, endpoint: str, value: float) -> None:
+        self.energy_start.setdefault(endpoint, value)
+        self.energy_last[endpoint] = value
+
+    def fields(self) -> dict:
+        """
+        Returns: dict of the window's aggregates, demand min/max/mean/last
+        and the energy delta of every summation
+        """
+        fields = {}
+        if self.count:
+            fields.update({
+                'demand_min': self.min,
+                'demand_max': self.max,
+                'demand_mean': round(self.total / self.count, 3),
+                'demand_last': self.last,
+                'demand_count': self.count,
+                })
+        for endpoint, last in self.energy_last.items():
+            delta = last - self.energy_start[endpoint]
+            # A summation that went backwards was reset or wrapped, no delta for this window
+            if delta >= 0:
+                fields[f'{endpoint}_delta'] = delta
+
+        return fields
+
+class RollupSink():
+    """
+    Endpoint sink that rolls the readings of one meter up into 1 and 15
+    minute windows (ROLLUP_WINDOWS): min/max/mean/last of the endpoints
+    marked `rollup: demand` in the endpoints yaml and the energy used in
+    the window for the `rollup: energy` summations. Every closed window
+    is published as JSON on <MQTT_BATCH_TOPIC_PREFIX><lFDI>/rollup_<1m|15m>
+    and written to the rollup_<1m|15m> measurement when InfluxDB output
+    is on, so long dashboard ranges read a few points per window instead
+    of every raw reading. Windows close when the first reading of the
+    next one comes in.
+    """
+    # Only aggregates what is happening now, backfilled history is left out
+    live_only = True
+
+    def __init__(self, mqtt_client, device_info: dict, windows: list = None,
+                 topic_prefix: str = None, influx=None):
+        self.client = mqtt_client
+        self.lfdi = device_info['device']['identifiers'][0]
+        if windows is None:
+            windows = self.windows_from_env()
+        self.windows = sorted(set(int(w) for w in windows))
+        if topic_prefix is None:
+            topic_prefix = os.getenv('MQTT_BATCH_TOPIC_PREFIX', 'xcel_itron5/')
+        self.topic_prefix = f'{topic_prefix}{self.lfdi}/'
+        self.influx = influx
+        self._lock = threading.Lock()
+        # {window seconds: RollupWindow being filled}
+        self._open = {}
+
+    @staticmethod
+    def windows_from_env() -> list:
+        """
+        Returns: list of window lengths in seconds, empty turns rollups off
+        """
+        value = os.getenv('ROLLUP_WINDOWS', '60,900')
+
+        return [int(w) for w in value.split(',') if w.strip()]
+
+    def write(self, endpoint, reading: dict) -> None:
+        """
+        Sink interface, adds the reading to every open window.
+
+        Returns: None
+        """
+        kind = getattr(endpoint, 'rollup', None)
+        if kind not in ROLLUP_KINDS:
+            return
+        try:
+            value = float(reading[VALUE_READING])
+        except (KeyError, TypeError, ValueError):
+            return
+        name = endpoint.name.replace(' ', '_')
+        now = time()
+        closed = []
+        with self._lock:
+            for seconds in self.windows:
+                start = int(now // seconds * seconds)
+                window = self._open.get(seconds)
+                if window is None or window.start != start:
+                    baseline = {}
+                    if window is not None:
+                        closed.append(window)
+                        baseline = dict(window.energy_start, **window.energy_last)
+                    window = self._open[seconds] = RollupWindow(seconds, start, baseline)
+                if kind == 'demand':
+                    window.add_demand(value)
+                else:
+                    window.add_energy(name, value)
+        for window in closed:
+            self.emit(window)
+
+    def emit(self, window: RollupWindow) -> None:
+        """
+        Publishes a closed window and writes it to InfluxDB.
+
+        Returns: None
+        """
+        fields = window.fields()
+        if not fields:
+            return
+        label = window_label(window.seconds)
+        document = {'lfdi': self.lfdi, 'window': window.seconds,
+                    'start': window.start, 'end': window.start + window.seconds}
+        document.update(fields)
+        result = self.client.publish(f'{self.topic_prefix}rollup_{label}',
+                                     json.dumps(document, separators=(',', ':')))
+        if result[0] != 0:
+            logger.warning(f'Rollup {label} of {self.lfdi} not published, rc {result[0]}')
+        if self.influx is not None:
+            self.influx.write_point(f'rollup_{label}', {'lfdi': self.lfdi}, fields, window.start)
@@ -0,0 +1,75 @@
+import heapq
+import random
+import logging
+from time import monotonic
+
+# Local imports
+from xcelMetrics import CYCLE_OVERRUNS
+
+logger = logging.getLogger(__name__)
+
+class PollScheduler():
+    """
+    Fixed cadence scheduler for the endpoints of one meter. Keeps a
+    priority queue of next-due times on the monotonic clock, so the
+    time spent querying never pushes the following polls back.
+
+    Every meter starts at a random phase within its first interval so a
+    fleet of meters doesn't hit the network in lockstep. When polling
+    falls behind, the missed ticks are skipped instead of being run back
+    to back.
+    """
+    def __init__(self, endpoints: list, default_interval: float, jitter: bool = True):
+        self._queue = []
+        self.default_interval = default_interval
+        # Counter keeps heap entries with equal due times from comparing endpoints
+        self._seq = 0
+        # {endpoint name: number of ticks skipped because we were behind}
+        self.skipped = {}
+        start = monotonic()
+        if jitter:
+            start += random.uniform(0, default_interval)
+        for obj in endpoints:
+            interval = obj.poll_interval or default_interval
+            self.skipped[obj.name] = 0
+            self._push(start, interval, obj)
+
+    def _push(self, due: float, interval: float, obj) -> None:
+        heapq.heappush(self._queue, (due, self._seq, interval, obj))
+        self._seq += 1
+
+    def next_due(self) -> float:
+        """
+        Returns: float, monotonic time of the earliest due endpoint, an
+        interval from now if there are none
+        """
+        if not self._queue:
+            return monotonic() + self.default_interval
+        return self._queue[0][0]
+
+    def pop_due(self, now: float = None) -> list:
+        """
+        Takes every endpoint that's due and schedules its next tick on
+        the fixed grid, skipping any ticks that already passed.
+
+        Returns: list of the endpoints to poll now
+        """
+        if now is None:
+            now = monotonic()
+        due_endpoints = []
+        while self._queue and self._queue[0][0] <= now:
+            due, _, interval, obj = heapq.heappop(self._queue)
+            next_due = due + interval
+            if next_due <= now:
+                missed = int((now - next_due) // interval) + 1
+                next_due += missed * interval
+                self.record_skip(obj, missed)
+            self._push(next_due, interval, obj)
+            due_endpoints.append(obj)
+
+        return due_endpoints
+
+    def record_skip(self, obj, count: int = 1) -> None:
+        self.skipped[obj.name] = self.skipped.get(obj.name, 0) + count
+        CYCLE_OVERRUNS.inc(count, meter=obj.meter_name, endpoint=obj.name)
+        logger.warning(f'{obj.name} fell behind, skipped {count} poll(s)')
@@ -0,0 +1,337 @@
+import os
+import json
+import mmap
+import struct
+import logging
+import threading
+import paho.mqtt.client as mqtt
+from pathlib import Path
+from time import time, sleep, monotonic
+
+# Local imports
+from xcelPublish import wrap_pipeline
+
+logger = logging.getLogger(__name__)
+
+# magic, timestamp, qos, retain, topic length, payload length
+RECORD_HEADER = struct.Struct('<2sdBBHI')
+RECORD_MAGIC = b'XS'
+SEGMENT_SUFFIX = '.spool'
+CURSOR_FILE = 'cursor'
+
+class SpoolRing():
+    """
+    Bounded on-disk ring of MQTT messages. Messages are appended to
+    fixed-size memory-mapped segment files. When the size cap is reached,
+    the oldest segment is evicted. Reading walks the ring oldest first,
+    and the read cursor is persisted so a restart resumes where replay
+    left off.
+    """
+    def __init__(self, directory: str, segment_size: int = 4 * 1024 * 1024,
+                 max_segments: int = 16):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        # {segment number: mmap}, oldest first
+        self._segments = {}
+        self._write_segment = None
+        self._write_offset = 0
+        self.evicted = 0
+        self._open_existing()
+        self._read_segment, self._read_offset = self._load_cursor()
+
+    # Segment handling, all called with the lock held or during __init__
+    def _segment_path(self, number: int) -> Path:
+        return self.directory / f'{number:010d}{SEGMENT_SUFFIX}'
+
+    def _map_segment(self, number: int) -> mmap.mmap:
+        path = self._segment_path(number)
+        with open(path, 'a+b') as file:
+            if os.fstat(file.fileno()).st_size < self.segment_size:
+                file.truncate(self.segment_size)
+            return mmap.mmap(file.fileno(), self.segment_size)
+
+    def _scan(self, segment: mmap.mmap, offset: int = 0):
+        """
+        Yields (offset, next offset, record) for each record in a segment
+        """
+        while offset + RECORD_HEADER.size <= self.segment_size:
+            magic, timestamp, qos, retain, topic_len, payload_len = \
+                RECORD_HEADER.unpack_from(segment, offset)
+            if magic != RECORD_MAGIC:
+                return
+            start = offset + RECORD_HEADER.size
+            end = start + topic_len + payload_len
+            if end > self.segment_size:
+                return
+            topic = bytes(segment[start:start + topic_len]).decode('utf-8')
+            payload = bytes(segment[start + topic_len:end])
+            yield offset, end, (timestamp, topic, payload, qos, bool(retain))
+            offset = end
+
+    def _open_existing(self) -> None:
+        numbers = sorted(int(path.stem) for path in self.directory.glob(f'*{SEGMENT_SUFFIX}'))
+        for number in numbers:
+            self._segments[number] = self._map_segment(number)
+        if not numbers:
+            self._new_segment(0)
+            return
+        # Find where the newest segment stopped being written
+        self._write_segment = numbers[-1]
+        self._write_offset = 0
+        for _, end, _ in self._scan(self._segments[self._write_segment]):
+            self._write_offset = end
+
+    def _new_segment(self, number: int) -> None:
+        self._segments[number] = self._map_segment(number)
+        self._write_segment = number
+        self._write_offset = 0
+        while len(self._segments) > self.max_segments:
+            self._evict_oldest()
+
+    def _evict_oldest(self) -> None:
+        number = min(self._segments)
+        segment = self._segments.pop(number)
+        dropped = sum(1 for _ in self._scan(segment))
+        segment.close()
+        self._segment_path(number).unlink(missing_ok=True)
+        self.evicted += dropped
+        logger.warning(f'MQTT spool full, dropped {dropped} oldest messages')
+        if getattr(self, '_read_segment', None) is not None and self._read_segment <= number:
+            self._read_segment, self._read_offset = min(self._segments), 0
+
+    def _load_cursor(self) -> tuple:
+        try:
+            number, offset = (self.directory / CURSOR_FILE).read_text().split()
+            number, offset = int(number), int(offset)
+            if number in self._segments:
+                return number, offset
+        except (FileNotFoundError, ValueError):
+            pass
+        return min(self._segments), 0
+
+    def _save_cursor(self) -> None:
+        tmp = self.directory / f'{CURSOR_FILE}.tmp'
+        tmp.write_text(f'{self._read_segment} {self._read_offset}')
+        tmp.replace(self.directory / CURSOR_FILE)
+
+    # Public API
+    def append(self, topic: str, payload: bytes, qos: int = 0, retain: bool = False,
+               timestamp: float = None) -> bool:
+        """
+        Stores a message at the end of the ring.
+
+        Returns: bool, False if the message can never fit in a segment
+        """
+        if timestamp is None:
+            timestamp = time()
+        topic_bytes = topic.encode('utf-8')
+        size = RECORD_HEADER.size + len(topic_bytes) + len(payload)
+        if size > self.segment_size:
+            logger.error(f'Message for {topic} too large to spool ({size} bytes)')
+            return False
+        with self._lock:
+            if self._write_offset + size > self.segment_size:
+                segment = self._segments[self._write_segment]
+                # Mark the unused tail so scanning stops there
+                if self._write_offset + RECORD_HEADER.size <= self.segment_size:
+                    segment[self._write_offset:self._write_offset + 2] = b'\0\0'
+                self._new_segment(self._write_segment + 1)
+            segment = self._segments[self._write_segment]
+            offset = self._write_offset
+            RECORD_HEADER.pack_into(segment, offset, RECORD_MAGIC, timestamp, qos,
+                                    int(retain), len(topic_bytes), len(payload))
+            start = offset + RECORD_HEADER.size
+            segment[start:start + len(topic_bytes)] = topic_bytes
+            segment[start + len(topic_bytes):start + size - RECORD_HEADER.size] = payload
+            self._write_offset = offset + size
+            # Make sure a stale record right behind us can't be read as ours
+            if self._write_offset + 2 <= self.segment_size:
+                segment[self._write_offset:self._write_offset + 2] = b'\0\0'
+
+        return True
+
+    def empty(self) -> bool:
+        with self._lock:
+            return (self._read_segment, self._read_offset) == (self._write_segment, self._write_offset)
+
+    def read_batch(self, limit: int) -> tuple:
+        """
+        Reads up to `limit` of the oldest messages without consuming them.
+
+        Returns: tuple of (list of records, opaque position to commit)
+        """
+        records = []
+        with self._lock:
+            number, offset = self._read_segment, self._read_offset
+            while len(records) < limit:
+                for _, end, record in self._scan(self._segments[number], offset):
+                    if (number, end) > (self._write_segment, self._write_offset):
+                        break
+                    records.append(record)
+                    offset = end
+                    if len(records) >= limit:
+                        break
+                if len(records) >= limit or number == self._write_segment:
+                    break
+                # Rest of this segment is done, carry on in the next one
+                number, offset = number + 1, 0
+
+        return records, (number, offset)
+
+    def commit(self, position: tuple) -> None:
+        """
+        Consumes everything up to a position returned by read_batch,
+        deleting segments that were fully replayed.
+
+        Returns: None
+        """
+        with self._lock:
+            number, offset = position
+            if number not in self._segments:
+                # Evicted while we were replaying it
+                return
+            for old in [n for n in self._segments if n < number]:
+                self._segments.pop(old).close()
+                self._segment_path(old).unlink(missing_ok=True)
+            self._read_segment, self._read_offset = number, offset
+            self._save_cursor()
+
+    def close(self) -> None:
+        with self._lock:
+            for segment in self._segments.values():
+                segment.flush()
+                segment.close()
+            self._segments = {}
+
+def replay_message(topic: str, payload: bytes, timestamp: float, prefix: str) -> tuple:
+    """
+    A bare per sensor value would be stored at the time it is replayed,
+    so it goes out as {"value": ..., "time": <when it was spooled>} on
+    <prefix><topic> instead, for Telegraf's spool inputs. Documents that
+    carry their own time (PAYLOAD_MODE=json/msgpack) go out as they are.
+
+    Returns: tuple of topic and payload
+    """
+    if not prefix or payload[:1] == b'{':
+        return topic, payload
+    try:
+        text = payload.decode('utf-8')
+    except UnicodeDecodeError:
+        return topic, payload
+    try:
+        value = float(text)
+    except ValueError:
+        value = text
+
+    return f'{prefix}{topic}', json.dumps({'value': value, 'time': round(timestamp, 3)})
+
+class SpoolingClient():
+    """
+    Stands in for the paho client in the publish path. Publishes go
+    straight through while the broker is reachable. While it's down, or
+    while older messages are still waiting, they go to the disk spool
+    instead. A background thread replays the spool in rate limited
+    batches once paho reconnects, see replay_message() for how readings
+    keep their original time.
+    """
+    def __init__(self, client: mqtt.Client, spool: SpoolRing,
+                 batch_size: int = None, replay_rate: float = None):
+        self.client = client
+        self.spool = spool
+        self.batch_size = batch_size or int(os.getenv('SPOOL_BATCH_SIZE', 500))
+        # Messages per second during replay
+        self.replay_rate = replay_rate or float(os.getenv('SPOOL_REPLAY_RATE', 1000))
+        # Per sensor values are replayed with their timestamp below this prefix,
+        # empty replays them bare on their own topic
+        self.replay_prefix = os.getenv('SPOOL_REPLAY_TOPIC_PREFIX', 'spool/')
+        self.spooled = 0
+        self.replayed = 0
+        self._wakeup = threading.Event()
+        self._on_connect = client.on_connect
+        client.on_connect = self._handle_connect
+        self._thread = threading.Thread(target=self._replay_loop, name='xcel_spool', daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, name):
+        # Anything else is the real client's business
+        return getattr(self.client, name)
+
+    def _handle_connect(self, client, userdata, flags, rc):
+        if self._on_connect:
+            self._on_connect(client, userdata, flags, rc)
+        if rc == 0:
+            self._wakeup.set()
+
+    def publish(self, topic: str, payload=None, qos: int = 0, retain: bool = False):
+        """
+        Same signature and return value as paho's publish, except that
+        spooled messages report success with a mid of 0.
+
+        Returns: mqtt.MQTTMessageInfo
+        """
+        if self.client.is_connected() and self.spool.empty():
+            result = self.client.publish(topic, payload, qos=qos, retain=retain)
+            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                return result
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif payload is None:
+            payload = b''
+        elif not isinstance(payload, (bytes, bytearray)):
+            payload = str(payload).encode('utf-8')
+        result = mqtt.MQTTMessageInfo(0)
+        result.rc = mqtt.MQTT_ERR_SUCCESS if self.spool.append(topic, payload, qos, retain) \
+            else mqtt.MQTT_ERR_QUEUE_SIZE
+        if result.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.spooled += 1
+            self._wakeup.set()
+        return result
+
+    def _replay_loop(self) -> None:
+        while True:
+            self._wakeup.wait(timeout=5.0)
+            self._wakeup.clear()
+            while self.client.is_connected() and not self.spool.empty():
+                started = monotonic()
+                records, position = self.spool.read_batch(self.batch_size)
+                sent = 0
+                for timestamp, topic, payload, qos, retain in records:
+                    if not retain:
+                        topic, payload = replay_message(topic, payload, timestamp, self.replay_prefix)
+                    result = self.client.publish(topic, payload, qos=qos, retain=retain)
+                    if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                        break
+                    sent += 1
+                if sent < len(records):
+                    # Lost the broker mid batch, replay all of it again next time
+                    logger.warning('Broker went away during spool replay')
+                    break
+                self.spool.commit(position)
+                self.replayed += sent
+                if records:
+                    logger.info(f'Replayed {sent} spooled messages, oldest from '
+                                f'{time() - records[0][0]:.0f}s ago')
+                # Stay under the replay rate
+                remaining = sent / self.replay_rate - (monotonic() - started)
+                if remaining > 0:
+                    sleep(remaining)
+
+def wrap_client(client: mqtt.Client, name: str) -> mqtt.Client:
+    """
+    Puts a SpoolingClient in front of the given client when SPOOL_DIR is
+    set, using its own folder below SPOOL_DIR, and the publish pipeline
+    in front of that.
+
+    Returns: the wrapped client, or the client as is
+    """
+    spool_dir = os.getenv('SPOOL_DIR')
+    if not spool_dir:
+        return wrap_pipeline(client, name)
+    spool = SpoolRing(Path(spool_dir) / name.replace(' ', '_').lower(),
+                      segment_size=int(os.getenv('SPOOL_SEGMENT_SIZE', 4 * 1024 * 1024)),
+                      max_segments=int(os.getenv('SPOOL_MAX_SEGMENTS', 16)))
+
+    return wrap_pipeline(SpoolingClient(client, spool), name)
@@ -0,0 +1,120 @@
+import os
+import ssl
+import logging
+import threading
+from requests.adapters import HTTPAdapter
+
+# Our target cipher is: ECDHE-ECDSA-AES128-CCM8
+CIPHERS = ('ECDHE')
+# Keep-alive connections held open to a single meter
+DEFAULT_POOL_SIZE = 4
+
+logger = logging.getLogger(__name__)
+
+class TransportStats():
+    """
+    Thread safe counters for the connections made to a meter. In steady
+    state every request should reuse a kept-alive connection, and any
+    reconnect should resume the previous TLS session instead of running
+    a full ECDHE handshake.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.full_handshakes = 0
+        self.resumed_handshakes = 0
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def record_handshake(self, resumed: bool) -> None:
+        with self._lock:
+            if resumed:
+                self.resumed_handshakes += 1
+            else:
+                self.full_handshakes += 1
+
+    def snapshot(self) -> dict:
+        """
+        Returns: dict of the current counters
+        """
+        with self._lock:
+            connections = self.full_handshakes + self.resumed_handshakes
+            return {
+                'requests': self.requests,
+                'connections': connections,
+                'reused_connections': max(self.requests - connections, 0),
+                'full_handshakes': self.full_handshakes,
+                'resumed_handshakes': self.resumed_handshakes,
+                }
+
+class ResumingSSLContext(ssl.SSLContext):
+    """
+    SSLContext that offers the meter's last TLS session on every new
+    connection, so reconnects resume it rather than redoing the ECDHE
+    handshake, and reports each handshake to the TransportStats.
+    """
+    def __new__(cls, stats: TransportStats):
+        return super().__new__(cls, ssl.PROTOCOL_TLS_CLIENT)
+
+    def __init__(self, stats: TransportStats):
+        self.stats = stats
+        self._session_lock = threading.Lock()
+        self._session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        with self._session_lock:
+            session = self._session
+        if session is not None and kwargs.get('session') is None:
+            kwargs['session'] = session
+        conn = super().wrap_socket(sock, *args, **kwargs)
+        self.stats.record_handshake(conn.session_reused)
+        with self._session_lock:
+            self._session = conn.session
+        if conn.session_reused:
+            logger.debug('Resumed TLS session with the meter')
+        elif session is not None:
+            logger.info('Meter refused TLS session resumption, did a full handshake')
+
+        return conn
+
+class MeterAdapter(HTTPAdapter):
+    """
+    A TransportAdapter that re-enables ECDHE support in Requests and
+    keeps a bounded pool of kept-alive connections to one meter.
+    From https://lukasa.co.uk/2017/02/Configuring_TLS_With_Requests/
+
+    The ssl context is created once per adapter so the TLS session
+    cache is shared by every connection in the pool.
+    """
+    def __init__(self, pool_size: int = None):
+        if pool_size is None:
+            pool_size = int(os.getenv('METER_POOL_SIZE', DEFAULT_POOL_SIZE))
+        self.stats = TransportStats()
+        self.ssl_context = self.create_ssl_context(self.stats)
+        # pool_block stops bursts from opening throwaway connections
+        super(MeterAdapter, self).__init__(pool_connections=1, pool_maxsize=pool_size,
+                                           pool_block=True)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(MeterAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        kwargs['ssl_context'] = self.ssl_context
+        return super(MeterAdapter, self).proxy_manager_for(*args, **kwargs)
+
+    def send(self, *args, **kwargs):
+        self.stats.record_request()
+        return super(MeterAdapter, self).send(*args, **kwargs)
+
+    @staticmethod
+    def create_ssl_context(stats: TransportStats) -> ResumingSSLContext:
+        context = ResumingSSLContext(stats)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.maximum_version = ssl.TLSVersion.TLSv1_2
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.set_ciphers(CIPHERS)
+        return context
@@ -1,45 +1,75 @@
 import xml.etree.ElementTree as ET
 import json
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import os
 
+
+NS = {'ns': 'urn:ieee:std:2030.5:ns'}
+SIMULATOR_PORT = 8082
+
+
+def extractText(root, element_name, default):
+    """Text of a direct child of the 2030.5 root element, default if it's missing or empty"""
+    elem = root.find(f'ns:{element_name}', NS)
+    return elem.text if elem is not None and elem.text is not None else default
+
+
+class SimulatorClient:
+    """
+    One meterSimulator host. Keeps a pool of kept-alive connections to it
+    and remembers its sFDI, which never changes, after the first /sdev.
+    """
+
+    def __init__(self, host, port=SIMULATOR_PORT, pool_size=10, timeout=5):
+        self.base_url = f'http://{host}:{port}'
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount(f'{self.base_url}/', adapter)
+        self._sFDI = None
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        response = self.session.get(f'{self.base_url}{path}', timeout=self.timeout)
+        response.raise_for_status()
+        return ET.fromstring(response.content)
+
+    def getInstantaneousMeterReading(self, meterReadingId=1):
+        """Value and touTier of one meterReadingId"""
+        root = self.get(f'/upt/0/mr/{meterReadingId}/r')
+        return float(extractText(root, 'value', '0')), int(extractText(root, 'touTier', '0'))
+
+    def getDeviceID(self, refresh=False):
+        """sFDI of the simulator, only asked for once unless refresh is set"""
+        with self._lock:
+            if self._sFDI is None or refresh:
+                self._sFDI = extractText(self.get('/sdev'), 'sFDI', '')
+            return self._sFDI
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def getClient(host=None):
+    """Shared client of a simulator host, HOST_IP by default"""
+    host = host or os.getenv('HOST_IP', 'localhost')
+    with _clients_lock:
+        if host not in _clients:
+            _clients[host] = SimulatorClient(host)
+        return _clients[host]
+
+
 def getInstantaneousMeterReading(meterReadingId=1):
     """Get meter reading from simulator endpoint and return value and touTier"""
-    host_ip = os.getenv('HOST_IP', 'localhost')
-    url = f'http://{host_ip}:8082/upt/0/mr/{meterReadingId}/r'
-    
-    response = requests.get(url, timeout=5)
-    xml_data = response.text
-    
-    # Parse XML
-    root = ET.fromstring(xml_data)
-    ns = {'ns': 'urn:ieee:std:2030.5:ns'}
-    
-    # Helper function to extract text from XML element with fallback to default value
-    def extractValue(element_name, default='0'):
-        elem = root.find(f'ns:{element_name}', ns)
-        return elem.text if elem is not None and elem.text is not None else default
-    
-    # Return both value and touTier
-    return float(extractValue('value')), int(extractValue('touTier'))
+    return getClient().getInstantaneousMeterReading(meterReadingId)
 
 
 def getDeviceID():
     """Get device ID from simulator endpoint and return sFDI"""
-    host_ip = os.getenv('HOST_IP', 'localhost')
-    url = f'http://{host_ip}:8082/sdev'
-    
-    response = requests.get(url, timeout=5)
-    xml_data = response.text
-    
-    # Parse XML
-    root = ET.fromstring(xml_data)
-    ns = {'ns': 'urn:ieee:std:2030.5:ns'}
-    
-    # Helper function to extract text from XML element with fallback to default value
-    def extract_sFDI(element_name, default=''):
-        elem = root.find(f'ns:{element_name}', ns)
-        return elem.text if elem is not None and elem.text is not None else default
-    
-    # Return just the sFDI value
-    return extract_sFDI('sFDI')
\ No newline at end of file
+    return getClient().getDeviceID()
@@ -0,0 +1,248 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import queue
+import random
+import sys
+import time
+from array import array
+from mqttPublisher import MqttPublisher
+
+
+"""
+
+loadGenerator.py
+
+
+- pretends to be N meters publishing at a chosen total message rate
+- uses the same topics the mosquitto -> telegraf -> influx stack subscribes to
+- spreads the meters over several processes, each with one MQTT connection
+- reports achieved throughput and publish-ack latency percentiles
+
+needs no simulator, only a reachable broker, e.g.
+
+    python loadGenerator.py --meters 500 --rate 2000 --duration 60 --processes 4
+
+"""
+
+
+# Topics of a single meter, the ones telegraf.conf and Home Assistant listen on,
+# as (shared topic, per-meter topic, reading)
+PROFILES = {
+    'simulator': [
+        ('xcel_itron5/sFDI/Power_Demand/state',
+         'xcel_itron5/{meter}/Power_Demand/state', 'demand'),
+    ],
+    'homeassistant': [
+        ('homeassistant/sensor/Instantaneous_Demand/value/state',
+         'homeassistant/sensor/{meter}/Instantaneous_Demand/value/state', 'demand'),
+        ('homeassistant/sensor/Current_Summation_Received/value/state',
+         'homeassistant/sensor/{meter}/Current_Summation_Received/value/state', 'received'),
+        ('homeassistant/sensor/Current_Summation_Delivered/value/state',
+         'homeassistant/sensor/{meter}/Current_Summation_Delivered/value/state', 'delivered'),
+    ],
+}
+
+
+class FakeMeter:
+    """Random walk readings for one pretend meter"""
+
+    def __init__(self, meter_id, topics, per_meter_topics):
+        self.topics = []
+        for shared_topic, meter_topic, kind in topics:
+            # e.g. xcel_itron5/meter_7/Power_Demand/state
+            topic = meter_topic.format(meter=f"meter_{meter_id}") if per_meter_topics else shared_topic
+            self.topics.append((topic, kind))
+        self.demand = random.uniform(300, 4000)
+        self.received = random.uniform(0, 1e5)
+        self.delivered = random.uniform(1e5, 1e7)
+
+    def messages(self):
+        """One reading per topic of the meter"""
+        self.demand = max(0.0, self.demand + random.gauss(0, 50))
+        self.delivered += self.demand * 5 / 3600
+        values = {'demand': round(self.demand, 1),
+                  'received': round(self.received),
+                  'delivered': round(self.delivered)}
+        return [(topic, str(values[kind])) for topic, kind in self.topics]
+
+
+def run_worker(worker_id, meter_ids, rate, duration, args, results):
+    """Publish for `duration` seconds at `rate` msg/s, then report back"""
+    latencies = array('d')
+
+    def on_publish(client, userdata, mid, latency):
+        latencies.append(latency)
+
+    publisher = MqttPublisher(args.host, args.port, qos=args.qos,
+                              max_inflight=args.max_inflight, on_publish=on_publish)
+    try:
+        publisher.connect()
+    except TimeoutError as e:
+        results.put({'worker': worker_id, 'error': str(e)})
+        return
+
+    meters = [FakeMeter(i, PROFILES[args.profile], args.per_meter_topics) for i in meter_ids]
+    interval = 1.0 / rate
+    start = time.monotonic()
+    next_send = start
+    end = start + duration
+    index = 0
+    pending = []
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+        if now < next_send:
+            time.sleep(min(next_send - now, 0.005))
+            continue
+        # Send everything that's due, catching up in a burst if we fell behind
+        while next_send <= now:
+            if not pending:
+                pending = meters[index % len(meters)].messages()
+                index += 1
+            publisher.publish(*pending.pop())
+            next_send += interval
+
+    sent_elapsed = time.monotonic() - start
+    publisher.close(timeout=args.drain_timeout)
+    elapsed = time.monotonic() - start
+    results.put({
+        'worker': worker_id,
+        'sent': publisher.published,
+        'failed': publisher.failed,
+        'acked': len(latencies),
+        'unacked': publisher.inflight(),
+        'send_seconds': sent_elapsed,
+        'seconds': elapsed,
+        'latencies': latencies.tobytes(),
+    })
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted sequence"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def collect_reports(workers, results, timeout):
+    """
+    One report per worker, giving up on workers that exit without one
+    (e.g. crashed) instead of waiting for them forever. Returns the
+    reports and {worker id: why it has none}
+    """
+    reports = {}
+    deadline = time.monotonic() + timeout
+    while len(reports) < len(workers) and time.monotonic() < deadline:
+        try:
+            report = results.get(timeout=1.0)
+        except queue.Empty:
+            # A worker flushes its report before it exits, so once they are all
+            # gone and the queue stays empty nothing else is coming
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        reports[report['worker']] = report
+    missing = {}
+    for worker_id, worker in enumerate(workers):
+        report = reports.get(worker_id)
+        if report is not None and 'error' in report:
+            missing[worker_id] = report['error']
+        elif report is None:
+            missing[worker_id] = (f"exited with code {worker.exitcode}" if worker.exitcode is not None
+                                  else "no report before the timeout")
+    return [report for report in reports.values() if 'error' not in report], missing
+
+
+def summarize(reports, args):
+    """Merge the per-process reports into one result"""
+    latencies = array('d')
+    for report in reports:
+        latencies.frombytes(report['latencies'])
+    ordered = sorted(latencies)
+    # Publishing only, against the target, and with the wait for the last acks
+    send_seconds = max(report['send_seconds'] for report in reports)
+    seconds = max(report['seconds'] for report in reports)
+    sent = sum(report['sent'] for report in reports)
+    acked = sum(report['acked'] for report in reports)
+    summary = {
+        'meters': args.meters,
+        'processes': len(reports),
+        'qos': args.qos,
+        'target_rate': args.rate,
+        'duration': args.duration,
+        'sent': sent,
+        'acked': acked,
+        'failed': sum(report['failed'] for report in reports),
+        'unacked': sum(report['unacked'] for report in reports),
+        'achieved_rate': sent / send_seconds if send_seconds else 0.0,
+        'acked_rate': acked / seconds if seconds else 0.0,
+        'latency_ms': {},
+    }
+    for pct in (50, 90, 99, 99.9):
+        value = percentile(ordered, pct)
+        summary['latency_ms'][f'p{pct}'] = round(value * 1000, 3) if value is not None else None
+    summary['latency_ms']['max'] = round(ordered[-1] * 1000, 3) if ordered else None
+    return summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='MQTT load generator for the I2M2G stack')
+    parser.add_argument('--host', default=os.getenv('MQTT_SERVER', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('MQTT_PORT', '1883')))
+    parser.add_argument('--meters', type=int, default=100, help='number of pretend meters')
+    parser.add_argument('--rate', type=float, default=1000.0, help='total messages per second')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds to publish for')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--qos', type=int, choices=(0, 1, 2), default=1,
+                        help='QoS 0 only measures time to socket write, 1/2 measure the broker ack')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='simulator')
+    parser.add_argument('--per-meter-topics', action='store_true',
+                        help='put the meter id in the topic instead of sharing the stack topics')
+    parser.add_argument('--max-inflight', type=int, default=1000)
+    parser.add_argument('--drain-timeout', type=float, default=10.0)
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    processes = max(1, min(args.processes, args.meters))
+    results = mp.Queue()
+    workers = []
+    for worker_id in range(processes):
+        meter_ids = list(range(worker_id, args.meters, processes))
+        worker = mp.Process(target=run_worker,
+                            args=(worker_id, meter_ids, args.rate / processes,
+                                  args.duration, args, results))
+        worker.start()
+        workers.append(worker)
+
+    # Drain the queue before joining so big latency payloads can't block the workers,
+    # allowing for the connect timeout and the drain on top of the run itself
+    reports, missing = collect_reports(workers, results,
+                                       args.duration + args.drain_timeout + 30.0)
+    for worker in workers:
+        worker.join(timeout=5.0)
+        if worker.is_alive():
+            worker.terminate()
+    for worker_id, reason in sorted(missing.items()):
+        print(f"Worker {worker_id} did not report: {reason}", file=sys.stderr)
+    if not reports:
+        sys.exit("No worker reported, nothing to summarize")
+
+    summary = summarize(reports, args)
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        print(f"Meters: {summary['meters']}  Processes: {summary['processes']}  QoS: {summary['qos']}")
+        print(f"Target rate: {summary['target_rate']:.0f} msg/s  "
+              f"Achieved send rate: {summary['achieved_rate']:.0f} msg/s  "
+              f"Acked rate incl. drain: {summary['acked_rate']:.0f} msg/s")
+        print(f"Sent: {summary['sent']}  Acked: {summary['acked']}  "
+              f"Failed: {summary['failed']}  Unacked: {summary['unacked']}")
+        print("Publish-ack latency (ms): " + "  ".join(
+            f"{name}={value}" for name, value in summary['latency_ms'].items()))
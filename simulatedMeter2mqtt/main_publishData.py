@@ -26,7 +26,8 @@ what it needs:
 import paho.mqtt.client as mqtt
 import os
 import logging
-import yaml
+from mqttPublisher import MqttPublisher
+from eventLog import setup_logging, log_event
 
 
 """
@@ -35,169 +36,96 @@ publisher.py
 
 
 - this code pubslises readings from simulator to MQTT broker
-- uses config.yml for output formatting style 
+- uses the output_level profile of config.yml for what gets logged, see eventLog.py
 
 """
 
-# Load configuration
-
-
-def load_config():
-    """Load configuration from config.yml"""
-    try:
-        with open('config.yml', 'r') as file:
-            return yaml.safe_load(file)
-    except FileNotFoundError:
-        # Default configuration if file doesn't exist
-        return {
-            'output_level': 'bare_minimum',
-            'formats': {
-                'bare_minimum': {
-                    'show_connection': False,
-                    'show_topic': False,
-                    'show_message_id': False,
-                    'show_docker_info': False,
-                    'show_success_only': True,
-                    'emoji': False,
-                    'minimal_logging': True
-                }
-            }
-        }
-
-
-# Load config
-config = load_config()
-output_config = config['formats'].get(
-    config['output_level'], config['formats']['bare_minimum'])
-
-# Set up logging based on config
-if output_config.get('minimal_logging', False):
-    # Minimal logging - only show errors
-    logging.basicConfig(level=logging.ERROR, format='%(message)s')
-else:
-    # Normal logging
-    logging.basicConfig(level=logging.INFO)
+# Load config, and route logging through the shared non-blocking layer
+output_config = setup_logging()
 logger = logging.getLogger(__name__)
 
 
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the broker"""
-    if not output_config['show_connection']:
-        return
-
     if rc == 0:
-        status = "✅ Connected to MQTT broker" if output_config[
-            'emoji'] else "Connected to MQTT broker"
-        logger.info(status)
+        log_event('connect', "Connected to MQTT broker")
     else:
-        status = f"❌ MQTT connection failed (code: {rc})" if output_config[
-            'emoji'] else f"MQTT connection failed (code: {rc})"
-        logger.error(status)
+        log_event('connect', "MQTT connection failed", logging.ERROR,
+                  rc=rc, error=mqtt.connack_string(rc))
 
 
-def on_publish(client, userdata, mid):
+def on_publish(client, userdata, mid, latency=0.0):
     """Callback for when a message is published"""
-    if output_config['show_message_id']:
-        status = f"✅ Message published (ID: {mid})" if output_config[
-            'emoji'] else f"Message published (ID: {mid})"
-    else:
-        status = "✅ Message published" if output_config['emoji'] else "Message published"
-    logger.info(status)
+    log_event('ack', "Message published", mid=mid, latency_ms=round(latency * 1000, 1))
 
 
 def on_disconnect(client, userdata, rc):
     """Callback for when the client disconnects from the broker"""
-    if rc != 0 and not output_config['show_success_only']:
-        status = f"⚠️ MQTT disconnected (code: {rc})" if output_config[
-            'emoji'] else f"MQTT disconnected (code: {rc})"
-        logger.warning(status)
+    if rc != 0 and not output_config.get('show_success_only', False):
+        log_event('disconnect', "MQTT disconnected", logging.WARNING,
+                  rc=rc, error=mqtt.error_string(rc))
 
 
-def publish_to_mqtt(value, sFDI):
-    """Publish only the value to MQTT topic"""
-    try:
-        # Create MQTT client
-        client = mqtt.Client()
-
-        # Set up callbacks
-        client.on_connect = on_connect
-        client.on_publish = on_publish
-        client.on_disconnect = on_disconnect
-
-        # Get MQTT configuration from environment
-        # Check if we're running in a container or locally
-        if os.path.exists('/.dockerenv'):
-            # Running inside Docker container
-            mqtt_host = os.getenv('MQTT_SERVER', 'xcel_itron2mqtt')
-        else:
-            # Running locally - connect to Mosquitto container on localhost
-            mqtt_host = os.getenv('MQTT_SERVER', 'localhost')
+_publisher = None
+
 
-        mqtt_port = int(os.getenv('MQTT_PORT', '1883'))
-        topic_prefix = os.getenv('MQTT_METER_TOPIC_PREFIX', 'xcel_itron_5')
+def get_publisher():
+    """Return the shared MQTT publisher, connecting it on first use"""
+    global _publisher
+    if _publisher is not None:
+        return _publisher
 
-        # Show Docker info if configured
-        if output_config['show_docker_info']:
-            env_info = "inside Docker" if os.path.exists(
-                '/.dockerenv') else "locally"
-            logger.info(f"🌐 Running {env_info}")
+    # Get MQTT configuration from environment
+    # Check if we're running in a container or locally
+    if os.path.exists('/.dockerenv'):
+        # Running inside Docker container
+        mqtt_host = os.getenv('MQTT_SERVER', 'xcel_itron2mqtt')
+    else:
+        # Running locally - connect to Mosquitto container on localhost
+        mqtt_host = os.getenv('MQTT_SERVER', 'localhost')
+
+    mqtt_port = int(os.getenv('MQTT_PORT', '1883'))
+
+    log_event('environment', "Running inside Docker" if os.path.exists('/.dockerenv')
+              else "Running locally", host=mqtt_host, port=mqtt_port)
+
+    # Connect once, paho reconnects by itself if the broker goes away
+    publisher = MqttPublisher(mqtt_host, mqtt_port, 60,
+                              on_connect=on_connect,
+                              on_disconnect=on_disconnect,
+                              on_publish=on_publish)
+    # Kept even if the broker isn't up yet, its network thread keeps trying
+    # instead of every reading starting another client
+    _publisher = publisher
+    try:
+        publisher.connect(keep_trying=True)
+    except TimeoutError as e:
+        log_event('connect', "Broker not reachable yet, retrying in the background",
+                  logging.WARNING, error=str(e))
+    return _publisher
 
-        # Connect to MQTT broker
-        client.connect(mqtt_host, mqtt_port, 60)
 
-        # Start the network loop to handle callbacks
-        client.loop_start()
+def publish_to_mqtt(value, sFDI):
+    """Publish only the value to MQTT topic"""
+    try:
+        publisher = get_publisher()
 
         # Construct topic
         topic = "xcel_itron5/sFDI/Power_Demand/state"
         message = str(value)
 
-        # Show publishing info based on config
-        if output_config['show_topic']:
-            publish_msg = f"📤 Publishing {message} to {topic}" if output_config[
-                'emoji'] else f"Publishing {message} to {topic}"
-            logger.info(publish_msg)
-        elif not output_config.get('minimal_logging', False):
-            publish_msg = f"📤 Publishing {message}" if output_config[
-                'emoji'] else f"Publishing {message}"
-            logger.info(publish_msg)
+        # Publish message, on_publish reports when the broker has it
+        result = publisher.publish(topic, message)
 
-        logger.info(f"Publishing to topic: {topic} with message: {message}")
-        print(f"Publishing to topic: {topic} with message: {message}")
-
-        # Publish message
-        result = client.publish(topic, message)
-
-        # Wait a moment for the publish callback to be called
-        import time
-        time.sleep(0.1)
-
-        # Check if publish was successful and show minimal output
         if result.rc == mqtt.MQTT_ERR_SUCCESS:
-            if output_config.get('minimal_logging', False):
-                # In minimal mode, show message and success status
-                print(f"Published: {message} ✓")
-                print()  # Add two new lines for spacing
-            else:
-                # Normal mode - use logging
-                status = "✅ Message published" if output_config['emoji'] else "Message published"
-                logger.info(status)
-                print()  # Add two new lines for spacing
-                print()
+            log_event('publish', "Published", value=message, topic=topic,
+                      rc=result.rc, mid=result.mid)
         else:
-            error_msg = f"❌ Publish failed (error code: {result.rc})" if output_config[
-                'emoji'] else f"Publish failed (error code: {result.rc})"
-            logger.error(error_msg)
-            print()  # Add two new lines for spacing even on error
-            print()
-
-        # Stop the network loop and disconnect
-        client.loop_stop()
-        client.disconnect()
+            log_event('publish', "Publish failed", logging.ERROR, value=message,
+                      topic=topic, rc=result.rc, error=mqtt.error_string(result.rc))
 
     except Exception as e:
-        error_msg = f"❌ MQTT error: {str(e)}" if output_config['emoji'] else f"MQTT error: {str(e)}"
-        logger.error(error_msg)
+        log_event('publish', "MQTT error", logging.ERROR, error=str(e))
         # Don't raise the exception - just log it and continue
 
 
@@ -223,6 +151,9 @@ if __name__ == "__main__":
         except KeyboardInterrupt:
             break
         except Exception as e:
-            print(f"Error: {e}")
+            log_event('reading', "Error", logging.ERROR, error=str(e))
 
         time.sleep(5)  # Publish every 5 seconds
+
+    if _publisher is not None:
+        _publisher.close()
@@ -0,0 +1,120 @@
+import threading
+import time
+import paho.mqtt.client as mqtt
+
+
+"""
+
+mqttPublisher.py
+
+
+- long-lived MQTT publisher shared by every reading the agent sends
+- connects once, paho's network thread reconnects on its own when the broker drops
+- tracks in-flight message IDs through on_publish instead of sleeping after each publish
+
+"""
+
+
+class MqttPublisher:
+    """Persistent MQTT connection that publishes readings back to back"""
+
+    def __init__(self, host, port=1883, keepalive=60, qos=0, max_inflight=1000,
+                 on_connect=None, on_disconnect=None, on_publish=None):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.qos = qos
+
+        # Optional callbacks of the caller, run after our own bookkeeping
+        self._user_on_connect = on_connect
+        self._user_on_disconnect = on_disconnect
+        self._user_on_publish = on_publish
+
+        self._inflight_lock = threading.Condition()
+        # {mid: monotonic send time} of messages the broker hasn't confirmed yet
+        self._inflight = {}
+        # on_publish can fire before publish() has returned the mid
+        self._early_acks = set()
+        self.connected = threading.Event()
+        self.published = 0
+        self.failed = 0
+
+        self.client = mqtt.Client()
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+
+    def connect(self, timeout=10.0, keep_trying=False):
+        """
+        Start the network loop and wait until the broker accepts us. On a
+        timeout the loop is stopped again, unless keep_trying leaves paho
+        retrying in the background.
+        """
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+        if not self.connected.wait(timeout):
+            if not keep_trying:
+                self.client.disconnect()
+                self.client.loop_stop()
+            raise TimeoutError(f"No MQTT connection to {self.host}:{self.port} after {timeout}s")
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            self.connected.set()
+        if self._user_on_connect:
+            self._user_on_connect(client, userdata, flags, rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        if self._user_on_disconnect:
+            self._user_on_disconnect(client, userdata, rc)
+
+    def _on_publish(self, client, userdata, mid):
+        with self._inflight_lock:
+            sent_at = self._inflight.pop(mid, None)
+            if sent_at is None:
+                self._early_acks.add(mid)
+            self._inflight_lock.notify_all()
+        latency = time.monotonic() - sent_at if sent_at is not None else 0.0
+        if self._user_on_publish:
+            self._user_on_publish(client, userdata, mid, latency)
+
+    def publish(self, topic, payload, qos=None, retain=False):
+        """Queue a single message, returns paho's MQTTMessageInfo without waiting"""
+        qos = self.qos if qos is None else qos
+        sent_at = time.monotonic()
+        result = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.failed += 1
+            return result
+
+        self.published += 1
+        with self._inflight_lock:
+            if result.mid in self._early_acks:
+                self._early_acks.discard(result.mid)
+            else:
+                self._inflight[result.mid] = sent_at
+        return result
+
+    def publish_many(self, messages, qos=None, retain=False):
+        """Queue a burst of (topic, payload) messages back to back"""
+        return [self.publish(topic, payload, qos=qos, retain=retain)
+                for topic, payload in messages]
+
+    def inflight(self):
+        """Number of messages handed to paho that haven't been confirmed"""
+        with self._inflight_lock:
+            return len(self._inflight)
+
+    def wait_for_inflight(self, timeout=None):
+        """Block until every queued message is confirmed, False on timeout"""
+        with self._inflight_lock:
+            return self._inflight_lock.wait_for(lambda: not self._inflight, timeout)
+
+    def close(self, timeout=5.0):
+        """Flush what's still in flight, then disconnect"""
+        self.wait_for_inflight(timeout)
+        self.client.disconnect()
+        self.client.loop_stop()
@@ -0,0 +1,152 @@
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import paho.mqtt.client as mqtt
+from getSimulatedData import SimulatorClient, SIMULATOR_PORT
+from main_publishData import get_publisher
+from eventLog import log_event
+
+
+"""
+
+simulatorPoller.py
+
+
+- one process polls any number of meterReadingIds on any number of meterSimulator hosts
+- every host keeps one pooled HTTP session, its sFDI is asked for once
+- all ids of a cycle are read at once, each one publishes to its own topic
+- replaces running one main_publishData.py container per meterReadingId, e.g.
+
+    python simulatorPoller.py 10.195.250.49=1-8 10.195.250.50:8083=1,3
+
+targets are HOST[:PORT]=IDS, with SIM_TARGETS (space separated) or HOST_IP=1 as the default
+
+"""
+
+
+TOPIC_TEMPLATE = 'xcel_itron5/{sFDI}/{meterReadingId}/Power_Demand/state'
+
+
+def parse_ids(spec):
+    """'1,3,5-8' -> [1, 3, 5, 6, 7, 8]"""
+    ids = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            ids.extend(range(int(first), int(last) + 1))
+        else:
+            ids.append(int(part))
+    return ids
+
+
+def parse_target(spec):
+    """'host:port=1-4' -> (host, port, [1, 2, 3, 4])"""
+    address, _, ids = spec.partition('=')
+    host, _, port = address.partition(':')
+    return host, int(port or SIMULATOR_PORT), parse_ids(ids or '1')
+
+
+class SimulatorPoller:
+    """Polls every (host, meterReadingId) pair each interval and publishes the values"""
+
+    def __init__(self, targets, publisher, interval=5.0, topic_template=TOPIC_TEMPLATE,
+                 workers=None):
+        self.publisher = publisher
+        self.interval = interval
+        self.topic_template = topic_template
+        # [(client, meterReadingId)], one client per host shared by all of its ids
+        self.readings = []
+        self.clients = []
+        for host, port, ids in targets:
+            client = SimulatorClient(host, port, pool_size=max(len(ids), 1))
+            self.clients.append(client)
+            self.readings.extend((client, meter_reading_id) for meter_reading_id in ids)
+        workers = workers or min(32, max(len(self.readings), 1))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sim_poll')
+        self.cycles = 0
+        self.errors = 0
+
+    def topic(self, client, meter_reading_id):
+        return self.topic_template.format(sFDI=client.getDeviceID(), meterReadingId=meter_reading_id,
+                                          host=client.base_url.split('//', 1)[1])
+
+    def poll_one(self, client, meter_reading_id):
+        """Read and publish one meterReadingId, returns True if it was published"""
+        try:
+            value, touTier = client.getInstantaneousMeterReading(meter_reading_id)
+            topic = self.topic(client, meter_reading_id)
+        except Exception as e:
+            log_event('reading', "Error", logging.ERROR, host=client.base_url,
+                      meterReadingId=meter_reading_id, error=str(e))
+            return False
+        result = self.publisher.publish(topic, str(value))
+        if result.rc != mqtt.MQTT_ERR_SUCCESS:
+            log_event('publish', "Publish failed", logging.ERROR, value=value, topic=topic,
+                      rc=result.rc, error=mqtt.error_string(result.rc))
+            return False
+        log_event('publish', "Published", value=value, topic=topic, rc=result.rc, mid=result.mid)
+        return True
+
+    def poll_cycle(self):
+        """Poll every reading at once, returns how many were published"""
+        results = list(self.executor.map(lambda reading: self.poll_one(*reading), self.readings))
+        self.cycles += 1
+        self.errors += results.count(False)
+        return sum(results)
+
+    def run(self, cycles=None):
+        """Poll every interval, on a fixed schedule, until interrupted or after cycles"""
+        next_cycle = time.monotonic()
+        try:
+            while cycles is None or self.cycles < cycles:
+                self.poll_cycle()
+                next_cycle += self.interval
+                delay = next_cycle - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind, start again from now instead of bursting to catch up
+                    next_cycle = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        for client in self.clients:
+            client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Poll many meterReadingIds of meterSimulator hosts in one process")
+    parser.add_argument('targets', nargs='*', help="HOST[:PORT]=IDS, e.g. 10.0.0.5=1-8")
+    parser.add_argument('--interval', type=float, default=float(os.getenv('SIM_INTERVAL', '5')))
+    parser.add_argument('--topic-template', default=os.getenv('SIM_TOPIC_TEMPLATE', TOPIC_TEMPLATE))
+    parser.add_argument('--cycles', type=int, default=None, help="stop after this many cycles")
+    args = parser.parse_args()
+
+    specs = args.targets or os.getenv('SIM_TARGETS', '').split()
+    if not specs:
+        specs = [f"{os.getenv('HOST_IP', 'localhost')}=1"]
+    targets = [parse_target(spec) for spec in specs]
+
+    print("Meter Agent Simulator Poller")
+    for host, port, ids in targets:
+        print(f"Polling meterReadingIDs {ids} at {host}:{port}")
+    print("")
+
+    publisher = get_publisher()
+    poller = SimulatorPoller(targets, publisher, args.interval, args.topic_template)
+    try:
+        poller.run(args.cycles)
+    finally:
+        poller.close()
+        publisher.close()
+
+
+if __name__ == "__main__":
+    main()